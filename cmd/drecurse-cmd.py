@@ -17,6 +17,7 @@ optspec = """
 bup drecurse <path>
 --
 x,xdev,one-file-system   don't cross filesystem boundaries
+j,jobs=  list up to n directories at once [1]
 exclude= a path to exclude from the backup (can be used more than once)
 exclude-from= a file that contains exclude paths (can be used more than once)
 exclude-rx= skip paths matching the unanchored regex (may be repeated)
@@ -29,6 +30,8 @@ o = options.Options(optspec)
 
 if len(extra) != 1:
     o.fatal("exactly one filename expected")
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 
 drecurse_top = extra[0]
 excluded_paths = parse_excludes(flags, o.fatal)
@@ -37,7 +40,8 @@ if not drecurse_top.startswith('/'):
 exclude_rxs = parse_rx_excludes(flags, o.fatal)
 it = drecurse.recursive_dirlist([drecurse_top], opt.xdev,
                                 excluded_paths=excluded_paths,
-                                exclude_rxs=exclude_rxs)
+                                exclude_rxs=exclude_rxs,
+                                jobs=opt.jobs)
 if opt.profile:
     import cProfile
     def do_it():
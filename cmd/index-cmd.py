@@ -8,7 +8,8 @@ exec "$bup_python" "$0" ${1+"$@"}
 from __future__ import absolute_import
 import sys, stat, time, os, errno, re
 
-from bup import metadata, options, git, index, drecurse, hlinkdb
+from bup import (metadata, options, git, index, drecurse, hlinkdb, journal,
+                 xstat)
 from bup.drecurse import recursive_dirlist
 from bup.hashsplit import GIT_MODE_TREE, GIT_MODE_FILE
 from bup.helpers import (add_error, handle_ctrl_c, log, parse_excludes, parse_rx_excludes,
@@ -30,20 +31,22 @@ def check_index(reader):
     try:
         log('check: checking forward iteration...\n')
         e = None
-        d = {}
-        for e in reader.forward_iter():
-            if e.children_n:
-                if opt.verbose:
-                    log('%08x+%-4d %r\n' % (e.children_ofs, e.children_n,
-                                            e.name))
-                assert(e.children_ofs)
-                assert(e.name.endswith('/'))
-                assert(not d.get(e.children_ofs))
-                d[e.children_ofs] = 1
-            if e.flags & index.IX_HASHVALID:
-                assert(e.sha != index.EMPTY_SHA)
-                assert(e.gitmode)
-        assert(not e or e.name == '/')  # last entry is *always* /
+        for r in filter(None, [reader, reader.overlay]):
+            e = None
+            d = {}
+            for e in r.forward_iter():
+                if e.children_n:
+                    if opt.verbose:
+                        log('%08x+%-4d %r\n' % (e.children_ofs, e.children_n,
+                                                e.name))
+                    assert(e.children_ofs)
+                    assert(e.name.endswith('/'))
+                    assert(not d.get(e.children_ofs))
+                    d[e.children_ofs] = 1
+                if e.flags & index.IX_HASHVALID:
+                    assert(e.sha != index.EMPTY_SHA)
+                    assert(e.gitmode)
+            assert(not e or e.name == '/')  # last entry is *always* /
         log('check: checking normal iteration...\n')
         last = None
         for e in reader:
@@ -57,7 +60,10 @@ def check_index(reader):
 
 
 def clear_index(indexfile):
-    indexfiles = [indexfile, indexfile + '.meta', indexfile + '.hlink']
+    indexfiles = [indexfile, indexfile + '.meta', indexfile + '.hlink',
+                  indexfile + '.dirty', indexfile + '.journal',
+                  indexfile + '.journal.claimed',
+                  indexfile + index.OVERLAY_SUFFIX]
     for indexfile in indexfiles:
         path = git.repo(indexfile)
         try:
@@ -69,14 +75,68 @@ def clear_index(indexfile):
                 raise
 
 
-def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions):
+def indexed(reader, top):
+    # Whether top has an (existing) entry in the index.
+    want = lambda e: top.startswith(e.name) and e.name != top
+    return any(e.name == top and e.exists()
+               for e in reader.iter(name=top, wantrecurse=want))
+
+
+def parent_dir(path):
+    return os.path.dirname(path.rstrip('/')).rstrip('/') + '/'
+
+
+def unchanged_dir(ent, st, tstart):
+    # Whether the names in the directory can't have changed since ent
+    # was recorded, assuming any change to them updates the
+    # directory's mtime and ctime.  Recent (capped) times won't match.
+    if not (ent.exists() and stat.S_ISDIR(ent.mode)):
+        return False
+    if ent.mtime != st.st_mtime or ent.ctime != st.st_ctime:
+        return False
+    if ent.ino != st.st_ino:
+        return False
+    if opt.check_device and ent.dev != st.st_dev:
+        return False
+    return xstat.fstime_floor_secs(st.st_ctime) * 10**9 < tstart
+
+
+def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions,
+                 change_journal=None):
     # tmax and start must be epoch nanoseconds.
     tmax = (time.time() - 1) * 10**9
+    dirty = index.DirtyCounts(indexfile + '.dirty', indexfile)
     ri = index.Reader(indexfile)
     msw = index.MetaStoreWriter(indexfile + '.meta')
     wi = index.Writer(indexfile, msw, tmax)
-    rig = IterHelper(ri.iter(name=top))
     tstart = int(time.time()) * 10**9
+    bup_dir = os.path.abspath(git.repo())
+
+    changes = None
+    if change_journal:
+        why = change_journal.unusable_reason(top, excluded_paths, exclude_rxs,
+                                             opt.xdev)
+        if not why and not indexed(ri, top):
+            why = '%r is not in the index yet' % top
+        if why:
+            log('index: %s; checking everything in %r\n' % (why, top))
+        else:
+            changes = journal.Changes(top, change_journal.records_beneath(top),
+                                      xdev=opt.xdev,
+                                      bup_dir=bup_dir,
+                                      excluded_paths=excluded_paths,
+                                      exclude_rxs=exclude_rxs,
+                                      xdev_exceptions=xdev_exceptions,
+                                      jobs=opt.jobs)
+
+    known_dirlist = None
+    if opt.skip_unchanged_dirs:
+        listings = index.DirListings(ri)
+        def known_dirlist(path, st):
+            ent = listings.entry(path)
+            if ent and unchanged_dir(ent, st, tstart):
+                return listings.names(path)
+            return None
 
     hlinks = hlinkdb.HLinkDB(indexfile + '.hlink')
 
@@ -85,15 +145,43 @@ def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions):
         def fake_hash(name):
             return (GIT_MODE_FILE, index.FAKE_SHA)
 
+    if changes:
+        # Only the journaled paths are visited, so entries skipped
+        # along the way haven't necessarily been deleted.
+        rig = IterHelper(ri.iter(name=top, wantrecurse=changes.wantrecurse))
+        paths = changes.paths
+        gone = changes.covers
+    else:
+        rig = IterHelper(ri.iter(name=top))
+        paths = recursive_dirlist([top],
+                                  xdev=opt.xdev,
+                                  bup_dir=bup_dir,
+                                  excluded_paths=excluded_paths,
+                                  exclude_rxs=exclude_rxs,
+                                  xdev_exceptions=xdev_exceptions,
+                                  jobs=opt.jobs,
+                                  known_dirlist=known_dirlist)
+        gone = None
+
+    # Count what's left for save to do as we go, so that --progress
+    # can skip its pre-scan.  Journaled updates don't visit every
+    # entry, so they can't.
+    if changes:
+        dirty.forget(top)
+        def count(name, size, exists, valid):
+            pass
+    else:
+        dirty.begin(top)
+        count = dirty.add
+
+    # Directories that gained entries, which must be invalidated.
+    grown = set()
+    # Deleted entries a compaction could drop.
+    droppable = 0
+
     total = 0
-    bup_dir = os.path.abspath(git.repo())
     index_start = time.time()
-    for path, pst in recursive_dirlist([top],
-                                       xdev=opt.xdev,
-                                       bup_dir=bup_dir,
-                                       excluded_paths=excluded_paths,
-                                       exclude_rxs=exclude_rxs,
-                                       xdev_exceptions=xdev_exceptions):
+    for path, pst in paths:
         if opt.verbose>=2 or (opt.verbose==1 and stat.S_ISDIR(pst.st_mode)):
             sys.stdout.write('%s\n' % path)
             sys.stdout.flush()
@@ -107,11 +195,15 @@ def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions):
         total += 1
 
         while rig.cur and rig.cur.name > path:  # deleted paths
-            if rig.cur.exists():
+            if rig.cur.exists() and (not gone or gone(rig.cur.name)):
                 rig.cur.set_deleted()
                 rig.cur.repack()
                 if rig.cur.nlink > 1 and not stat.S_ISDIR(rig.cur.mode):
                     hlinks.del_path(rig.cur.name)
+            elif index.droppable(rig.cur):
+                droppable += 1
+            count(rig.cur.name, rig.cur.size, rig.cur.exists(),
+                  rig.cur.is_valid())
             rig.next()
 
         if rig.cur and rig.cur.name == path:    # paths that already existed
@@ -121,6 +213,8 @@ def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions):
                     meta = metadata.from_path(path, statinfo=pst)
                 except (OSError, IOError) as e:
                     add_error(e)
+                    count(rig.cur.name, rig.cur.size, rig.cur.exists(),
+                          rig.cur.is_valid())
                     rig.next()
                     continue
                 if not stat.S_ISDIR(rig.cur.mode) and rig.cur.nlink > 1:
@@ -149,11 +243,14 @@ def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions):
                     rig.cur.gitmode, rig.cur.sha = fake_hash(path)
                     rig.cur.flags |= index.IX_HASHVALID
                     need_repack = True
-            if opt.fake_invalid:
+            if opt.fake_invalid or path in grown:
                 rig.cur.invalidate()
                 need_repack = True
+                grown.discard(path)
             if need_repack:
                 rig.cur.repack()
+            count(rig.cur.name, rig.cur.size, rig.cur.exists(),
+                  rig.cur.is_valid())
             rig.next()
         else:  # new paths
             try:
@@ -165,16 +262,29 @@ def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions):
             meta.atime = meta.mtime = meta.ctime = 0
             meta_ofs = msw.store(meta)
             wi.add(path, pst, meta_ofs, hashgen=fake_hash)
+            count(path, pst.st_size, True, bool(fake_hash))
             if not stat.S_ISDIR(pst.st_mode) and pst.st_nlink > 1:
                 hlinks.add_path(path, pst.st_dev, pst.st_ino)
+            if path != '/':
+                grown.add(parent_dir(path))
 
     elapsed = time.time() - index_start
     paths_per_sec = total / elapsed if elapsed else 0
     progress('Indexing: %d, done (%d paths/s).\n' % (total, paths_per_sec))
+    if not changes:
+        dirty.end()
 
     hlinks.prepare_save()
 
     if ri.exists():
+        # The directories above top that gained entries (e.g. top
+        # itself is new) weren't visited.
+        listings = index.DirListings(ri)
+        for d in grown:
+            e = listings.entry(d)
+            if e and e.is_valid():
+                e.invalidate()
+                e.repack()
         ri.save()
         wi.flush()
         if wi.count:
@@ -184,21 +294,21 @@ def update_index(top, excluded_paths, exclude_rxs, xdev_exceptions):
                 check_index(ri)
                 log('check: before merging: newfile\n')
                 check_index(wr)
-            mi = index.Writer(indexfile, msw, tmax)
-
-            for e in index.merge(ri, wr):
-                # FIXME: shouldn't we remove deleted entries eventually?  When?
-                mi.add_ixentry(e)
-
-            ri.close()
-            mi.close()
+            index.add_to_overlay(ri, wr, msw, tmax)
             wr.close()
         wi.abort()
+        ri.close()
+        ri = index.Reader(indexfile)
+        compact = index.wants_compaction(ri, droppable)
+        ri.close()
+        if compact:
+            index.compact(indexfile, msw, tmax)
     else:
         wi.close()
 
     msw.close()
     hlinks.commit_save()
+    dirty.save()
 
 
 optspec = """
@@ -211,6 +321,7 @@ s,status   print each filename with a status char (A/M/D) (implies -p)
 u,update   recursively update the index entries for the given file/dir names (default if no mode is specified)
 check      carefully check index file integrity
 clear      clear the default index
+watch      journal changes to the given paths (until interrupted) for --from-journal
  Options:
 H,hash     print the hash for each object next to its name
 l,long     print more information about each file
@@ -224,6 +335,9 @@ exclude-rx= skip paths matching the unanchored regex (may be repeated)
 exclude-rx-from= skip --exclude-rx patterns in file (may be repeated)
 v,verbose  increase log output (can be used more than once)
 x,xdev,one-file-system  don't cross filesystem boundaries
+j,jobs=    list and stat up to n directories at once [1]
+skip-unchanged-dirs  don't re-read directories whose mtime and ctime haven't changed
+from-journal  only update the paths journaled by a running --watch (when it can be trusted)
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -233,14 +347,27 @@ if not (opt.modified or \
         opt.status or \
         opt.update or \
         opt.check or \
-        opt.clear):
+        opt.clear or \
+        opt.watch):
     opt.update = 1
 if (opt.fake_valid or opt.fake_invalid) and not opt.update:
     o.fatal('--fake-{in,}valid are meaningless without -u')
 if opt.fake_valid and opt.fake_invalid:
     o.fatal('--fake-valid is incompatible with --fake-invalid')
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
 if opt.clear and opt.indexfile:
     o.fatal('cannot clear an external index (via -f)')
+if opt.from_journal and not opt.update:
+    o.fatal('--from-journal is meaningless without -u')
+if opt.watch:
+    if (opt.modified or opt['print'] or opt.status or opt.update
+        or opt.check or opt.clear):
+        o.fatal('--watch is incompatible with the other modes')
+    if not extra:
+        o.fatal('watch mode requested but no paths given')
+    if not journal.have_inotify():
+        o.fatal('--watch is only supported with inotify (i.e. on Linux)')
 
 # FIXME: remove this once we account for timestamp races, i.e. index;
 # touch new-file; index.  It's possible for this to happen quickly
@@ -262,14 +389,50 @@ if opt.clear:
     log('clear: clearing index.\n')
     clear_index(indexfile)
 
+if opt.watch:
+    excluded_paths = parse_excludes(flags, o.fatal)
+    exclude_rxs = parse_rx_excludes(flags, o.fatal)
+    xexcept = index.unique_resolved_paths(extra)
+    paths = [rp for rp, path in index.reduce_paths(extra)]
+    change_journal = journal.Journal(indexfile + '.journal')
+    watcher = None
+    try:
+        change_journal.start_watching(
+            journal.WatchInfo(paths, excluded_paths,
+                              [rx.pattern for rx in exclude_rxs],
+                              bool(opt.xdev)))
+        watcher = journal.Watcher(change_journal, paths,
+                                  xdev=opt.xdev,
+                                  bup_dir=os.path.abspath(git.repo()),
+                                  excluded_paths=excluded_paths,
+                                  exclude_rxs=exclude_rxs,
+                                  xdev_exceptions=xexcept)
+        watcher.run()
+    except journal.Error as e:
+        log('error: %s\n' % e)
+        sys.exit(1)
+    finally:
+        if watcher:
+            watcher.close()
+        change_journal.stop_watching()
+
 if opt.update:
     if not extra:
         o.fatal('update mode (-u) requested but no paths given')
     excluded_paths = parse_excludes(flags, o.fatal)
     exclude_rxs = parse_rx_excludes(flags, o.fatal)
     xexcept = index.unique_resolved_paths(extra)
+    change_journal = None
+    if opt.from_journal:
+        change_journal = journal.Journal(indexfile + '.journal')
+        change_journal.claim()
+    tops = []
     for rp, path in index.reduce_paths(extra):
-        update_index(rp, excluded_paths, exclude_rxs, xdev_exceptions=xexcept)
+        update_index(rp, excluded_paths, exclude_rxs, xdev_exceptions=xexcept,
+                     change_journal=change_journal)
+        tops.append(rp)
+    if change_journal:
+        change_journal.finish(tops)
 
 if opt['print'] or opt.status or opt.modified:
     for (name, ent) in index.Reader(indexfile).filter(extra or ['']):
@@ -8,14 +8,20 @@ exec "$bup_python" "$0" ${1+"$@"}
 from __future__ import absolute_import
 import sys
 
-from bup import git, options, client
+from bup import git, hashsplit, options, client
 from bup.helpers import log, saved_errors
 
 
 optspec = """
-[BUP_DIR=...] bup init [-r host:path]
+[BUP_DIR=...] bup init [-r host:path] [split options...]
 --
 r,remote=  remote repository path
+ Split options (recorded in the local repository):
+chunker=   content-defined chunking engine
+blob-bits= average blob size, as a power of two
+min-blob-size=  minimum blob size
+max-blob-size=  maximum blob size
+fanout=    average number of blobs in a single tree
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -23,9 +29,21 @@ o = options.Options(optspec)
 if extra:
     o.fatal("no arguments expected")
 
+config = {}
+for name, value in (('chunker', opt.chunker),
+                    ('blobBits', opt.blob_bits),
+                    ('minSize', opt.min_blob_size),
+                    ('maxSize', opt.max_blob_size),
+                    ('fanout', opt.fanout)):
+    if value is not None:
+        config['bup.split.' + name] = str(value)
+try:
+    hashsplit.read_config(config.get)
+except ValueError as e:
+    o.fatal(str(e))
 
 try:
-    git.init_repo()  # local repo
+    git.init_repo(config=config)  # local repo
 except git.GitError as e:
     log("bup: error: could not init repository: %s" % e)
     sys.exit(1)
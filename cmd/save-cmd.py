@@ -6,17 +6,19 @@ exec "$bup_python" "$0" ${1+"$@"}
 # end of bup preamble
 
 from __future__ import absolute_import
+from collections import deque
 from errno import EACCES
-from io import BytesIO
+from itertools import islice
 import os, sys, stat, time, math
 
-from bup import hashsplit, git, options, index, client, metadata, hlinkdb
+from bup import (hashsplit, git, options, index, client, metadata, hlinkdb,
+                 xstat)
 from bup.hashsplit import GIT_MODE_TREE, GIT_MODE_FILE, GIT_MODE_SYMLINK
 from bup.helpers import (add_error, grafted_path_components, handle_ctrl_c,
                          hostname, istty2, log, parse_date_or_fatal, parse_num,
                          path_components, progress, qprogress, resolve_parent,
                          saved_errors, stripped_path_components,
-                         userfullname, username, valid_save_name)
+                         unlink, userfullname, username, valid_save_name)
 
 
 optspec = """
@@ -36,6 +38,8 @@ strip      strips the path to every filename given
 strip-path= path-prefix to be stripped when saving
 graft=     a graft point *old_path*=*new_path* (can be used more than once)
 #,compress=  set compression level to # (0-9, 9 is highest) [1]
+j,jobs=    read, split and compress up to n files at once [1]
+prefetch=  have the kernel start reading the next n files to save early [0]
 """
 o = options.Options(optspec)
 (opt, flags, extra) = o.parse(sys.argv[1:])
@@ -56,6 +60,12 @@ if opt.date:
 else:
     date = time.time()
 
+if opt.jobs < 1:
+    o.fatal('--jobs must be at least 1')
+threads = opt.jobs if opt.jobs > 1 else None
+if opt.prefetch < 0:
+    o.fatal('--prefetch must not be negative')
+
 if opt.strip and opt.strip_path:
     o.fatal("--strip is incompatible with --strip-path")
 
@@ -92,11 +102,19 @@ if opt.remote or is_reverse:
         log('error: %s' % e)
         sys.exit(1)
     oldref = refname and cli.read_ref(refname) or None
-    w = cli.new_packwriter(compression_level=opt.compress)
+    split_config = cli.config_get
+    w = cli.new_packwriter(compression_level=opt.compress, threads=threads)
 else:
     cli = None
     oldref = refname and git.read_ref(refname) or None
-    w = git.PackWriter(compression_level=opt.compress)
+    split_config = git.git_config_get
+    w = git.PackWriter(compression_level=opt.compress, threads=threads)
+
+try:
+    hashsplit.configure(split_config)
+except ValueError as e:
+    log('error: %s\n' % e)
+    sys.exit(1)
 
 handle_ctrl_c()
 
@@ -114,8 +132,9 @@ def eatslash(dir):
 # elements, in the order they're listed in the index.
 #
 # Since the git tree elements are sorted according to
-# git.shalist_item_sort_key, the metalist items are accumulated as
-# (sort_key, metadata) tuples, and then sorted when the .bupm file is
+# git.shalist_item_sort_key, the metalist items are accumulated in a
+# metadata.MetadataSpool along with their sort_key, and sorted (and
+# merged with any runs spilled to disk) when the .bupm file is
 # created.  The sort_key must be computed using the element's real
 # name and mode rather than the git mode and (possibly mangled) name.
 
@@ -130,11 +149,11 @@ shalists = [] # Hashes for each dir in paths.
 metalists = [] # Metadata for each dir in paths.
 
 
-def _push(part, metadata):
+def _push(part, dir_metadata):
     # Enter a new archive directory -- make it the current directory.
     parts.append(part)
     shalists.append([])
-    metalists.append([('', metadata)]) # This dir's metadata (no name).
+    metalists.append(metadata.MetadataSpool(dir_metadata))
 
 
 def _pop(force_tree, dir_metadata=None):
@@ -143,16 +162,16 @@ def _pop(force_tree, dir_metadata=None):
     part = parts.pop()
     shalist = shalists.pop()
     metalist = metalists.pop()
-    if metalist and not force_tree:
-        if dir_metadata: # Override the original metadata pushed for this dir.
-            metalist = [('', dir_metadata)] + metalist[1:]
-        sorted_metalist = sorted(metalist, key = lambda x : x[0])
-        metadata = ''.join([m[1].encode() for m in sorted_metalist])
-        metadata_f = BytesIO(metadata)
-        mode, id = hashsplit.split_to_blob_or_tree(w.new_blob, w.new_tree,
-                                                   [metadata_f],
-                                                   keep_boundaries=False)
-        shalist.append((mode, '.bupm', id))
+    try:
+        if not force_tree:
+            if dir_metadata: # Override the original metadata pushed for this dir.
+                metalist.dir_meta = dir_metadata
+            mode, id = hashsplit.split_to_blob_or_tree(w.new_blob, w.new_tree,
+                                                       [metalist.reader()],
+                                                       keep_boundaries=False)
+            shalist.append((mode, '.bupm', id))
+    finally:
+        metalist.close()
     # FIXME: only test if collision is possible (i.e. given --strip, etc.)?
     if force_tree:
         tree = force_tree
@@ -242,20 +261,121 @@ def find_hardlink_target(hlink_db, ent):
         if link_paths:
             return link_paths[0]
 
+def indexed_metadata(ent, st):
+    # bup index already recorded the metadata for ent; if the path
+    # hasn't changed since (any metadata change also changes the
+    # ctime), use that rather than collecting it all again.  Entries
+    # whose times were capped by the index won't match.
+    if (st.st_ctime != ent.ctime or st.st_mtime != ent.mtime
+        or st.st_size != ent.size or st.st_ino != ent.ino
+        or st.st_dev != ent.dev or st.st_mode != ent.mode
+        or st.st_nlink != ent.nlink):
+        return None
+    meta = msr.metadata_at(ent.meta_ofs)
+    # Restore the times that were cleared to 0 in the metastore.
+    (meta.atime, meta.mtime, meta.ctime) = (ent.atime, ent.mtime, ent.ctime)
+    return meta
+
+def will_split(ent):
+    return ent.exists() and not already_saved(ent) \
+        and stat.S_ISREG(ent.mode) \
+        and not (opt.smaller and ent.size >= opt.smaller)
+
+class FileSplit:
+    """The split of the regular file ent, which happens when it's saved,
+    unless it's started earlier on a background thread via start()."""
+    def __init__(self, ent):
+        self.f = self.splits = None
+        self.open_error = None
+        try:
+            self.f = hashsplit.open_noatime(ent.name)
+        except (IOError, OSError) as e:
+            self.open_error = e
+
+    def prefetch(self):
+        if self.f:
+            hashsplit.prefetch(self.f)
+
+    def start(self):
+        if self.f and not self.splits:
+            self.splits = hashsplit.split_ahead([self.f], False)
+
+    def save(self):
+        """Write the file's blobs and trees, and return its (mode, id)."""
+        return hashsplit.split_to_blob_or_tree(w.new_blob, w.new_tree,
+                                               [self.f],
+                                               keep_boundaries=False,
+                                               splits=self.splits)
+
+    def close(self):
+        if self.splits:
+            self.splits.close()
+        if self.f:
+            hashsplit.forget_prefetch(self.f)
+            self.f.close()
+            self.f = None
+
+_max_entries_ahead = 1000
+
+def looking_ahead(entries, jobs, prefetch):
+    """Yield (transname, ent, split) for each of entries, where split
+    is a FileSplit for each regular file that's going to be saved, and
+    None otherwise.  When jobs > 1, keep that many splits running,
+    counting the one for the entry last yielded.  Have the kernel
+    start reading the next prefetch files after those."""
+    pending = deque()
+    splits = deque()  # the FileSplits in pending
+    def next_item():
+        if jobs > 1:
+            for split in islice(splits, jobs):
+                split.start()
+        item = pending.popleft()
+        if item[2]:
+            splits.popleft()
+        return item
+    try:
+        for transname, ent in entries:
+            split = None
+            if will_split(ent):
+                split = FileSplit(ent)
+                if prefetch:
+                    split.prefetch()
+                splits.append(split)
+            pending.append((transname, ent, split))
+            while len(splits) >= jobs + prefetch \
+                  or len(pending) > _max_entries_ahead:
+                yield next_item()
+        while pending:
+            yield next_item()
+    finally:
+        # Any splits we didn't get to (e.g. after an error)
+        for split in splits:
+            split.close()
+
 total = ftotal = 0
 if opt.progress:
-    for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_pre):
-        if not (ftotal % 10024):
-            qprogress('Reading index: %d\r' % ftotal)
-        exists = ent.exists()
-        hashvalid = already_saved(ent)
-        ent.set_sha_missing(not hashvalid)
-        if not opt.smaller or ent.size < opt.smaller:
-            if exists and not hashvalid:
-                total += ent.size
-        ftotal += 1
-    progress('Reading index: %d, done.\n' % ftotal)
+    totals = None
+    if not opt.smaller:
+        dirty = index.DirtyCounts(indexfile + '.dirty', indexfile)
+        totals = dirty.totals(extra)
+    if totals:
+        (total, ftotal) = totals
+    else:
+        for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_pre):
+            if not (ftotal % 10024):
+                qprogress('Reading index: %d\r' % ftotal)
+            exists = ent.exists()
+            hashvalid = already_saved(ent)
+            ent.set_sha_missing(not hashvalid)
+            if not opt.smaller or ent.size < opt.smaller:
+                if exists and not hashvalid:
+                    total += ent.size
+            ftotal += 1
+        progress('Reading index: %d, done.\n' % ftotal)
     hashsplit.progress_callback = progress_report
+# The counts left by bup index won't survive the changes we're about
+# to make to the index.
+unlink(indexfile + '.dirty')
 
 # Root collisions occur when strip or graft options map more than one
 # path to the same directory (paths which originally had separate
@@ -274,7 +394,12 @@ tstart = time.time()
 count = subcount = fcount = 0
 lastskip_name = None
 lastdir = ''
-for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
+entries = r.filter(extra, wantrecurse=wantrecurse_during)
+if opt.jobs > 1 or opt.prefetch:
+    entries = looking_ahead(entries, opt.jobs, opt.prefetch)
+else:
+    entries = ((transname, ent, None) for transname, ent in entries)
+for (transname, ent, split) in entries:
     (dir, file) = os.path.split(ent.name)
     exists = (ent.flags & index.IX_EXISTS)
     hashvalid = already_saved(ent)
@@ -383,22 +508,21 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
         meta.hardlink_target = find_hardlink_target(hlink_db, ent)
         # Restore the times that were cleared to 0 in the metastore.
         (meta.atime, meta.mtime, meta.ctime) = (ent.atime, ent.mtime, ent.ctime)
-        metalists[-1].append((sort_key, meta))
+        metalists[-1].append(sort_key, meta)
     else:
         if stat.S_ISREG(ent.mode):
-            try:
-                f = hashsplit.open_noatime(ent.name)
-            except (IOError, OSError) as e:
-                add_error(e)
+            split = split or FileSplit(ent)
+            if split.open_error:
+                add_error(split.open_error)
                 lastskip_name = ent.name
             else:
                 try:
-                    (mode, id) = hashsplit.split_to_blob_or_tree(
-                                            w.new_blob, w.new_tree, [f],
-                                            keep_boundaries=False)
+                    (mode, id) = split.save()
                 except (IOError, OSError) as e:
                     add_error('%s: %s' % (ent.name, e))
                     lastskip_name = ent.name
+                finally:
+                    split.close()
         else:
             if stat.S_ISDIR(ent.mode):
                 assert(0)  # handled above
@@ -425,12 +549,18 @@ for (transname,ent) in r.filter(extra, wantrecurse=wantrecurse_during):
             sort_key = git.shalist_item_sort_key((ent.mode, file, id))
             hlink = find_hardlink_target(hlink_db, ent)
             try:
-                meta = metadata.from_path(ent.name, hardlink_target=hlink)
+                st = xstat.lstat(ent.name)
+                meta = indexed_metadata(ent, st)
+                if meta:
+                    meta.hardlink_target = hlink
+                else:
+                    meta = metadata.from_path(ent.name, statinfo=st,
+                                              hardlink_target=hlink)
             except (OSError, IOError) as e:
                 add_error(e)
                 lastskip_name = ent.name
             else:
-                metalists[-1].append((sort_key, meta))
+                metalists[-1].append(sort_key, meta)
 
     if exists and wasmissing:
         count += oldsize
@@ -146,6 +146,13 @@ def read_ref(conn, refname):
     conn.ok()
 
 
+def config_get(conn, name):
+    _init_session()
+    value = git.git_config_get(name, repo_dir=git.repodir)
+    conn.write('%s\n' % (value or '').encode('hex'))
+    conn.ok()
+
+
 def update_ref(conn, refname):
     _init_session()
     newval = conn.readline().strip()
@@ -171,18 +178,27 @@ def cat_batch(conn, dummy):
     _init_session()
     cat_pipe = git.cp()
     # For now, avoid potential deadlock by just reading them all
-    for ref in tuple(lines_until_sentinel(conn, '\n', Exception)):
-        ref = ref[:-1]
-        it = cat_pipe.get(ref)
-        info = next(it)
-        if not info[0]:
+    refs = tuple(x[:-1] for x in lines_until_sentinel(conn, '\n', Exception))
+    for oidx, typ, size, it in cat_pipe.get_many(refs):
+        if not oidx:
             conn.write('missing\n')
             continue
-        conn.write('%s %s %d\n' % info)
+        conn.write('%s %s %d\n' % (oidx, typ, size))
         for buf in it:
             conn.write(buf)
     conn.ok()
 
+def cat_batch_check(conn, dummy):
+    _init_session()
+    cat_pipe = git.cp()
+    refs = tuple(x[:-1] for x in lines_until_sentinel(conn, '\n', Exception))
+    for oidx, typ, size in cat_pipe.get_info_many(refs):
+        if not oidx:
+            conn.write('missing\n')
+            continue
+        conn.write('%s %s %d\n' % (oidx, typ, size))
+    conn.ok()
+
 def refs(conn, args):
     limit_to_heads, limit_to_tags = args.split()
     assert limit_to_heads in ('0', '1')
@@ -248,9 +264,11 @@ commands = {
     'receive-objects-v2': receive_objects_v2,
     'read-ref': read_ref,
     'update-ref': update_ref,
+    'config-get': config_get,
     'join': join,
     'cat': join,  # apocryphal alias
     'cat-batch' : cat_batch,
+    'cat-batch-check' : cat_batch_check,
     'refs': refs,
     'rev-list': rev_list
 }
@@ -68,10 +68,6 @@ max_pack_objects = None
 if opt.max_pack_objects:
     max_pack_objects = parse_num(opt.max_pack_objects)
 
-if opt.fanout:
-    hashsplit.fanout = parse_num(opt.fanout)
-if opt.blobs:
-    hashsplit.fanout = 0
 if opt.bwlimit:
     client.bwlimit = parse_num(opt.bwlimit)
 if opt.date:
@@ -100,19 +96,34 @@ if opt.name and not valid_save_name(opt.name):
 refname = opt.name and 'refs/heads/%s' % opt.name or None
 if opt.noop or opt.copy:
     cli = pack_writer = oldref = None
+    split_config = git.git_config_get
 elif opt.remote or is_reverse:
     cli = client.Client(opt.remote)
     oldref = refname and cli.read_ref(refname) or None
+    split_config = cli.config_get
     pack_writer = cli.new_packwriter(compression_level=opt.compress,
                                      max_pack_size=max_pack_size,
                                      max_pack_objects=max_pack_objects)
 else:
     cli = None
     oldref = refname and git.read_ref(refname) or None
+    split_config = git.git_config_get
     pack_writer = git.PackWriter(compression_level=opt.compress,
                                  max_pack_size=max_pack_size,
                                  max_pack_objects=max_pack_objects)
 
+try:
+    hashsplit.configure(split_config)
+except ValueError as e:
+    log('error: %s\n' % e)
+    sys.exit(1)
+
+# The command line overrides the repository's fanout
+if opt.fanout:
+    hashsplit.fanout = parse_num(opt.fanout)
+if opt.blobs:
+    hashsplit.fanout = 0
+
 if opt.git_ids:
     # the input is actually a series of git object ids that we should retrieve
     # and split.
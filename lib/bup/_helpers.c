@@ -16,6 +16,7 @@
 #include <stdlib.h>
 #include <stdio.h>
 #include <string.h>
+#include <dirent.h>
 
 #ifdef HAVE_SYS_MMAN_H
 #include <sys/mman.h>
@@ -36,11 +37,18 @@
 #ifdef HAVE_SYS_IOCTL_H
 #include <sys/ioctl.h>
 #endif
+#ifdef HAVE_SYS_INOTIFY_H
+#include <sys/inotify.h>
+#endif
 
 #ifdef HAVE_TM_TM_GMTOFF
 #include <time.h>
 #endif
 
+#ifdef BUP_HAVE_OPENSSL_SHA1
+#include <openssl/evp.h>
+#endif
+
 #include "bupsplit.h"
 
 #if defined(FS_IOC_GETFLAGS) && defined(FS_IOC_SETFLAGS)
@@ -539,6 +547,362 @@ static PyObject *splitbuf(PyObject *self, PyObject *args)
 }
 
 
+// The content-defined chunking engines.  A repository must stick to
+// one of them, since the same data split by another engine won't
+// deduplicate against what's already there.
+#define CHUNKER_BUPSPLIT 0
+#define CHUNKER_FASTCDC 1
+
+// How to split: with which engine, aiming for blobs of 1 << bits
+// bytes, none smaller than min (unless the data runs out) or larger
+// than max.
+typedef struct {
+    int engine, bits, min, max;
+} chunker;
+
+// FastCDC (Xia et al., "FastCDC: a Fast and Efficient Content-Defined
+// Chunking Approach for Data Deduplication", USENIX ATC 2016) with a
+// gear hash, which costs one shift, one add, and one table lookup per
+// byte.  It never splits before the minimum, and uses "normalized
+// chunking": a split requires FASTCDC_NORMALIZATION more leading zero
+// bits than the chunker's bits before the average size, and that many
+// fewer after, which concentrates the sizes around the average.
+
+#define FASTCDC_NORMALIZATION 2
+
+static uint64_t gear_table[256];
+
+static void gear_table_init(void)
+{
+    // splitmix64, so the table is the same everywhere without having
+    // to spell out 256 constants.
+    uint64_t x = 0x62757073706c6974ULL;  // "bupsplit"
+    int i;
+    for (i = 0; i < 256; i++)
+    {
+        uint64_t z = (x += 0x9e3779b97f4a7c15ULL);
+        z = (z ^ (z >> 30)) * 0xbf58476d1ce4e5b9ULL;
+        z = (z ^ (z >> 27)) * 0x94d049bb133111ebULL;
+        gear_table[i] = z ^ (z >> 31);
+    }
+}
+
+// Like bupsplit_find_ofs().  Since the gear hash shifts each byte out
+// of the top after 64 more, the split depends only on the preceding
+// 64 bytes, and *bits is the number of leading zero bits in the hash
+// (at least c->bits, so levels are comparable with bupsplit's).
+static int fastcdc_find_ofs(const chunker *c, const unsigned char *buf,
+                            int len, int *bits)
+{
+    const uint64_t strict = 1ULL << (64 - c->bits - FASTCDC_NORMALIZATION);
+    const uint64_t loose = 1ULL << (64 - c->bits + FASTCDC_NORMALIZATION);
+    int i = c->min, normal = 1 << c->bits;
+    uint64_t h = 0;
+
+    if (normal > len)
+        normal = len;
+    for (; i < normal; i++)
+    {
+        h = (h << 1) + gear_table[buf[i]];
+        if (h < strict)
+            goto found;
+    }
+    for (; i < len; i++)
+    {
+        h = (h << 1) + gear_table[buf[i]];
+        if (h < loose)
+            goto found;
+    }
+    return 0;
+
+ found:
+    if (bits)
+    {
+        int zeros = 0;
+        while (zeros < 64 && !(h & (1ULL << (63 - zeros))))
+            zeros++;
+        *bits = zeros < c->bits ? c->bits : zeros;
+    }
+    return i + 1;
+}
+
+// Return the first bupsplit split that's at least c->min bytes in.
+// The rollsum starts over after each split that's too early.
+static int bupsplit_find_min_ofs(const chunker *c, const unsigned char *buf,
+                                 int len, int *bits)
+{
+    int ofs = 0;
+    while (1)
+    {
+        int size = bupsplit_find_ofs_for(buf + ofs, len - ofs, c->bits, bits);
+        if (!size)
+            return 0;
+        ofs += size;
+        if (ofs >= c->min)
+            return ofs;
+    }
+}
+
+static int chunker_find_ofs(const chunker *c, const unsigned char *buf,
+                            int len, int *bits)
+{
+    if (c->engine == CHUNKER_FASTCDC)
+        return fastcdc_find_ofs(c, buf, len, bits);
+    return bupsplit_find_min_ofs(c, buf, len, bits);
+}
+
+
+// Return the number of zero bytes at the start of buf.
+static Py_ssize_t zero_run(const unsigned char *buf, Py_ssize_t len)
+{
+    Py_ssize_t i = 0;
+    while (i < len && ((uintptr_t) (buf + i) & (sizeof(size_t) - 1)))
+        if (buf[i++])
+            return i - 1;
+    while (i + (Py_ssize_t) sizeof(size_t) <= len
+           && !*(const size_t *) (buf + i))
+        i += sizeof(size_t);
+    while (i < len && !buf[i])
+        i++;
+    return i;
+}
+
+
+// Find every split in buf, as chunker_find_ofs() would find them one
+// at a time, and return them as an array of (size, bits) pairs,
+// setting *count to the number of pairs.  Any blob larger than c->max
+// is cut at c->max, with bits 0, and the search restarts there.
+// Trailing data with no split isn't included.  Returns NULL (with
+// *count 0) if there are no splits, and NULL with *nomem set if
+// allocation fails.  Doesn't touch any Python objects.
+//
+// The rollsum's initial state is a fixed point for zero bytes, so a
+// bupsplit search that starts in a run of zeros ends wherever a search
+// starting at the end of the run does.  Whenever at least a whole
+// c->max blob of zeros (and more than an average blob's worth) is
+// ahead, find that split once per run, with a zero scan standing in
+// for rolling through the zeros.
+static int *_find_splits(const chunker *c, const unsigned char *buf,
+                         Py_ssize_t len, Py_ssize_t *count, int *nomem)
+{
+    Py_ssize_t n = 0, max_n = 0, ofs = 0, zero_end = 0;
+    Py_ssize_t zero_min = c->max > c->min ? c->max : c->min;
+    int *splits = NULL, *tmp, tail = -1, tail_bits = -1;
+
+    if (zero_min < (1 << c->bits))
+        zero_min = 1 << c->bits;
+    *nomem = 0;
+    while (ofs < len)
+    {
+        int size, bits = -1;
+        if (c->engine == CHUNKER_BUPSPLIT && ofs >= zero_end)
+        {
+            zero_end = ofs + zero_run(buf + ofs, len - ofs);
+            tail = -1;
+        }
+        if (c->engine == CHUNKER_BUPSPLIT && zero_end - ofs >= zero_min)
+        {
+            if (tail < 0)
+                tail = bupsplit_find_ofs_for(buf + zero_end, len - zero_end,
+                                             c->bits, &tail_bits);
+            // With zero_end - ofs >= c->max, a hit is cut below anyway.
+            size = tail ? c->max + 1 : 0;
+            bits = tail_bits;
+        }
+        else
+            size = chunker_find_ofs(c, buf + ofs, len - ofs, &bits);
+        if (!size)
+            break;
+        if (size > c->max)
+        {
+            size = c->max;
+            bits = 0;
+        }
+        if (n == max_n)
+        {
+            // Roughly one split per 1 << c->bits bytes
+            max_n = max_n ? max_n * 2 : 2 * ((len >> c->bits) + 1);
+            tmp = realloc(splits, max_n * 2 * sizeof(int));
+            if (!tmp)
+            {
+                free(splits);
+                *nomem = 1;
+                *count = 0;
+                return NULL;
+            }
+            splits = tmp;
+        }
+        splits[2 * n] = size;
+        splits[2 * n + 1] = bits;
+        n++;
+        ofs += size;
+    }
+    *count = n;
+    return splits;
+}
+
+
+// Check the chunker settings parsed from a split function's arguments.
+// A negative c->min selects the engine's default: no minimum for
+// bupsplit, and a quarter of the average for fastcdc.
+static int check_chunker(chunker *c)
+{
+    if (c->max < 1)
+    {
+        PyErr_Format(PyExc_ValueError, "blob_max must be positive");
+        return 0;
+    }
+    if (c->engine != CHUNKER_BUPSPLIT && c->engine != CHUNKER_FASTCDC)
+    {
+        PyErr_Format(PyExc_ValueError, "unknown chunker %d", c->engine);
+        return 0;
+    }
+    if (c->bits < BUP_WINDOWBITS || c->bits > 30)
+    {
+        PyErr_Format(PyExc_ValueError, "blob bits must be between %d and 30",
+                     BUP_WINDOWBITS);
+        return 0;
+    }
+    if (c->min < 0)
+        c->min = c->engine == CHUNKER_FASTCDC ? (1 << c->bits) / 4 : 0;
+    return 1;
+}
+
+
+// Parse find_splits()'s (buf, blob_max[, engine[, bits[, blob_min]]])
+// arguments.
+static int parse_split_args(PyObject *args, unsigned char **buf,
+                            Py_ssize_t *len, chunker *c)
+{
+    c->engine = CHUNKER_BUPSPLIT;
+    c->bits = BUP_BLOBBITS;
+    c->min = -1;
+    if (!PyArg_ParseTuple(args, "t#i|iii", buf, len, &c->max,
+                          &c->engine, &c->bits, &c->min))
+	return 0;
+    assert(*len <= INT_MAX);
+    return check_chunker(c);
+}
+
+
+// Return every split in buf (see _find_splits()) in a string of
+// native int (size, bits) pairs.
+static PyObject *find_splits(PyObject *self, PyObject *args)
+{
+    unsigned char *buf = NULL;
+    Py_ssize_t len = 0, n = 0;
+    int nomem = 0;
+    int *splits = NULL;
+    chunker c;
+    PyObject *result;
+
+    if (!parse_split_args(args, &buf, &len, &c))
+	return NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    splits = _find_splits(&c, buf, len, &n, &nomem);
+    Py_END_ALLOW_THREADS
+
+    if (nomem)
+        return PyErr_NoMemory();
+    result = Py_BuildValue(buf_argf "#", splits ? (char *) splits : "",
+                           n * 2 * sizeof(int));
+    free(splits);
+    return result;
+}
+
+
+#ifdef BUP_HAVE_OPENSSL_SHA1
+
+// Each split_and_hash() result: native int size and bits, then the sha
+#define SPLIT_HASH_ENTRY_SIZE (2 * sizeof(int) + 20)
+
+// Set sha to the git blob id of the len bytes at buf.
+static int blob_sha(EVP_MD_CTX *ctx, const unsigned char *buf, int len,
+                    unsigned char *sha)
+{
+    char hdr[32];
+    int hdr_len = snprintf(hdr, sizeof(hdr), "blob %d", len) + 1;
+    return EVP_DigestInit_ex(ctx, EVP_sha1(), NULL)
+        && EVP_DigestUpdate(ctx, hdr, hdr_len)
+        && EVP_DigestUpdate(ctx, buf, len)
+        && EVP_DigestFinal_ex(ctx, sha, NULL);
+}
+
+
+// split_and_hash(buf, blob_max, engine, bits, blob_min, zero_sha)
+//
+// Like find_splits(), but also compute each blob's git id with
+// OpenSSL's SHA-1 in the same pass without the GIL, returning a string
+// of (native int size, native int bits, 20-byte sha) records.  A
+// blob_max blob that's all zeros isn't hashed; it gets zero_sha, which
+// must be the id of blob_max zero bytes.
+static PyObject *split_and_hash(PyObject *self, PyObject *args)
+{
+    unsigned char *buf = NULL, *zero_sha = NULL, *out = NULL;
+    Py_ssize_t len = 0, zero_sha_len = 0, n = 0, ofs = 0, i;
+    int nomem = 0, ok = 1;
+    int *splits = NULL;
+    chunker c;
+    EVP_MD_CTX *ctx;
+    PyObject *result;
+
+    if (!PyArg_ParseTuple(args, "t#iiiit#", &buf, &len, &c.max,
+                          &c.engine, &c.bits, &c.min,
+                          &zero_sha, &zero_sha_len))
+	return NULL;
+    assert(len <= INT_MAX);
+    if (!check_chunker(&c))
+        return NULL;
+    if (zero_sha_len != 20)
+    {
+        PyErr_Format(PyExc_ValueError, "zero_sha must be 20 bytes");
+        return NULL;
+    }
+    ctx = EVP_MD_CTX_new();
+    if (!ctx)
+        return PyErr_NoMemory();
+
+    Py_BEGIN_ALLOW_THREADS
+    splits = _find_splits(&c, buf, len, &n, &nomem);
+    if (n)
+    {
+        out = malloc(n * SPLIT_HASH_ENTRY_SIZE);
+        if (!out)
+            nomem = 1;
+    }
+    for (i = 0; out && ok && i < n; i++)
+    {
+        const int size = splits[2 * i];
+        unsigned char *rec = out + i * SPLIT_HASH_ENTRY_SIZE;
+        memcpy(rec, splits + 2 * i, 2 * sizeof(int));
+        if (size == c.max && zero_run(buf + ofs, size) == size)
+            memcpy(rec + 2 * sizeof(int), zero_sha, 20);
+        else
+            ok = blob_sha(ctx, buf + ofs, size, rec + 2 * sizeof(int));
+        ofs += size;
+    }
+    Py_END_ALLOW_THREADS
+
+    EVP_MD_CTX_free(ctx);
+    free(splits);
+    if (nomem)
+        return PyErr_NoMemory();
+    if (!ok)
+    {
+        free(out);
+        PyErr_Format(PyExc_RuntimeError, "unable to compute SHA-1");
+        return NULL;
+    }
+    result = Py_BuildValue(buf_argf "#", out ? (char *) out : "",
+                           n * SPLIT_HASH_ENTRY_SIZE);
+    free(out);
+    return result;
+}
+
+#endif // def BUP_HAVE_OPENSSL_SHA1
+
+
 static PyObject *bitmatch(PyObject *self, PyObject *args)
 {
     unsigned char *buf1 = NULL, *buf2 = NULL;
@@ -889,11 +1253,22 @@ static PyObject *merge_into(PyObject *self, PyObject *args)
 
 #define FAN_ENTRIES 256
 
+// The in-flight idx entries handed to write_idx are packed records of
+// the object's sha, followed by its crc and pack offset in network
+// byte order.
+#define IDX_ENTRY_SIZE (sizeof(struct sha) + 4 + 8)
+
+static int _cmp_idx_entry(const void *a, const void *b)
+{
+    // The same order as sorting (sha, crc, ofs) tuples
+    return memcmp(a, b, IDX_ENTRY_SIZE);
+}
+
 static PyObject *write_idx(PyObject *self, PyObject *args)
 {
     char *filename = NULL;
-    PyObject *py_total, *idx = NULL;
-    PyObject *part;
+    PyObject *py_total;
+    Py_buffer idx;
     unsigned char *fmap = NULL;
     Py_ssize_t flen = 0;
     unsigned int total = 0;
@@ -902,19 +1277,43 @@ static PyObject *write_idx(PyObject *self, PyObject *args)
     uint32_t *fan_ptr, *crc_ptr, *ofs_ptr;
     uint64_t *ofs64_ptr;
     struct sha *sha_ptr;
+    const unsigned char *ent;
 
-    if (!PyArg_ParseTuple(args, "sw#OO",
+    if (!PyArg_ParseTuple(args, "sw#w*O",
                           &filename, &fmap, &flen, &idx, &py_total))
 	return NULL;
 
     if (!bup_uint_from_py(&total, py_total, "total"))
-        return NULL;
+        goto clean_and_fail;
 
-    if (PyList_Size (idx) != FAN_ENTRIES) // Check for list of the right length.
-        return PyErr_Format (PyExc_TypeError, "idx must contain %d entries",
-                             FAN_ENTRIES);
+    if (idx.len != (Py_ssize_t) total * IDX_ENTRY_SIZE)
+    {
+        PyErr_Format(PyExc_ValueError,
+                     "idx must contain %u entries of %d bytes",
+                     total, (int) IDX_ENTRY_SIZE);
+        goto clean_and_fail;
+    }
 
     const char idx_header[] = "\377tOc\0\0\0\002";
+    ofs64_count = 0;
+    ent = idx.buf;
+    for (count = 0; count < total; count++, ent += IDX_ENTRY_SIZE)
+    {
+        const unsigned char *ofs = ent + sizeof(struct sha) + 4;
+        if (ofs[0] || ofs[1] || ofs[2] || ofs[3] || ofs[4] & 0x80)
+            ofs64_count++;
+    }
+    if (flen < (Py_ssize_t) (sizeof(idx_header) - 1 + 4 * FAN_ENTRIES
+                             + 28 * (Py_ssize_t) total + 8 * ofs64_count))
+    {
+        PyErr_Format(PyExc_ValueError, "idx map is too small for %u entries",
+                     total);
+        goto clean_and_fail;
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    qsort(idx.buf, total, IDX_ENTRY_SIZE, _cmp_idx_entry);
+
     memcpy (fmap, idx_header, sizeof(idx_header) - 1);
 
     fan_ptr = (uint32_t *)&fmap[sizeof(idx_header) - 1];
@@ -925,50 +1324,40 @@ static PyObject *write_idx(PyObject *self, PyObject *args)
 
     count = 0;
     ofs64_count = 0;
+    ent = idx.buf;
     for (i = 0; i < FAN_ENTRIES; ++i)
     {
-	int plen;
-	part = PyList_GET_ITEM(idx, i);
-	PyList_Sort(part);
-	plen = PyList_GET_SIZE(part);
-	count += plen;
-	*fan_ptr++ = htonl(count);
-	for (j = 0; j < plen; ++j)
+	while (count < total && ent[0] == i)
 	{
-	    unsigned char *sha = NULL;
-	    Py_ssize_t sha_len = 0;
-            PyObject *crc_py, *ofs_py;
-	    unsigned int crc;
-            unsigned PY_LONG_LONG ofs_ull;
-	    uint64_t ofs;
-	    if (!PyArg_ParseTuple(PyList_GET_ITEM(part, j), "t#OO",
-				  &sha, &sha_len, &crc_py, &ofs_py))
-		return NULL;
-            if(!bup_uint_from_py(&crc, crc_py, "crc"))
-                return NULL;
-            if(!bup_ullong_from_py(&ofs_ull, ofs_py, "ofs"))
-                return NULL;
-            assert(crc <= UINT32_MAX);
-            assert(ofs_ull <= UINT64_MAX);
-	    ofs = ofs_ull;
-	    if (sha_len != sizeof(struct sha))
-		return NULL;
-	    memcpy(sha_ptr++, sha, sizeof(struct sha));
-	    *crc_ptr++ = htonl(crc);
+	    uint64_t ofs = 0;
+	    memcpy(sha_ptr++, ent, sizeof(struct sha));
+	    memcpy(crc_ptr++, ent + sizeof(struct sha), 4);
+	    for (j = 0; j < 8; j++)
+		ofs = (ofs << 8) | ent[sizeof(struct sha) + 4 + j];
 	    if (ofs > 0x7fffffff)
 	    {
                 *ofs64_ptr++ = htonll(ofs);
 		ofs = 0x80000000 | ofs64_count++;
 	    }
 	    *ofs_ptr++ = htonl((uint32_t)ofs);
+	    ent += IDX_ENTRY_SIZE;
+	    count++;
 	}
+	*fan_ptr++ = htonl(count);
     }
+    Py_END_ALLOW_THREADS
+    assert(count == total);
+    PyBuffer_Release(&idx);
 
     int rc = msync(fmap, flen, MS_ASYNC);
     if (rc != 0)
 	return PyErr_SetFromErrnoWithFilename(PyExc_IOError, filename);
 
     return PyLong_FromUnsignedLong(count);
+
+ clean_and_fail:
+    PyBuffer_Release(&idx);
+    return NULL;
 }
 
 
@@ -1107,6 +1496,26 @@ static PyObject *fadvise_done(PyObject *self, PyObject *args)
 }
 
 
+static PyObject *fadvise_willneed(PyObject *self, PyObject *args)
+{
+    int fd = -1;
+    long long llofs, lllen = 0;
+    if (!PyArg_ParseTuple(args, "iLL", &fd, &llofs, &lllen))
+	return NULL;
+    off_t ofs, len;
+    if (!INTEGRAL_ASSIGNMENT_FITS(&ofs, llofs))
+        return PyErr_Format(PyExc_OverflowError,
+                            "fadvise offset overflows off_t");
+    if (!INTEGRAL_ASSIGNMENT_FITS(&len, lllen))
+        return PyErr_Format(PyExc_OverflowError,
+                            "fadvise length overflows off_t");
+#ifdef POSIX_FADV_WILLNEED
+    posix_fadvise(fd, ofs, len, POSIX_FADV_WILLNEED);
+#endif
+    return Py_BuildValue("");
+}
+
+
 // Currently the Linux kernel and FUSE disagree over the type for
 // FS_IOC_GETFLAGS and FS_IOC_SETFLAGS.  The kernel actually uses int,
 // but FUSE chose long (matching the declaration in linux/fs.h).  So
@@ -1415,7 +1824,9 @@ static PyObject *bup_stat(PyObject *self, PyObject *args)
         return NULL;
 
     struct stat st;
+    Py_BEGIN_ALLOW_THREADS
     rc = stat(filename, &st);
+    Py_END_ALLOW_THREADS
     if (rc != 0)
         return PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
     return stat_struct_to_py(&st, filename, 0);
@@ -1431,7 +1842,9 @@ static PyObject *bup_lstat(PyObject *self, PyObject *args)
         return NULL;
 
     struct stat st;
+    Py_BEGIN_ALLOW_THREADS
     rc = lstat(filename, &st);
+    Py_END_ALLOW_THREADS
     if (rc != 0)
         return PyErr_SetFromErrnoWithFilename(PyExc_OSError, filename);
     return stat_struct_to_py(&st, filename, 0);
@@ -1446,13 +1859,283 @@ static PyObject *bup_fstat(PyObject *self, PyObject *args)
         return NULL;
 
     struct stat st;
+    Py_BEGIN_ALLOW_THREADS
     rc = fstat(fd, &st);
+    Py_END_ALLOW_THREADS
     if (rc != 0)
         return PyErr_SetFromErrno(PyExc_OSError);
     return stat_struct_to_py(&st, NULL, fd);
 }
 
 
+#if defined(HAVE_OPENAT) && defined(HAVE_FSTATAT) && defined(HAVE_FDOPENDIR)
+
+static PyObject *bup_openat(PyObject *self, PyObject *args)
+{
+    int dirfd, flags, fd;
+    char *path;
+
+    if (!PyArg_ParseTuple(args, "isi", &dirfd, &path, &flags))
+        return NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    fd = openat(dirfd, path, flags);
+    Py_END_ALLOW_THREADS
+    if (fd < 0)
+        return PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+    return PyInt_FromLong(fd);
+}
+
+
+struct dirlist_ent
+{
+    char *name;  // with a trailing '/' for directories
+    size_t len;
+    int err;  // fstatat() errno, or 0
+    struct stat st;
+};
+
+static int dirlist_ent_cmp_reverse(const void *x, const void *y)
+{
+    const struct dirlist_ent *a = x, *b = y;
+    const size_t n = a->len < b->len ? a->len : b->len;
+    int c = memcmp(a->name, b->name, n);
+    if (!c)
+        c = (a->len > b->len) - (a->len < b->len);
+    return -c;
+}
+
+static void free_dirlist_ents(struct dirlist_ent *ents, size_t n)
+{
+    size_t i;
+    for (i = 0; i < n; i++)
+        free(ents[i].name);
+    free(ents);
+}
+
+static int add_dirlist_ent(struct dirlist_ent **ents, size_t *n, size_t *size,
+                           const char *name, size_t len)
+{
+    if (*n == *size)
+    {
+        size_t new_size = *size ? *size * 2 : 64;
+        struct dirlist_ent *tmp = realloc(*ents, new_size * sizeof(**ents));
+        if (!tmp)
+            return -1;
+        *ents = tmp;
+        *size = new_size;
+    }
+    struct dirlist_ent *e = &(*ents)[*n];
+    e->name = malloc(len + 2);
+    if (!e->name)
+        return -1;
+    memcpy(e->name, name, len);
+    e->name[len] = '\0';
+    e->len = len;
+    e->err = 0;
+    (*n)++;
+    return 0;
+}
+
+// Add the names of all the entries of the directory open as fd.
+// Returns -1 (with errno set) on failure.
+static int read_dirlist(int fd, struct dirlist_ent **ents, size_t *n,
+                        size_t *size)
+{
+    DIR *dir;
+    struct dirent *d;
+    int dfd, err = 0;
+
+    // fdopendir() takes over the descriptor, so give it a copy; the
+    // copy shares fd's position, hence the rewind.
+    dfd = dup(fd);
+    if (dfd < 0)
+        return -1;
+    dir = fdopendir(dfd);
+    if (!dir)
+    {
+        err = errno;
+        close(dfd);
+        errno = err;
+        return -1;
+    }
+    rewinddir(dir);
+    while (1)
+    {
+        errno = 0;
+        d = readdir(dir);
+        if (!d)
+        {
+            err = errno;
+            break;
+        }
+        if (strcmp(d->d_name, ".") == 0 || strcmp(d->d_name, "..") == 0)
+            continue;
+        if (add_dirlist_ent(ents, n, size, d->d_name, strlen(d->d_name)) != 0)
+        {
+            err = ENOMEM;
+            break;
+        }
+    }
+    closedir(dir);
+    if (err)
+    {
+        errno = err;
+        return -1;
+    }
+    return 0;
+}
+
+// lstat the entries relative to fd, mark the directories, and sort
+// the result in reverse.
+static void stat_dirlist(int fd, struct dirlist_ent *ents, size_t n)
+{
+    size_t i;
+    for (i = 0; i < n; i++)
+    {
+        struct dirlist_ent *e = &ents[i];
+        if (fstatat(fd, e->name, &e->st, AT_SYMLINK_NOFOLLOW) != 0)
+            e->err = errno;
+        else if (S_ISDIR(e->st.st_mode))
+        {
+            e->name[e->len++] = '/';
+            e->name[e->len] = '\0';
+        }
+    }
+    qsort(ents, n, sizeof(*ents), dirlist_ent_cmp_reverse);
+}
+
+static PyObject *bup_dirlist(PyObject *self, PyObject *args)
+{
+    int fd, rc = 0;
+    struct dirlist_ent *ents = NULL;
+    size_t n = 0, size = 0, i;
+    PyObject *names_py = Py_None, *entries = NULL, *errors = NULL;
+
+    if (!PyArg_ParseTuple(args, "i|O", &fd, &names_py))
+        return NULL;
+
+    if (names_py == Py_None)
+    {
+        Py_BEGIN_ALLOW_THREADS
+        rc = read_dirlist(fd, &ents, &n, &size);
+        Py_END_ALLOW_THREADS
+        if (rc != 0)
+        {
+            int err = errno;
+            free_dirlist_ents(ents, n);
+            errno = err;
+            return PyErr_SetFromErrno(PyExc_OSError);
+        }
+    }
+    else
+    {
+        PyObject *seq = PySequence_Fast(names_py, "names must be a sequence");
+        if (!seq)
+            return NULL;
+        const Py_ssize_t count = PySequence_Fast_GET_SIZE(seq);
+        Py_ssize_t j;
+        for (j = 0; j < count; j++)
+        {
+            char *name;
+            Py_ssize_t len;
+            if (PyString_AsStringAndSize(PySequence_Fast_GET_ITEM(seq, j),
+                                         &name, &len) != 0)
+            {
+                Py_DECREF(seq);
+                free_dirlist_ents(ents, n);
+                return NULL;
+            }
+            if (add_dirlist_ent(&ents, &n, &size, name, len) != 0)
+            {
+                Py_DECREF(seq);
+                free_dirlist_ents(ents, n);
+                return PyErr_NoMemory();
+            }
+        }
+        Py_DECREF(seq);
+    }
+
+    Py_BEGIN_ALLOW_THREADS
+    stat_dirlist(fd, ents, n);
+    Py_END_ALLOW_THREADS
+
+    entries = PyList_New(0);
+    if (!entries)
+        goto fail;
+    errors = PyList_New(0);
+    if (!errors)
+        goto fail;
+    for (i = 0; i < n; i++)
+    {
+        PyObject *item;
+        if (ents[i].err)
+            item = Py_BuildValue("(s#i)", ents[i].name, (Py_ssize_t) ents[i].len,
+                                 ents[i].err);
+        else
+        {
+            PyObject *st = stat_struct_to_py(&ents[i].st, ents[i].name, fd);
+            if (!st)
+                goto fail;
+            item = Py_BuildValue("(s#N)", ents[i].name, (Py_ssize_t) ents[i].len,
+                                 st);
+        }
+        if (!item)
+            goto fail;
+        rc = PyList_Append(ents[i].err ? errors : entries, item);
+        Py_DECREF(item);
+        if (rc != 0)
+            goto fail;
+    }
+    free_dirlist_ents(ents, n);
+    return Py_BuildValue("(NN)", entries, errors);
+
+ fail:
+    free_dirlist_ents(ents, n);
+    Py_XDECREF(entries);
+    Py_XDECREF(errors);
+    return NULL;
+}
+
+#endif /* defined(HAVE_OPENAT) && defined(HAVE_FSTATAT) && defined(HAVE_FDOPENDIR) */
+
+
+#ifdef HAVE_SYS_INOTIFY_H
+
+static PyObject *bup_inotify_init(PyObject *self, PyObject *args)
+{
+    int fd;
+
+    if (!PyArg_ParseTuple(args, ""))
+        return NULL;
+
+    fd = inotify_init();
+    if (fd < 0)
+        return PyErr_SetFromErrno(PyExc_OSError);
+    return PyInt_FromLong(fd);
+}
+
+
+static PyObject *bup_inotify_add_watch(PyObject *self, PyObject *args)
+{
+    int fd, wd;
+    unsigned int mask;
+    char *path;
+
+    if (!PyArg_ParseTuple(args, "isI", &fd, &path, &mask))
+        return NULL;
+
+    Py_BEGIN_ALLOW_THREADS
+    wd = inotify_add_watch(fd, path, mask);
+    Py_END_ALLOW_THREADS
+    if (wd < 0)
+        return PyErr_SetFromErrnoWithFilename(PyExc_OSError, path);
+    return PyInt_FromLong(wd);
+}
+
+#endif /* def HAVE_SYS_INOTIFY_H */
+
+
 #ifdef HAVE_TM_TM_GMTOFF
 static PyObject *bup_localtime(PyObject *self, PyObject *args)
 {
@@ -1538,6 +2221,8 @@ static PyObject *bup_mincore(PyObject *self, PyObject *args)
 #endif /* def BUP_MINCORE_BUF_TYPE */
 
 
+
+
 static PyMethodDef helper_methods[] = {
     { "write_sparsely", bup_write_sparsely, METH_VARARGS,
       "Write buf excepting zeros at the end. Return trailing zero count." },
@@ -1547,6 +2232,13 @@ static PyMethodDef helper_methods[] = {
 	"Return the number of bits in the rolling checksum." },
     { "splitbuf", splitbuf, METH_VARARGS,
 	"Split a list of strings based on a rolling checksum." },
+    { "find_splits", find_splits, METH_VARARGS,
+	"Return all of the content-defined splits in a buffer." },
+#ifdef BUP_HAVE_OPENSSL_SHA1
+    { "split_and_hash", split_and_hash, METH_VARARGS,
+	"Return all of the content-defined splits in a buffer,"
+	" with their blob ids." },
+#endif
     { "bitmatch", bitmatch, METH_VARARGS,
 	"Count the number of matching prefix bits between two strings." },
     { "firstword", firstword, METH_VARARGS,
@@ -1560,7 +2252,7 @@ static PyMethodDef helper_methods[] = {
     { "merge_into", merge_into, METH_VARARGS,
 	"Merges a bunch of idx and midx files into a single midx." },
     { "write_idx", write_idx, METH_VARARGS,
-	"Write a PackIdxV2 file from an idx list of lists of tuples" },
+	"Write a PackIdxV2 file from a buffer of packed idx entries" },
     { "write_random", write_random, METH_VARARGS,
 	"Write random bytes to the given file descriptor" },
     { "random_sha", random_sha, METH_VARARGS,
@@ -1569,6 +2261,8 @@ static PyMethodDef helper_methods[] = {
 	"open() the given filename for read with O_NOATIME if possible" },
     { "fadvise_done", fadvise_done, METH_VARARGS,
 	"Inform the kernel that we're finished with earlier parts of a file" },
+    { "fadvise_willneed", fadvise_willneed, METH_VARARGS,
+	"Ask the kernel to start reading part of a file into the cache" },
 #ifdef BUP_HAVE_FILE_ATTRS
     { "get_linux_file_attr", bup_get_linux_file_attr, METH_VARARGS,
       "Return the Linux attributes for the given file." },
@@ -1596,6 +2290,21 @@ static PyMethodDef helper_methods[] = {
       "Extended version of lstat." },
     { "fstat", bup_fstat, METH_VARARGS,
       "Extended version of fstat." },
+#if defined(HAVE_OPENAT) && defined(HAVE_FSTATAT) && defined(HAVE_FDOPENDIR)
+    { "openat", bup_openat, METH_VARARGS,
+      "openat(dirfd, path, flags) -> fd" },
+    { "dirlist", bup_dirlist, METH_VARARGS,
+      "dirlist(fd, names=None) -> (entries, errors): list the directory\n"
+      "open as fd (or just the given names in it), returning a reverse\n"
+      "sorted list of (name, lstat) pairs (names of directories end with\n"
+      "'/'), and (name, errno) for the entries that could not be lstat()ed." },
+#endif
+#ifdef HAVE_SYS_INOTIFY_H
+    { "inotify_init", bup_inotify_init, METH_VARARGS,
+      "inotify_init() -> fd" },
+    { "inotify_add_watch", bup_inotify_add_watch, METH_VARARGS,
+      "inotify_add_watch(fd, path, mask) -> wd" },
+#endif
 #ifdef HAVE_TM_TM_GMTOFF
     { "localtime", bup_localtime, METH_VARARGS,
       "Return struct_time elements plus the timezone offset and name." },
@@ -1645,6 +2354,12 @@ static int setup_module(PyObject *m)
         value = INTEGER_TO_PY(UINT_MAX);
         PyObject_SetAttrString(m, "UINT_MAX", value);
         Py_DECREF(value);
+        value = INTEGER_TO_PY(CHUNKER_BUPSPLIT);
+        PyObject_SetAttrString(m, "CHUNKER_BUPSPLIT", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(CHUNKER_FASTCDC);
+        PyObject_SetAttrString(m, "CHUNKER_FASTCDC", value);
+        Py_DECREF(value);
     }
 #ifdef HAVE_UTIMENSAT
     {
@@ -1668,8 +2383,54 @@ static int setup_module(PyObject *m)
         Py_DECREF(value);
     }
 #endif
+#ifdef HAVE_SYS_INOTIFY_H
+    {
+        PyObject *value;
+        value = INTEGER_TO_PY(IN_MODIFY);
+        PyObject_SetAttrString(m, "IN_MODIFY", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(IN_ATTRIB);
+        PyObject_SetAttrString(m, "IN_ATTRIB", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(IN_CLOSE_WRITE);
+        PyObject_SetAttrString(m, "IN_CLOSE_WRITE", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(IN_MOVED_FROM);
+        PyObject_SetAttrString(m, "IN_MOVED_FROM", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(IN_MOVED_TO);
+        PyObject_SetAttrString(m, "IN_MOVED_TO", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(IN_CREATE);
+        PyObject_SetAttrString(m, "IN_CREATE", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(IN_DELETE);
+        PyObject_SetAttrString(m, "IN_DELETE", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(IN_UNMOUNT);
+        PyObject_SetAttrString(m, "IN_UNMOUNT", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(IN_Q_OVERFLOW);
+        PyObject_SetAttrString(m, "IN_Q_OVERFLOW", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(IN_IGNORED);
+        PyObject_SetAttrString(m, "IN_IGNORED", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(IN_ONLYDIR);
+        PyObject_SetAttrString(m, "IN_ONLYDIR", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(IN_DONT_FOLLOW);
+        PyObject_SetAttrString(m, "IN_DONT_FOLLOW", value);
+        Py_DECREF(value);
+        value = INTEGER_TO_PY(IN_ISDIR);
+        PyObject_SetAttrString(m, "IN_ISDIR", value);
+        Py_DECREF(value);
+    }
+#endif
 #pragma clang diagnostic pop  // ignored "-Wtautological-compare"
 
+    gear_table_init();
+
     e = getenv("BUP_FORCE_TTY");
     get_state(m)->istty2 = isatty(2) || (atoi(e ? e : "0") & 2);
     unpythonize_argv();
@@ -40,6 +40,8 @@ extern "C" {
 #endif
     
 int bupsplit_find_ofs(const unsigned char *buf, int len, int *bits);
+int bupsplit_find_ofs_for(const unsigned char *buf, int len, int blobbits,
+			  int *bits);
 int bupsplit_selftest(void);
 
 #ifdef __cplusplus
@@ -277,7 +277,8 @@ class Client:
         return idx
 
     def new_packwriter(self, compression_level=1,
-                       max_pack_size=None, max_pack_objects=None):
+                       max_pack_size=None, max_pack_objects=None,
+                       threads=None):
         self._require_command('receive-objects-v2')
         self.check_busy()
         def _set_busy():
@@ -291,7 +292,8 @@ class Client:
                                  ensure_busy = self.ensure_busy,
                                  compression_level=compression_level,
                                  max_pack_size=max_pack_size,
-                                 max_pack_objects=max_pack_objects)
+                                 max_pack_objects=max_pack_objects,
+                                 threads=threads)
 
     def read_ref(self, refname):
         self._require_command('read-ref')
@@ -305,6 +307,19 @@ class Client:
         else:
             return None   # nonexistent ref
 
+    def config_get(self, name):
+        """Return the value of the remote repository's git config
+        option name, as git.git_config_get() would, or None if it's not
+        set, or the server is too old to say."""
+        if 'config-get' not in self._available_commands:
+            return None
+        assert not re.search(r'\s', name)
+        self.check_busy()
+        self.conn.write('config-get %s\n' % name)
+        r = self.conn.readline().strip()
+        self.check_ok()
+        return r.decode('hex') if r else None
+
     def update_ref(self, refname, newval, oldval):
         self._require_command('update-ref')
         self.check_busy()
@@ -363,6 +378,41 @@ class Client:
             raise not_ok
         self._not_busy()
 
+    def cat_batch_check(self, refs):
+        """Yield (oidx, type, size) for each ref in refs, or (None, None,
+        None) if it does not exist.  Servers too old to answer without
+        the data are asked for it (via cat-batch), and it's discarded."""
+        if 'cat-batch-check' not in self._available_commands:
+            for oidx, oid_t, size, it in self.cat_batch(refs):
+                for ignored in it or ():
+                    pass
+                yield oidx, oid_t, size
+            return
+        self.check_busy()
+        self._busy = 'cat-batch-check'
+        conn = self.conn
+        conn.write('cat-batch-check\n')
+        for ref in refs:
+            assert ref
+            assert '\n' not in ref
+            conn.write(ref)
+            conn.write('\n')
+        conn.write('\n')
+        for ref in refs:
+            info = conn.readline()
+            if info == 'missing\n':
+                yield None, None, None
+                continue
+            if not (info and info.endswith('\n')):
+                raise ClientError('Hit EOF while looking for object info: %r'
+                                  % info)
+            oidx, oid_t, size = info.split(' ')
+            yield oidx, oid_t, int(size)
+        not_ok = self.check_ok()
+        if not_ok:
+            raise not_ok
+        self._not_busy()
+
     def refs(self, patterns=None, limit_to_heads=False, limit_to_tags=False):
         patterns = patterns or tuple()
         self._require_command('refs')
@@ -442,12 +492,14 @@ class PackWriter_Remote(git.PackWriter):
                  ensure_busy,
                  compression_level=1,
                  max_pack_size=None,
-                 max_pack_objects=None):
+                 max_pack_objects=None,
+                 threads=None):
         git.PackWriter.__init__(self,
                                 objcache_maker=objcache_maker,
                                 compression_level=compression_level,
                                 max_pack_size=max_pack_size,
-                                max_pack_objects=max_pack_objects)
+                                max_pack_objects=max_pack_objects,
+                                threads=threads)
         self.file = conn
         self.filename = 'remote socket'
         self.suggest_packs = suggest_packs
@@ -463,7 +515,7 @@ class PackWriter_Remote(git.PackWriter):
             self.onopen()
             self._packopen = True
 
-    def _end(self, run_midx=True):
+    def _end(self, run_midx=True, wait=True):
         assert(run_midx)  # We don't support this via remote yet
         if self._packopen and self.file:
             self.file.write('\0\0\0\0')
@@ -473,7 +525,11 @@ class PackWriter_Remote(git.PackWriter):
             return self.suggest_packs() # Returns last idx received
 
     def close(self):
-        id = self._end()
+        try:
+            self._write_pending()
+            id = self._end()
+        finally:
+            self._stop_workers()
         self.file = None
         return id
 
@@ -2,10 +2,13 @@
 from __future__ import absolute_import
 
 from distutils.core import setup, Extension
+import os
 
 _helpers_mod = Extension('_helpers',
                          sources=['_helpers.c', 'bupsplit.c'],
-                         depends=['../../config/config.h'])
+                         depends=['../../config/config.h'],
+                         libraries=os.environ.get('BUP_HELPERS_LIBS',
+                                                  '').split())
 
 setup(name='_helpers',
       version='0.1',
@@ -1,7 +1,8 @@
 
 from __future__ import absolute_import
-import stat, os
+import Queue, stat, os, threading
 
+from bup import _helpers
 from bup.helpers import add_error, should_rx_exclude_path, debug1, resolve_parent
 import bup.xstat as xstat
 
@@ -16,13 +17,18 @@ except AttributeError:
     O_NOFOLLOW = 0
 
 
-# the use of fchdir() and lstat() is for two reasons:
+# the use of fchdir() (or openat()) and lstat() is for two reasons:
 #  - help out the kernel by not making it repeatedly look up the absolute path
 #  - avoid race conditions caused by doing listdir() on a changing symlink
+_open_flags = os.O_RDONLY|O_LARGEFILE|O_NOFOLLOW|os.O_NDELAY
+
 class OsFile:
-    def __init__(self, path):
+    def __init__(self, path, dirfd=None):
         self.fd = None
-        self.fd = os.open(path, os.O_RDONLY|O_LARGEFILE|O_NOFOLLOW|os.O_NDELAY)
+        if dirfd is None:
+            self.fd = os.open(path, _open_flags)
+        else:
+            self.fd = _openat(dirfd, path, _open_flags)
         
     def __del__(self):
         if self.fd:
@@ -38,9 +44,9 @@ class OsFile:
 
 
 _IFMT = stat.S_IFMT(0xffffffff)  # avoid function call in inner loop
-def _dirlist():
+def _dirlist(names=None):
     l = []
-    for n in os.listdir('.'):
+    for n in (os.listdir('.') if names is None else names):
         try:
             st = xstat.lstat(n)
         except OSError as e:
@@ -53,11 +59,25 @@ def _dirlist():
     return l
 
 
-def _recursive_dirlist(prepend, xdev, bup_dir=None,
-                       excluded_paths=None,
-                       exclude_rxs=None,
-                       xdev_exceptions=frozenset()):
-    for (name,pst) in _dirlist():
+_openat = getattr(_helpers, 'openat', None)
+_fd_dirlist = getattr(_helpers, 'dirlist', None)
+
+def _dirlist_at(fd, prepend, names=None, error=add_error):
+    # What _dirlist() returns, but for the directory open as fd, and
+    # with the listing, lstat()s and sorting all done in one call.
+    entries, errors = _fd_dirlist(fd, names)
+    for (n, err) in errors:
+        e = OSError(err, os.strerror(err), n)
+        error(Exception('%s: %s' % (prepend + n, e)))
+    from_xstat_rep = xstat.stat_result.from_xstat_rep
+    return [(n, from_xstat_rep(st)) for (n, st) in entries]
+
+
+def _filtered(l, prepend, xdev, bup_dir, excluded_paths, exclude_rxs,
+              xdev_exceptions):
+    # Yield (name, path, pst, recurse) for each listed entry that
+    # isn't excluded, where recurse indicates a directory to descend.
+    for (name,pst) in l:
         path = prepend + name
         if excluded_paths:
             if os.path.normpath(path) in excluded_paths:
@@ -65,6 +85,7 @@ def _recursive_dirlist(prepend, xdev, bup_dir=None,
                 continue
         if exclude_rxs and should_rx_exclude_path(path, exclude_rxs):
             continue
+        recurse = False
         if name.endswith('/'):
             if bup_dir != None:
                 if os.path.normpath(path) == bup_dir:
@@ -74,25 +95,221 @@ def _recursive_dirlist(prepend, xdev, bup_dir=None,
                and path not in xdev_exceptions:
                 debug1('Skipping contents of %r: different filesystem.\n' % path)
             else:
-                try:
-                    OsFile(name).fchdir()
-                except OSError as e:
-                    add_error('%s: %s' % (prepend, e))
-                else:
-                    for i in _recursive_dirlist(prepend=prepend+name, xdev=xdev,
-                                                bup_dir=bup_dir,
-                                                excluded_paths=excluded_paths,
-                                                exclude_rxs=exclude_rxs,
-                                                xdev_exceptions=xdev_exceptions):
-                        yield i
+                recurse = True
+        yield (name, path, pst, recurse)
+
+
+def _recursive_dirlist(prepend, xdev, bup_dir=None,
+                       excluded_paths=None,
+                       exclude_rxs=None,
+                       xdev_exceptions=frozenset(),
+                       dirfd=None,
+                       known_dirlist=None,
+                       names=None):
+    # Without a dirfd, list the current directory and fchdir() into
+    # the subdirectories, otherwise work relative to dirfd.  Given
+    # names, just lstat those instead of reading the directory.
+    if dirfd is None:
+        l = _dirlist(names)
+    else:
+        l = _dirlist_at(dirfd, prepend, names)
+    for (name, path, pst, recurse) in _filtered(l, prepend, xdev, bup_dir,
+                                                excluded_paths, exclude_rxs,
+                                                xdev_exceptions):
+        if recurse:
+            try:
+                # Without the trailing '/', so that O_NOFOLLOW applies
+                sub = OsFile(name[:-1], dirfd)
+                if dirfd is None:
+                    sub.fchdir()
+            except OSError as e:
+                add_error('%s: %s' % (prepend, e))
+            else:
+                subnames = known_dirlist and known_dirlist(path, pst)
+                for i in _recursive_dirlist(prepend=path, xdev=xdev,
+                                            bup_dir=bup_dir,
+                                            excluded_paths=excluded_paths,
+                                            exclude_rxs=exclude_rxs,
+                                            xdev_exceptions=xdev_exceptions,
+                                            dirfd=(None if dirfd is None
+                                                   else sub.fd),
+                                            known_dirlist=known_dirlist,
+                                            names=subnames):
+                    yield i
+                if dirfd is None:
                     os.chdir('..')
         yield (path, pst)
 
 
+class _Listing:
+    # The (reverse sorted) contents of one directory, as _dirlist()
+    # would produce them, filled in by a _DirLister thread.  When
+    # possible, the directory is opened relative to its parent
+    # _Listing's (still open) directory, like _recursive_dirlist()
+    # does, so that a path that's concurrently replaced (e.g. by a
+    # symlink) can't redirect the traversal.
+    def __init__(self, path, names=None, parent=None):
+        self.path = path
+        self.names = names
+        self.entries = None
+        self.errors = []
+        self.dir = None
+        self._parent = parent
+        self._done = threading.Event()
+
+    def _open(self):
+        parent, self._parent = self._parent, None
+        if _openat and parent and parent.dir:
+            # Without the trailing '/', so that O_NOFOLLOW applies
+            name = self.path[len(parent.path):-1]
+            return OsFile(name, parent.dir.fd)
+        return OsFile(self.path)
+
+    def run(self):
+        try:
+            f = self.dir = self._open()
+            if _fd_dirlist:
+                l = _dirlist_at(f.fd, self.path, self.names,
+                                self.errors.append)
+            else:
+                l = []
+                names = self.names
+                if names is None:
+                    names = os.listdir(self.path)
+                for n in names:
+                    try:
+                        st = xstat.lstat(self.path + n)
+                    except OSError as e:
+                        self.errors.append(Exception('%s: %s'
+                                                     % (self.path + n, e)))
+                        continue
+                    if (st.st_mode & _IFMT) == stat.S_IFDIR:
+                        n += '/'
+                    l.append((n, st))
+                l.sort(reverse=True)
+        except OSError as e:
+            self.errors.append('%s: %s' % (self.path, e))
+            l = []
+        if not any(n.endswith('/') for (n, st) in l):
+            self.close()  # no subdirectories to open
+        self.entries = l
+        self._done.set()
+
+    def result(self):
+        self._done.wait()
+        for e in self.errors:
+            add_error(e)
+        return self.entries
+
+    def close(self):
+        # Once the subdirectories have all been listed.
+        self.dir = None
+
+
+# How many directory listings the parallel walker may hold ahead of
+# the one it's currently returning.
+_max_dirs_ahead = 256
+
+class _DirLister:
+    def __init__(self, jobs, known_dirlist=None):
+        self._requests = Queue.Queue()
+        self._threads = []
+        self._known_dirlist = known_dirlist
+        self.ahead = 0
+        for i in xrange(jobs):
+            t = threading.Thread(target=self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _work(self):
+        while True:
+            listing = self._requests.get()
+            if listing is None:
+                return
+            listing.run()
+
+    def submit(self, path, st, parent=None):
+        names = self._known_dirlist and self._known_dirlist(path, st)
+        listing = _Listing(path, names, parent)
+        self._requests.put(listing)
+        return listing
+
+    def close(self):
+        for t in self._threads:
+            self._requests.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+
+def _parallel_recursive_dirlist(lister, listing, prepend, xdev, bup_dir=None,
+                                excluded_paths=None,
+                                exclude_rxs=None,
+                                xdev_exceptions=frozenset()):
+    # Produces exactly what _recursive_dirlist() would, but with each
+    # directory opened relative to its parent listing's, so the
+    # listing of the subdirectories can proceed in other threads while
+    # we return the earlier ones.
+    items = []
+    for (name, path, pst, recurse) in _filtered(listing.result(), prepend,
+                                                xdev, bup_dir, excluded_paths,
+                                                exclude_rxs, xdev_exceptions):
+        sub = None
+        if recurse:
+            sub = True
+            if lister.ahead < _max_dirs_ahead:
+                sub = lister.submit(path, pst, listing)
+                lister.ahead += 1
+        items.append((path, pst, sub))
+    for (path, pst, sub) in items:
+        if sub:
+            if sub is True:
+                sub = lister.submit(path, pst, listing)
+            else:
+                lister.ahead -= 1
+            for i in _parallel_recursive_dirlist(lister, sub, path, xdev=xdev,
+                                                 bup_dir=bup_dir,
+                                                 excluded_paths=excluded_paths,
+                                                 exclude_rxs=exclude_rxs,
+                                                 xdev_exceptions=xdev_exceptions):
+                yield i
+        yield (path, pst)
+    listing.close()
+
+
 def recursive_dirlist(paths, xdev, bup_dir=None,
                       excluded_paths=None,
                       exclude_rxs=None,
-                      xdev_exceptions=frozenset()):
+                      xdev_exceptions=frozenset(),
+                      jobs=1,
+                      known_dirlist=None):
+    """Yield (path, stat) for each of paths and everything beneath
+    them, children before their parents, in reverse sorted order.
+    With jobs > 1, list and lstat up to that many directories at
+    once.  If known_dirlist(path, stat) returns a list of names for a
+    directory, only those are lstat()ed instead of reading the
+    directory."""
+    if jobs > 1:
+        lister = _DirLister(jobs, known_dirlist)
+        try:
+            for i in _recursive_dirlist_from(paths, xdev, bup_dir,
+                                             excluded_paths, exclude_rxs,
+                                             xdev_exceptions, lister,
+                                             known_dirlist):
+                yield i
+        finally:
+            lister.close()
+        return
+    for i in _recursive_dirlist_from(paths, xdev, bup_dir,
+                                     excluded_paths, exclude_rxs,
+                                     xdev_exceptions, None, known_dirlist):
+        yield i
+
+
+def _recursive_dirlist_from(paths, xdev, bup_dir, excluded_paths,
+                            exclude_rxs, xdev_exceptions, lister,
+                            known_dirlist):
     startdir = OsFile('.')
     try:
         assert(type(paths) != type(''))
@@ -116,15 +333,38 @@ def recursive_dirlist(paths, xdev, bup_dir=None,
             else:
                 xdev = None
             if stat.S_ISDIR(pst.st_mode):
-                pfile.fchdir()
                 prepend = os.path.join(path, '')
-                for i in _recursive_dirlist(prepend=prepend, xdev=xdev,
-                                            bup_dir=bup_dir,
-                                            excluded_paths=excluded_paths,
-                                            exclude_rxs=exclude_rxs,
-                                            xdev_exceptions=xdev_exceptions):
-                    yield i
-                startdir.fchdir()
+                names = known_dirlist and known_dirlist(prepend, pst)
+                if lister:
+                    sub = _parallel_recursive_dirlist(
+                        lister, lister.submit(prepend, pst), prepend, xdev=xdev,
+                        bup_dir=bup_dir,
+                        excluded_paths=excluded_paths,
+                        exclude_rxs=exclude_rxs,
+                        xdev_exceptions=xdev_exceptions)
+                    for i in sub:
+                        yield i
+                elif _fd_dirlist:
+                    for i in _recursive_dirlist(prepend=prepend, xdev=xdev,
+                                                bup_dir=bup_dir,
+                                                excluded_paths=excluded_paths,
+                                                exclude_rxs=exclude_rxs,
+                                                xdev_exceptions=xdev_exceptions,
+                                                dirfd=pfile.fd,
+                                                known_dirlist=known_dirlist,
+                                                names=names):
+                        yield i
+                else:
+                    pfile.fchdir()
+                    for i in _recursive_dirlist(prepend=prepend, xdev=xdev,
+                                                bup_dir=bup_dir,
+                                                excluded_paths=excluded_paths,
+                                                exclude_rxs=exclude_rxs,
+                                                xdev_exceptions=xdev_exceptions,
+                                                known_dirlist=known_dirlist,
+                                                names=names):
+                        yield i
+                    startdir.fchdir()
             else:
                 prepend = path
             yield (prepend,pst)
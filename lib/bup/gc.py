@@ -145,10 +145,13 @@ def sweep(live_objects, existing_count, cat_pipe, threshold, compression,
             cat_pipe.restart()
         ns.stale_files = []
 
+    # Finish each pack before moving on, since remove_stale_files()
+    # assumes that everything written so far is safely in a pack.
     writer = git.PackWriter(objcache_maker=None,
                             compression_level=compression,
                             run_midx=False,
-                            on_pack_finish=remove_stale_files)
+                            on_pack_finish=remove_stale_files,
+                            finish_in_background=False)
 
     # FIXME: sanity check .idx names vs .pack names?
     collect_count = 0
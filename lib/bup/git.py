@@ -5,8 +5,9 @@ interact with the Git data structures.
 
 from __future__ import absolute_import
 import errno, os, sys, zlib, time, subprocess, struct, stat, re, tempfile, glob
-from collections import namedtuple
-from itertools import islice
+import Queue, threading
+from collections import deque, namedtuple
+from itertools import islice, izip
 from numbers import Integral
 
 from bup import _helpers, compat, hashsplit, path, midx, bloom, xstat
@@ -598,9 +599,41 @@ def idxmerge(idxlist, final_progress=True):
     return merge_iter(idxlist, 10024, pfunc, pfinal)
 
 
+# PackWriter.idx is a bytearray of these (sha, crc, ofs) records, in
+# pack order, which _helpers.write_idx() sorts and writes out.
+_idx_entry = struct.Struct('!20sIQ')
+
+
 def _make_objcache():
     return PackIdxList(repo('objects/pack'))
 
+
+class _PackJob:
+    """An object waiting to be encoded by a PackWriter worker thread."""
+    def __init__(self, sha, type, content):
+        self.sha = sha
+        self.type = type
+        self.content = content
+        self.encoded = self.exc_info = None
+        self.done = threading.Event()
+
+
+def _encode_pack_jobs(jobs, compression_level):
+    """Encode each _PackJob from the jobs queue until None arrives."""
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        try:
+            # zlib releases the GIL, so the workers deflate in parallel
+            job.encoded = tuple(_encode_packobj(job.type, job.content,
+                                                compression_level))
+        except:
+            job.exc_info = sys.exc_info()
+        job.content = None
+        job.done.set()
+
+
 # bup-gc assumes that it can disable all PackWriter activities
 # (bloom/midx/cache) via the constructor and close() arguments.
 
@@ -608,7 +641,19 @@ class PackWriter:
     """Writes Git objects inside a pack file."""
     def __init__(self, objcache_maker=_make_objcache, compression_level=1,
                  run_midx=True, on_pack_finish=None,
-                 max_pack_size=None, max_pack_objects=None):
+                 max_pack_size=None, max_pack_objects=None, threads=None,
+                 finish_in_background=True):
+        """If threads is set, deflate objects on that many worker
+        threads.  They're still written to the pack in the order
+        they were submitted.
+
+        When the pack size or object limit is reached, the full pack
+        is finished (checksummed, indexed, synced and renamed) on a
+        background thread while writing continues into a new pack,
+        unless finish_in_background is false.  on_pack_finish is
+        called from the writing thread once a pack has been finished.
+
+        """
         self.repo_dir = repo()
         self.file = None
         self.parentfd = None
@@ -630,9 +675,14 @@ class PackWriter:
                 # larger packs slow down pruning
                 max_pack_size = 1000 * 1000 * 1000
         self.max_pack_size = max_pack_size
-        # cache memory usage is about 83 bytes per object
+        # idx memory usage is 32 bytes per object
         self.max_pack_objects = max_pack_objects if max_pack_objects \
-                                else max(1, self.max_pack_size // 5000)
+                                else max(1, self.max_pack_size // 2000)
+        self.threads = threads
+        self._jobs = self._workers = None
+        self._pending = deque()
+        self.finish_in_background = finish_in_background
+        self._finisher = self._finished = None
 
     def __del__(self):
         self.close()
@@ -656,7 +706,7 @@ class PackWriter:
             assert(name.endswith('.pack'))
             self.filename = name[:-5]
             self.file.write('PACK\0\0\0\2\0\0\0\0')
-            self.idx = list(list() for i in xrange(256))
+            self.idx = bytearray()
 
     def _raw_write(self, datalist, sha):
         self._open()
@@ -680,24 +730,79 @@ class PackWriter:
 
     def _update_idx(self, sha, crc, size):
         assert(sha)
-        if self.idx:
-            self.idx[ord(sha[0])].append((sha, crc, self.file.tell() - size))
+        if self.idx is not None:
+            self.idx.extend(_idx_entry.pack(sha, crc,
+                                            self.file.tell() - size))
 
     def _write(self, sha, type, content):
         if verbose:
             log('>')
         if not sha:
             sha = calc_hash(type, content)
-        size, crc = self._raw_write(_encode_packobj(type, content,
-                                                    self.compression_level),
-                                    sha=sha)
+        if self.threads:
+            self._queue_write(sha, type, content)
+        else:
+            size, crc = self._raw_write(_encode_packobj(type, content,
+                                                        self.compression_level),
+                                        sha=sha)
+            self._end_if_full()
+        return sha
+
+    def _end_if_full(self):
+        if self._finisher and not self._finisher.is_alive():
+            self._reap_finisher()
         if self.outbytes >= self.max_pack_size \
            or self.count >= self.max_pack_objects:
-            self.breakpoint()
-        return sha
+            # Not breakpoint(), since that would also write everything
+            # still pending into this pack.
+            self._end(self.run_midx, wait=not self.finish_in_background)
+            self.outbytes = self.count = 0
+
+    def _start_workers(self):
+        self._jobs = Queue.Queue()
+        self._workers = [threading.Thread(target=_encode_pack_jobs,
+                                          args=(self._jobs,
+                                                self.compression_level))
+                         for i in xrange(self.threads)]
+        for t in self._workers:
+            t.daemon = True
+            t.start()
+
+    def _stop_workers(self):
+        if self._workers:
+            for t in self._workers:
+                self._jobs.put(None)
+            for t in self._workers:
+                t.join()
+        self._jobs = self._workers = None
+
+    def _queue_write(self, sha, type, content):
+        if not self._workers:
+            self._start_workers()
+        # The content may be a view of a buffer that the caller will
+        # reuse (cf. hashsplit.Buf), so the worker needs a copy.
+        job = _PackJob(sha, type, str(content))
+        self._pending.append(job)
+        self._jobs.put(job)
+        self._write_pending(limit=4 * self.threads)
+
+    def _write_pending(self, limit=0):
+        """Write any finished objects at the front of the queue, in
+        order, waiting for the rest until no more than limit remain.
+
+        """
+        pending = self._pending
+        while pending and (len(pending) > limit or pending[0].done.is_set()):
+            job = pending.popleft()
+            job.done.wait()
+            if job.exc_info:
+                raise job.exc_info[0], job.exc_info[1], job.exc_info[2]
+            self._raw_write(job.encoded, sha=job.sha)
+            self._end_if_full()
 
     def breakpoint(self):
         """Clear byte and object counts and return the last processed id."""
+        self._write_pending()
         id = self._end(self.run_midx)
         self.outbytes = self.count = 0
         return id
@@ -719,18 +824,22 @@ class PackWriter:
         sha exists()."""
         self._write(sha, type, content)
 
-    def maybe_write(self, type, content):
-        """Write an object to the pack file if not present and return its id."""
-        sha = calc_hash(type, content)
+    def maybe_write(self, type, content, sha=None):
+        """Write an object to the pack file if not present and return its id.
+        If sha is provided, it must be the object's id (e.g. as computed
+        by hashsplit), and it won't be recomputed."""
+        if sha is None:
+            sha = calc_hash(type, content)
         if not self.exists(sha):
             self.just_write(sha, type, content)
             self._require_objcache()
             self.objcache.add(sha)
         return sha
 
-    def new_blob(self, blob):
-        """Create a blob object in the pack with the supplied content."""
-        return self.maybe_write('blob', blob)
+    def new_blob(self, blob, sha=None):
+        """Create a blob object in the pack with the supplied content.
+        See maybe_write() regarding sha."""
+        return self.maybe_write('blob', blob, sha=sha)
 
     def new_tree(self, shalist):
         """Create a tree object in the pack."""
@@ -762,114 +871,173 @@ class PackWriter:
 
     def abort(self):
         """Remove the pack file from disk."""
+        self._pending.clear()
+        self._stop_workers()
         f = self.file
-        if f:
-            pfd = self.parentfd
-            self.file = None
-            self.parentfd = None
-            self.idx = None
-            try:
+        try:
+            if f:
+                pfd = self.parentfd
+                self.file = None
+                self.parentfd = None
+                self.idx = None
                 try:
-                    os.unlink(self.filename + '.pack')
+                    try:
+                        os.unlink(self.filename + '.pack')
+                    finally:
+                        f.close()
                 finally:
-                    f.close()
-            finally:
-                if pfd is not None:
-                    os.close(pfd)
+                    if pfd is not None:
+                        os.close(pfd)
+        finally:
+            # Any pack that's already being finished is left intact.
+            self._reap_finisher()
+
+    def _finish_in_background(self, *args):
+        try:
+            self._finished = self._finish_pack(*args), None
+        except:
+            self._finished = None, sys.exc_info()
+
+    def _reap_finisher(self):
+        """Wait for the pack being finished in the background, if any."""
+        if not self._finisher:
+            return
+        self._finisher.join()
+        self._finisher = None
+        nameprefix, exc_info = self._finished
+        self._finished = None
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        if self.objcache is not None:
+            # Reload the objcache to pick up the finished pack, and
+            # remember the objects already written to (or queued for)
+            # the current one.
+            self.objcache = None
+            if self.idx or self._pending:
+                self._require_objcache()
+                for i in xrange(0, len(self.idx or ''), _idx_entry.size):
+                    self.objcache.add(str(self.idx[i:i + 20]))
+                for job in self._pending:
+                    self.objcache.add(job.sha)
+        if self.on_pack_finish:
+            self.on_pack_finish(nameprefix)
 
-    def _end(self, run_midx=True):
+    def _end(self, run_midx=True, wait=True):
+        """Finish the current pack, if any, after waiting for any
+        earlier pack that's being finished in the background.  Return
+        the new pack's name prefix, or if wait is false, finish the
+        pack in the background and return None.
+
+        """
+        self._reap_finisher()
         f = self.file
         if not f: return None
         self.file = None
-        try:
-            self.objcache = None
-            idx = self.idx
-            self.idx = None
+        args = (f, self.parentfd, self.filename, self.idx, self.count,
+                run_midx)
+        self.parentfd = self.idx = None
+        if not wait:
+            # Keep the objcache, which still knows about the objects in
+            # this pack, until _reap_finisher() replaces it.
+            self._finisher = threading.Thread(target=self._finish_in_background,
+                                              args=args)
+            self._finisher.start()
+            return None
+        self.objcache = None
+        nameprefix = self._finish_pack(*args)
+        if self.on_pack_finish:
+            self.on_pack_finish(nameprefix)
+        return nameprefix
+
+    def _finish_pack(self, f, parentfd, filename, idx, count, run_midx):
+        """Finish writing the pack in f, whose temporary name (without
+        the extension) is filename, and move it and its idx into place.
+        This may be called from a background thread, so it mustn't
+        touch the writer's current pack state.
 
+        """
+        try:
             # update object count
             f.seek(8)
-            cp = struct.pack('!i', self.count)
+            cp = struct.pack('!i', count)
             assert(len(cp) == 4)
             f.write(cp)
 
             # calculate the pack sha1sum
-            f.seek(0)
-            sum = Sha1()
-            for b in chunkyreader(f):
-                sum.update(b)
-            packbin = sum.digest()
+            # The object count at the front of the pack isn't known
+            # until now, so (like git) we have to hash the data again,
+            # but do it in one pass over a map of the (likely still
+            # cached) file, rather than read() it back chunk by chunk.
+            f.flush()
+            pack_map = mmap_read(f, close=False)
+            try:
+                packbin = Sha1(pack_map).digest()
+            finally:
+                pack_map.close()
+            f.seek(0, os.SEEK_END)
             f.write(packbin)
             fdatasync(f.fileno())
         finally:
             f.close()
 
-        obj_list_sha = self._write_pack_idx_v2(self.filename + '.idx', idx, packbin)
+        obj_list_sha = self._write_pack_idx_v2(filename + '.idx', idx, packbin)
         nameprefix = os.path.join(self.repo_dir,
                                   'objects/pack/pack-' +  obj_list_sha)
-        if os.path.exists(self.filename + '.map'):
-            os.unlink(self.filename + '.map')
-        os.rename(self.filename + '.pack', nameprefix + '.pack')
-        os.rename(self.filename + '.idx', nameprefix + '.idx')
+        if os.path.exists(filename + '.map'):
+            os.unlink(filename + '.map')
+        os.rename(filename + '.pack', nameprefix + '.pack')
+        os.rename(filename + '.idx', nameprefix + '.idx')
         try:
-            os.fsync(self.parentfd)
+            os.fsync(parentfd)
         finally:
-            os.close(self.parentfd)
+            os.close(parentfd)
 
         if run_midx:
             auto_midx(os.path.join(self.repo_dir, 'objects/pack'))
 
-        if self.on_pack_finish:
-            self.on_pack_finish(nameprefix)
-
         return nameprefix
 
     def close(self, run_midx=True):
         """Close the pack file and move it to its definitive path."""
-        return self._end(run_midx=run_midx)
+        try:
+            self._write_pending()
+            return self._end(run_midx=run_midx)
+        finally:
+            self._stop_workers()
 
     def _write_pack_idx_v2(self, filename, idx, packbin):
+        # Since the offsets increase, only the last entries can need
+        # the 64-bit table.
         ofs64_count = 0
-        for section in idx:
-            for entry in section:
-                if entry[2] >= 2**31:
-                    ofs64_count += 1
+        for i in xrange(len(idx) - _idx_entry.size, -1, -_idx_entry.size):
+            if _idx_entry.unpack_from(idx, i)[2] < 2**31:
+                break
+            ofs64_count += 1
 
+        count = len(idx) // _idx_entry.size
         # Length: header + fan-out + shas-and-crcs + overflow-offsets
-        index_len = 8 + (4 * 256) + (28 * self.count) + (8 * ofs64_count)
+        index_len = 8 + (4 * 256) + (28 * count) + (8 * ofs64_count)
         idx_map = None
         idx_f = open(filename, 'w+b')
         try:
-            idx_f.truncate(index_len)
+            # ...followed by the pack and idx sha1sums
+            idx_f.truncate(index_len + 40)
             fdatasync(idx_f.fileno())
             idx_map = mmap_readwrite(idx_f, close=False)
             try:
-                count = _helpers.write_idx(filename, idx_map, idx, self.count)
-                assert(count == self.count)
+                written = _helpers.write_idx(filename, idx_map, idx, count)
+                assert(written == count)
+                # Compute the sums from the map instead of reading the
+                # file back.
+                idx_map[index_len:index_len + 20] = packbin
+                obj_list_sum = Sha1(buffer(idx_map, 8 + 4 * 256, 20 * count))
+                idx_sum = Sha1(buffer(idx_map, 0, index_len + 20))
+                idx_map[index_len + 20:] = idx_sum.digest()
                 idx_map.flush()
             finally:
                 idx_map.close()
-        finally:
-            idx_f.close()
-
-        idx_f = open(filename, 'a+b')
-        try:
-            idx_f.write(packbin)
-            idx_f.seek(0)
-            idx_sum = Sha1()
-            b = idx_f.read(8 + 4*256)
-            idx_sum.update(b)
-
-            obj_list_sum = Sha1()
-            for b in chunkyreader(idx_f, 20*self.count):
-                idx_sum.update(b)
-                obj_list_sum.update(b)
-            namebase = obj_list_sum.hexdigest()
-
-            for b in chunkyreader(idx_f):
-                idx_sum.update(b)
-            idx_f.write(idx_sum.digest())
             fdatasync(idx_f.fileno())
-            return namebase
+            return obj_list_sum.hexdigest()
         finally:
             idx_f.close()
 
@@ -1049,8 +1217,11 @@ def guess_repo(path=None):
             repodir = os.path.expanduser('~/.bup')
 
 
-def init_repo(path=None):
-    """Create the Git bare repository for bup in a given path."""
+def init_repo(path=None, config=None):
+    """Create the Git bare repository for bup in a given path.  config
+    may be a dict of additional git config settings for the
+    repository, which must not already have different values for any
+    of them (e.g. a repository can't change its bup.split.chunker)."""
     guess_repo(path)
     d = repo()  # appends a / to the path
     parent = os.path.dirname(os.path.dirname(d))
@@ -1058,6 +1229,13 @@ def init_repo(path=None):
         raise GitError('parent directory "%s" does not exist\n' % parent)
     if os.path.exists(d) and not os.path.isdir(os.path.join(d, '.')):
         raise GitError('"%s" exists but is not a directory\n' % d)
+    config = config or {}
+    if os.path.exists(d):
+        for name, value in sorted(config.items()):
+            old = git_config_get(name, repo_dir=d)
+            if old is not None and old.strip() != value:
+                raise GitError('%s is already %r in "%s"\n'
+                               % (name, old.strip(), d))
     p = subprocess.Popen(['git', '--bare', 'init'], stdout=sys.stderr,
                          preexec_fn = _gitenv())
     _git_wait('git init', p)
@@ -1070,6 +1248,10 @@ def init_repo(path=None):
     p = subprocess.Popen(['git', 'config', 'core.logAllRefUpdates', 'true'],
                          stdout=sys.stderr, preexec_fn = _gitenv())
     _git_wait('git config', p)
+    for name, value in sorted(config.items()):
+        p = subprocess.Popen(['git', 'config', name, value],
+                             stdout=sys.stderr, preexec_fn = _gitenv())
+        _git_wait('git config', p)
 
 
 def check_repo_or_die(path=None):
@@ -1149,6 +1331,8 @@ class _AbortableIter:
 _ver_warned = 0
 class CatPipe:
     """Link to 'git cat-file' that is used to retrieve blob data."""
+    max_in_flight = 128  # get_many() requests sent ahead of the replies
+
     def __init__(self, repo_dir = None):
         global _ver_warned
         self.repo_dir = repo_dir
@@ -1157,6 +1341,7 @@ class CatPipe:
             log('error: git version must be at least 1.5.6\n')
             sys.exit(1)
         self.p = self.inprogress = None
+        self.check_p = self.check_inprogress = None
 
     def _abort(self):
         if self.p:
@@ -1165,14 +1350,25 @@ class CatPipe:
         self.p = None
         self.inprogress = None
 
+    def _abort_check(self):
+        if self.check_p:
+            self.check_p.stdout.close()
+            self.check_p.stdin.close()
+        self.check_p = None
+        self.check_inprogress = None
+
+    def _popen_cat_file(self, mode):
+        return subprocess.Popen(['git', 'cat-file', mode],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE,
+                                close_fds = True,
+                                bufsize = 4096,
+                                preexec_fn = _gitenv(self.repo_dir))
+
     def restart(self):
         self._abort()
-        self.p = subprocess.Popen(['git', 'cat-file', '--batch'],
-                                  stdin=subprocess.PIPE,
-                                  stdout=subprocess.PIPE,
-                                  close_fds = True,
-                                  bufsize = 4096,
-                                  preexec_fn = _gitenv(self.repo_dir))
+        self._abort_check()
+        self.p = self._popen_cat_file('--batch')
 
     def get(self, ref):
         """Yield (oidx, type, size), followed by the data referred to by ref.
@@ -1216,6 +1412,136 @@ class CatPipe:
             it.abort()
             raise
 
+    def _read_batch_hdr(self, f):
+        hdr = f.readline()
+        if hdr.endswith(' missing\n'):
+            return None, None, None
+        info = hdr.split(' ')
+        if len(info) != 3 or len(info[0]) != 40:
+            raise GitError('expected object (id, type, size), got %r' % hdr)
+        oidx, typ, size = info
+        return oidx, typ, int(size)
+
+    def _finish_batch_item(self, data_it):
+        for ignored in data_it:
+            pass
+        readline_result = self.p.stdout.readline()
+        assert(readline_result == '\n')
+
+    def get_many(self, refs):
+        """Yield (oidx, type, size, data_it) for each ref in refs, in
+        order, or (None, None, None, None) if a ref does not exist.
+        Up to max_in_flight requests are sent to 'git cat-file' ahead
+        of the replies being read, so that walking many objects is
+        limited by throughput rather than by round trips.  Any data
+        left unread in data_it is discarded when the next item is
+        requested.
+
+        """
+        if not self.p or self.p.poll() != None:
+            self.restart()
+        assert(self.p)
+        if self.inprogress:
+            log('get_many: starting while %r is open\n' % self.inprogress)
+        assert(not self.inprogress)
+        self.inprogress = 'get_many'
+        refs = iter(refs)
+        pending = 0
+        data_it = None
+        try:
+            while True:
+                while pending < self.max_in_flight:
+                    ref = next(refs, None)
+                    if ref is None:
+                        break
+                    assert(ref.find('\n') < 0)
+                    assert(ref.find('\r') < 0)
+                    assert(not ref.startswith('-'))
+                    self.p.stdin.write('%s\n' % ref)
+                    pending += 1
+                if not pending:
+                    break
+                self.p.stdin.flush()
+                oidx, typ, size = self._read_batch_hdr(self.p.stdout)
+                pending -= 1
+                if not oidx:
+                    yield None, None, None, None
+                    continue
+                data_it = chunkyreader(self.p.stdout, size)
+                yield oidx, typ, size, data_it
+                self._finish_batch_item(data_it)
+                data_it = None
+        except GeneratorExit:
+            # Abandoned early; read the remaining replies so the pipe
+            # stays in sync for the next request.
+            if data_it:
+                self._finish_batch_item(data_it)
+            self.p.stdin.flush()
+            for i in xrange(pending):
+                oidx, typ, size = self._read_batch_hdr(self.p.stdout)
+                if oidx:
+                    self._finish_batch_item(chunkyreader(self.p.stdout, size))
+            self.inprogress = None
+            raise
+        except:
+            self._abort()
+            raise
+        self.inprogress = None
+
+    def get_info_many(self, refs):
+        """Yield (oidx, type, size) for each ref in refs, in order, or
+        (None, None, None) if a ref does not exist.  The headers come
+        from a separate 'git cat-file --batch-check', so no object data
+        is read, and a get() or get_many() may be in progress.
+
+        """
+        if not self.check_p or self.check_p.poll() != None:
+            self._abort_check()
+            self.check_p = self._popen_cat_file('--batch-check')
+        if self.check_inprogress:
+            log('get_info_many: starting while %r is open\n'
+                % self.check_inprogress)
+        assert(not self.check_inprogress)
+        self.check_inprogress = 'get_info_many'
+        p = self.check_p
+        refs = iter(refs)
+        pending = 0
+        try:
+            while True:
+                while pending < self.max_in_flight:
+                    ref = next(refs, None)
+                    if ref is None:
+                        break
+                    assert(ref.find('\n') < 0)
+                    assert(ref.find('\r') < 0)
+                    assert(not ref.startswith('-'))
+                    p.stdin.write('%s\n' % ref)
+                    pending += 1
+                if not pending:
+                    break
+                p.stdin.flush()
+                info = self._read_batch_hdr(p.stdout)
+                pending -= 1
+                yield info
+        except GeneratorExit:
+            p.stdin.flush()
+            for i in xrange(pending):
+                self._read_batch_hdr(p.stdout)
+            self.check_inprogress = None
+            raise
+        except:
+            self._abort_check()
+            raise
+        self.check_inprogress = None
+
+    def get_info(self, ref):
+        """Return (oidx, type, size) for ref, or (None, None, None) if
+        it does not exist.
+
+        """
+        info, = CatPipe.get_info_many(self, (ref,))
+        return info
+
     def _join(self, it):
         _, typ, _ = next(it)
         if typ == 'blob':
@@ -1248,6 +1574,336 @@ class CatPipe:
             log('booger!\n')
 
 
+_oidx_rx = re.compile(r'^[0-9a-fA-F]{40}$')
+
+def _read_delta_size(delta, i):
+    size = shift = 0
+    while 1:
+        c = ord(delta[i])
+        i += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return i, size
+
+
+def _apply_delta(base, delta):
+    """Return the result of applying the git pack delta to base."""
+    i, src_size = _read_delta_size(delta, 0)
+    if src_size != len(base):
+        raise GitError('delta base size %d does not match expected %d'
+                       % (len(base), src_size))
+    i, dest_size = _read_delta_size(delta, i)
+    end = len(delta)
+    out = []
+    while i < end:
+        c = ord(delta[i])
+        i += 1
+        if c & 0x80:
+            # Copy from base: the low nibble selects which offset
+            # bytes follow, the next three bits which size bytes.
+            ofs = size = 0
+            for bit, shift in ((0x01, 0), (0x02, 8), (0x04, 16), (0x08, 24)):
+                if c & bit:
+                    ofs |= ord(delta[i]) << shift
+                    i += 1
+            for bit, shift in ((0x10, 0), (0x20, 8), (0x40, 16)):
+                if c & bit:
+                    size |= ord(delta[i]) << shift
+                    i += 1
+            if not size:
+                size = 0x10000
+            out.append(base[ofs:ofs + size])
+        elif c:
+            out.append(delta[i:i + c])
+            i += c
+        else:
+            raise GitError('invalid delta opcode 0')
+    result = ''.join(out)
+    if len(result) != dest_size:
+        raise GitError('delta result size %d does not match expected %d'
+                       % (len(result), dest_size))
+    return result
+
+
+class PackCatPipe(CatPipe):
+    """A CatPipe that reads objects directly from the repository's
+    packfiles.  Offsets are found via the .midx and .idx files, and
+    the objects (including OFS and REF deltas) are inflated in-process
+    from an mmap of the relevant .pack.  Anything that can't be found
+    that way (refs, loose objects, etc.) is handed to 'git cat-file'.
+    """
+    _max_cached_bases = 64
+
+    def __init__(self, repo_dir = None):
+        CatPipe.__init__(self, repo_dir)
+        self._pack_dir = repo('objects/pack', repo_dir=repo_dir)
+        self._reset_packs()
+
+    def _reset_packs(self):
+        self._pack_dir_mtime = None
+        self._midxes = []
+        self._idxs = []
+        self._idx_by_name = {}
+        self._pack_maps = {}
+        self._base_cache = {}
+
+    def restart(self):
+        # Drop everything so that we release any deleted packs (bup gc).
+        self._reset_packs()
+        CatPipe.restart(self)
+
+    def _refresh(self):
+        st = stat_if_exists(self._pack_dir)
+        mtime = st.st_mtime if st else None
+        if self._pack_dir_mtime is not None and mtime == self._pack_dir_mtime:
+            return False
+        self._pack_dir_mtime = mtime
+        old_idxs = self._idx_by_name
+        self._reset_packs()
+        self._pack_dir_mtime = mtime
+        idx_names = set(os.path.basename(x) for x in
+                        glob.glob(os.path.join(self._pack_dir, '*.idx')))
+        covered = set()
+        for full in glob.glob(os.path.join(self._pack_dir, '*.midx')):
+            mx = midx.PackMidx(full)
+            if not mx.idxnames or not idx_names.issuperset(mx.idxnames):
+                # Unusable or stale; PackIdxList.refresh() handles cleanup.
+                mx.close()
+                continue
+            self._midxes.append(mx)
+            covered.update(mx.idxnames)
+        self._midxes.sort(key=len, reverse=True)
+        for name in idx_names:
+            ix = old_idxs.get(name)
+            if ix:
+                self._idx_by_name[name] = ix
+            if name not in covered:
+                try:
+                    self._idxs.append(self._idx(name))
+                except GitError as e:
+                    add_error(e)
+        self._idxs.sort(key=len, reverse=True)
+        return True
+
+    def _idx(self, name):
+        ix = self._idx_by_name.get(name)
+        if not ix:
+            ix = open_idx(os.path.join(self._pack_dir, name))
+            self._idx_by_name[name] = ix
+        return ix
+
+    def _pack_map(self, idx_name):
+        m = self._pack_maps.get(idx_name)
+        if m is None:
+            assert(idx_name.endswith('.idx'))
+            with open(os.path.join(self._pack_dir,
+                                   idx_name[:-4] + '.pack'), 'rb') as f:
+                m = mmap_read(f, close=False)
+            if str(m[0:4]) != 'PACK':
+                raise GitError('%s: unrecognized pack header' % idx_name)
+            self._pack_maps[idx_name] = m
+        return m
+
+    def _find_in_packs(self, oid):
+        for mx in self._midxes:
+            name = mx.exists(oid, want_source=True)
+            if name:
+                return name, self._idx(name).find_offset(oid)
+        for ix in self._idxs:
+            ofs = ix.find_offset(oid)
+            if ofs is not None:
+                return os.path.basename(ix.name), ofs
+        return None, None
+
+    def _find(self, oid):
+        """Return (idx_name, offset) for oid, or (None, None)."""
+        if self._pack_dir_mtime is None:
+            self._refresh()
+        idx_name, ofs = self._find_in_packs(oid)
+        if idx_name is None and self._refresh():
+            idx_name, ofs = self._find_in_packs(oid)
+        return idx_name, ofs
+
+    def _cache_base(self, idx_name, ofs, result):
+        if len(self._base_cache) >= self._max_cached_bases:
+            self._base_cache.clear()
+        self._base_cache[(idx_name, ofs)] = result
+
+    def _packed_header(self, idx_name, ofs):
+        """Return (map, kind, size, base, i) for the object at ofs in
+        the pack, where base is the base's pack offset for an
+        OFS_DELTA, its oid for a REF_DELTA, and None otherwise, and i
+        is the offset of the object's zlib stream.
+
+        """
+        m = self._pack_map(idx_name)
+        c = ord(m[ofs])
+        kind = (c & 0x70) >> 4
+        size = c & 0x0f
+        shift = 4
+        i = ofs + 1
+        while c & 0x80:
+            c = ord(m[i])
+            i += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        base = None
+        if kind == 6:  # OFS_DELTA
+            c = ord(m[i])
+            i += 1
+            base_rel = c & 0x7f
+            while c & 0x80:
+                c = ord(m[i])
+                i += 1
+                base_rel = ((base_rel + 1) << 7) | (c & 0x7f)
+            base = ofs - base_rel
+        elif kind == 7:  # REF_DELTA
+            base = str(m[i:i + 20])
+            i += 20
+        elif kind not in _typermap:
+            raise GitError('unexpected pack object type %d at %s:%d'
+                           % (kind, idx_name, ofs))
+        return m, kind, size, base, i
+
+    def _packed_info(self, idx_name, ofs):
+        """Return the (type, size) of the object at ofs in the pack,
+        inflating no more than the start of any delta.
+
+        """
+        m, kind, size, base, i = self._packed_header(idx_name, ofs)
+        if kind not in (6, 7):
+            return _typermap[kind], size
+        # The delta starts with the base and result sizes as varints.
+        hdr = zlib.decompressobj().decompress(buffer(m, i), 20)
+        j, _ = _read_delta_size(hdr, 0)
+        size = _read_delta_size(hdr, j)[1]
+        # The type is the one at the end of the delta chain, which is
+        # followed iteratively, since git allows chains thousands of
+        # objects long.
+        while kind in (6, 7):
+            if kind == 7:
+                base_oid = base
+                idx_name, base = self._find(base_oid)
+                if idx_name is None:
+                    typ = CatPipe.get_info(self, base_oid.encode('hex'))[1]
+                    if typ is None:
+                        raise MissingObject(base_oid)
+                    return typ, size
+            m, kind, _, base, i = self._packed_header(idx_name, base)
+        return _typermap[kind], size
+
+    def _inflate(self, m, i, size, idx_name, ofs):
+        data = zlib.decompress(buffer(m, i), 15, max(1, size))
+        if len(data) != size:
+            raise GitError('object at %s:%d inflated to %d bytes, expected %d'
+                           % (idx_name, ofs, len(data), size))
+        return data
+
+    def _read_packed(self, idx_name, ofs):
+        """Return the (type, content) of the object at ofs in the pack."""
+        # Follow the delta chain (iteratively, since git allows chains
+        # thousands of objects long) down to an object that isn't a
+        # delta, or a cached base, and then apply the deltas back up.
+        deltas = []
+        while True:
+            if deltas:
+                result = self._base_cache.get((idx_name, ofs))
+                if result:
+                    typ, data = result
+                    break
+            m, kind, size, base, i = self._packed_header(idx_name, ofs)
+            if kind not in (6, 7):
+                typ = _typermap[kind]
+                data = self._inflate(m, i, size, idx_name, ofs)
+                if deltas:
+                    self._cache_base(idx_name, ofs, (typ, data))
+                break
+            deltas.append((idx_name, ofs,
+                           self._inflate(m, i, size, idx_name, ofs)))
+            if kind == 6:
+                ofs = base
+            else:
+                base_oid = base
+                idx_name, ofs = self._find(base_oid)
+                if idx_name is None:
+                    it = CatPipe.get(self, base_oid.encode('hex'))
+                    typ = next(it)[1]
+                    if typ is None:
+                        raise MissingObject(base_oid)
+                    data = ''.join(it)
+                    break
+        while deltas:
+            idx_name, ofs, delta = deltas.pop()
+            data = _apply_delta(data, delta)
+            if deltas:
+                self._cache_base(idx_name, ofs, (typ, data))
+        return typ, data
+
+    def _read_object(self, oid):
+        idx_name, ofs = self._find(oid)
+        if idx_name is not None:
+            return self._read_packed(idx_name, ofs)
+        it = CatPipe.get(self, oid.encode('hex'))
+        typ = next(it)[1]
+        if typ is None:
+            return None, None
+        return typ, ''.join(it)
+
+    def get(self, ref):
+        """Yield (oidx, type, size), followed by the data referred to by ref.
+        If ref does not exist, only yield (None, None, None).
+
+        """
+        if _oidx_rx.match(ref):
+            oid = ref.decode('hex')
+            idx_name, ofs = self._find(oid)
+            if idx_name is not None:
+                typ, data = self._read_packed(idx_name, ofs)
+                yield ref.lower(), typ, len(data)
+                yield data
+                return
+        for x in CatPipe.get(self, ref):
+            yield x
+
+    def get_many(self, refs):
+        """Yield (oidx, type, size, data_it) for each ref in refs, in
+        order, or (None, None, None, None) if a ref does not exist.
+
+        """
+        # Packed objects don't need pipelining, and anything else is
+        # rare enough to just fetch one at a time.
+        for ref in refs:
+            it = self.get(ref)
+            oidx, typ, size = next(it)
+            if not oidx:
+                yield None, None, None, None
+                continue
+            yield oidx, typ, size, it
+            for ignored in it:
+                pass
+
+    def get_info(self, ref):
+        """Return (oidx, type, size) for ref, or (None, None, None) if
+        it does not exist.  Packed objects are answered from their pack
+        headers, inflating no more than the start of any delta.
+
+        """
+        if _oidx_rx.match(ref):
+            idx_name, ofs = self._find(ref.decode('hex'))
+            if idx_name is not None:
+                return (ref.lower(),) + self._packed_info(idx_name, ofs)
+        return CatPipe.get_info(self, ref)
+
+    def get_info_many(self, refs):
+        """Yield (oidx, type, size) for each ref in refs, in order, or
+        (None, None, None) if a ref does not exist.
+
+        """
+        for ref in refs:
+            yield self.get_info(ref)
+
+
 _cp = {}
 
 def cp(repo_dir=None):
@@ -1304,40 +1960,70 @@ def walk_object(cat_pipe, oidx,
     read or return blob content in the data field unless include_data
     is set.
     """
+    def needs_fetch(oidx, mode):
+        if stop_at and stop_at(oidx):
+            return False
+        # If the object is a "regular file", then it's a leaf in the
+        # graph, so we can skip reading the data if the caller hasn't
+        # requested it.
+        return include_data or not (mode and stat.S_ISREG(mode))
+
+    def prefetch(oidx, mode):
+        # Fetch oidx along with the next objects we'll need from the
+        # top of the stack, so cat_pipe can pipeline the requests.
+        batch = [(oidx, mode)]
+        seen = set((oidx,))
+        for pend_oidx, _, _, pend_mode in reversed(pending):
+            if len(batch) >= cat_pipe.max_in_flight:
+                break
+            if pend_oidx in seen or pend_oidx in fetched:
+                continue
+            if needs_fetch(pend_oidx, pend_mode):
+                batch.append((pend_oidx, pend_mode))
+                seen.add(pend_oidx)
+        if not include_data:
+            # Only trees and commits have to be read, so ask for just
+            # the type of anything that might be a blob.
+            unknown = [x for x, m in batch if not (m and stat.S_ISDIR(m))]
+            infos = cat_pipe.get_info_many(unknown)
+            # Put get_info_many() first so that izip runs it to completion.
+            for (info_oidx, typ, _), want in izip(infos, unknown):
+                if not info_oidx:
+                    fetched[want] = None, None
+                elif typ == 'blob':
+                    fetched[want] = typ, None
+        batch = [x for x, m in batch if x not in fetched]
+        # Put get_many() first so that izip runs it to completion.
+        for (get_oidx, typ, _, it), want in izip(cat_pipe.get_many(batch),
+                                                  batch):
+            fetched[want] = (typ, ''.join(it)) if get_oidx else (None, None)
+
     # Maintain the pending stack on the heap to avoid stack overflow
     pending = [(oidx, [], [], None)]
+    fetched = {}
     while len(pending):
         oidx, parent_path, chunk_path, mode = pending.pop()
         oid = oidx.decode('hex')
         if stop_at and stop_at(oidx):
+            fetched.pop(oidx, None)
             continue
 
         if (not include_data) and mode and stat.S_ISREG(mode):
-            # If the object is a "regular file", then it's a leaf in
-            # the graph, so we can skip reading the data if the caller
-            # hasn't requested it.
             yield WalkItem(oid=oid, type='blob',
                            chunk_path=chunk_path, path=parent_path,
                            mode=mode,
                            data=None)
             continue
 
-        item_it = cat_pipe.get(oidx)
-        get_oidx, typ, _ = next(item_it)
-        if not get_oidx:
+        if oidx not in fetched:
+            prefetch(oidx, mode)
+        typ, data = fetched.pop(oidx)
+        if not typ:
             raise MissingObject(oidx.decode('hex'))
         if typ not in ('blob', 'commit', 'tree'):
             raise Exception('unexpected repository object type %r' % typ)
 
         # FIXME: set the mode based on the type when the mode is None
-        if typ == 'blob' and not include_data:
-            # Dump data until we can ask cat_pipe not to fetch it
-            for ignored in item_it:
-                pass
-            data = None
-        else:
-            data = ''.join(item_it)
-
         yield WalkItem(oid=oid, type=typ,
                        chunk_path=chunk_path, path=parent_path,
                        mode=mode,
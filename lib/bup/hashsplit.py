@@ -1,48 +1,79 @@
 
 from __future__ import absolute_import
-import io, math, os
+import io, math, os, stat, struct, sys
+import Queue, threading
+from array import array
+from collections import namedtuple
 
 from bup import _helpers, helpers
-from bup.helpers import sc_page_size
+from bup.helpers import parse_num, sc_page_size
 
 _fmincore = getattr(helpers, 'fmincore', None)
+_split_and_hash = getattr(_helpers, 'split_and_hash', None)
 
+BLOB_BITS = _helpers.blobbits()  # blobs average 1 << BLOB_BITS bytes
+BLOB_MIN = None     # the chunker's default
 BLOB_MAX = 8192*4   # 8192 is the "typical" blob size for bupsplit
 BLOB_READ_SIZE = 1024*1024
 MAX_PER_TREE = 256
 progress_callback = None
 fanout = 16
 
+# The content-defined chunking engines, by their names in the
+# bup.split.chunker repository setting.  A repository should only ever
+# use one of them (see configure()), since data split by one won't
+# deduplicate against data split by another.
+CHUNKERS = {'bupsplit': _helpers.CHUNKER_BUPSPLIT,
+            'fastcdc': _helpers.CHUNKER_FASTCDC}
+DEFAULT_CHUNKER = 'bupsplit'
+chunker = DEFAULT_CHUNKER
+
 GIT_MODE_FILE = 0o100644
 GIT_MODE_TREE = 0o40000
 GIT_MODE_SYMLINK = 0o120000
 
 # The purpose of this type of buffer is to avoid copying on peek(), get(),
-# and eat().  We do copy the buffer contents on put(), but that should
-# be ok if we always only put() large amounts of data at a time.
+# and eat().  put() copies the new data into a preallocated bytearray,
+# after moving any unconsumed bytes to the front, which is cheap as long
+# as we always put() large amounts of data and split out everything we
+# can in between.  Since the buffer is reused, anything returned by
+# peek() or get() is only valid until the next put().
 class Buf:
     def __init__(self):
-        self.data = ''
-        self.start = 0
+        self.data = bytearray()
+        self.start = self.end = 0
 
     def put(self, s):
         if s:
-            self.data = buffer(self.data, self.start) + s
+            used = self.end - self.start
+            size = used + len(s)
+            if size > len(self.data):
+                # Leave room for a similar put() plus a leftover blob.
+                data = bytearray(size + BLOB_MAX if self.data else size)
+                data[:used] = buffer(self.data, self.start, used)
+                self.data = data
+            elif self.start:
+                if self.start < used:  # overlapping
+                    self.data[:used] = self.data[self.start:self.end]
+                else:
+                    self.data[:used] = buffer(self.data, self.start, used)
+            self.data[used:size] = s
             self.start = 0
-            
+            self.end = size
+
     def peek(self, count):
-        return buffer(self.data, self.start, count)
-    
+        return buffer(self.data, self.start, min(count, self.used()))
+
     def eat(self, count):
         self.start += count
 
     def get(self, count):
-        v = buffer(self.data, self.start, count)
-        self.start += count
+        v = self.peek(count)
+        self.start += len(v)
         return v
 
     def used(self):
-        return len(self.data) - self.start
+        return self.end - self.start
 
 
 def _fadvise_pages_done(fd, first_page, count):
@@ -90,23 +121,60 @@ def _uncache_ours_upto(fd, offset, first_region, remaining_regions):
     return (rstart, rlen)
 
 
+# How much of each file prefetch() asks the kernel to read; after that,
+# the kernel's own readahead should keep up.
+_PREFETCH_BYTES = 8 * 1024 * 1024
+
+# The mincore() data for each prefetched file from before it was
+# prefetched, by _file_key()
+_prefetched_mincore = {}
+
+def _file_key(fd):
+    st = os.fstat(fd)
+    return st.st_dev, st.st_ino
+
+def prefetch(f):
+    """Ask the kernel to start reading the beginning of the rest of
+    the regular file f into the cache, so that it may already be there
+    when readfile_iter() gets to it.  The pages that weren't already
+    cached are still dropped from the cache after they're read, as if
+    readfile_iter() had read them itself."""
+    fd = f.fileno()
+    if _fmincore:
+        mcore = _fmincore(fd)
+        if mcore is not None:
+            _prefetched_mincore[_file_key(fd)] = mcore
+    _helpers.fadvise_willneed(fd, f.tell(), _PREFETCH_BYTES)
+
+
+def forget_prefetch(f):
+    """Drop what prefetch() recorded for f, which must be called if f
+    is closed without readfile_iter() reading it."""
+    if _prefetched_mincore:
+        _prefetched_mincore.pop(_file_key(f.fileno()), None)
+
+
 def readfile_iter(files, progress=None):
     for filenum,f in enumerate(files):
         ofs = 0
         b = ''
         fd = rpr = rstart = rlen = None
-        if _fmincore and hasattr(f, 'fileno'):
+        if hasattr(f, 'fileno'):
             try:
                 fd = f.fileno()
             except io.UnsupportedOperation:
                 pass
-            if fd:
+        if fd and stat.S_ISREG(os.fstat(fd).st_mode):
+            ofs = f.tell()  # the file may not be at its start
+        if _fmincore and fd:
+            mcore = _prefetched_mincore.pop(_file_key(fd), None)
+            if mcore is None:
                 mcore = _fmincore(fd)
-                if mcore:
-                    max_chunk = max(1, (8 * 1024 * 1024) / sc_page_size)
-                    rpr = _nonresident_page_regions(mcore, helpers.MINCORE_INCORE,
-                                                    max_chunk)
-                    rstart, rlen = next(rpr, (None, None))
+            if mcore:
+                max_chunk = max(1, (8 * 1024 * 1024) / sc_page_size)
+                rpr = _nonresident_page_regions(mcore, helpers.MINCORE_INCORE,
+                                                max_chunk)
+                rstart, rlen = next(rpr, (None, None))
         while 1:
             if progress:
                 progress(filenum, len(b))
@@ -121,39 +189,95 @@ def readfile_iter(files, progress=None):
             rstart, rlen = _uncache_ours_upto(fd, ofs, (rstart, rlen), rpr)
 
 
-def _splitbuf(buf, basebits, fanbits):
-    while 1:
-        b = buf.peek(buf.used())
-        (ofs, bits) = _helpers.splitbuf(b)
-        if ofs:
-            if ofs > BLOB_MAX:
-                ofs = BLOB_MAX
-                level = 0
+def _blob_sha(blob):
+    # The blob's git id, as git.calc_hash('blob', blob) computes it.
+    # hashlib releases the GIL for large updates.
+    sum = helpers.Sha1('blob %d\0' % len(blob))
+    sum.update(blob)
+    return sum.digest()
+
+
+# (zeros, sha) for the last size passed to _zero_blob()
+_zero_blob_cache = [None, None]
+
+def _zero_blob(size):
+    """Return (zeros, sha) for a blob of size zero bytes, where zeros is
+    a buffer that compares equal to any other buffer of size zeros."""
+    zeros, sha = _zero_blob_cache
+    if zeros is None or len(zeros) != size:
+        zeros = buffer('\0' * size)
+        sha = _blob_sha(zeros)
+        _zero_blob_cache[:] = zeros, sha
+    return zeros, sha
+
+
+def _max_blob_sha(blob):
+    # Runs of zeros (sparse files, disk images, ...) never split, so
+    # they're cut into BLOB_MAX blobs that all have the same id.
+    if blob[0] == '\0':
+        zeros, sha = _zero_blob(BLOB_MAX)
+        if blob == zeros:
+            return sha
+    return _blob_sha(blob)
+
+
+_split_hash_entry = struct.Struct('ii20s')
+
+def _iter_unpack(st, data):
+    for i in xrange(0, len(data), st.size):
+        yield st.unpack_from(data, i)
+
+
+def _splitbuf(buf, basebits, fanbits, engine, want_sha=False):
+    # Find all of the splits with one call, rather than one per blob,
+    # and when asked, compute their blob ids too, in the same C pass
+    # when _helpers was built with OpenSSL.
+    if want_sha and _split_and_hash:
+        splits = _split_and_hash(buf.peek(buf.used()), BLOB_MAX,
+                                 *(engine + (_zero_blob(BLOB_MAX)[1],)))
+        for ofs, bits, sha in _iter_unpack(_split_hash_entry, splits):
+            level = (bits - basebits) // fanbits if bits else 0
+            yield buf.get(ofs), level, sha
+    else:
+        splits = array('i')
+        splits.fromstring(_helpers.find_splits(buf.peek(buf.used()),
+                                               BLOB_MAX, *engine))
+        for i in xrange(0, len(splits), 2):
+            ofs, bits = splits[i], splits[i + 1]
+            # bits is 0 when the blob was cut at BLOB_MAX
+            level = (bits - basebits) // fanbits if bits else 0
+            blob = buf.get(ofs)
+            if not want_sha:
+                sha = None
+            elif bits:
+                sha = _blob_sha(blob)
             else:
-                level = (bits-basebits)//fanbits  # integer division
-            buf.eat(ofs)
-            yield buffer(b, 0, ofs), level
-        else:
-            break
+                sha = _max_blob_sha(blob)
+            yield blob, level, sha
     while buf.used() >= BLOB_MAX:
         # limit max blob size
-        yield buf.get(BLOB_MAX), 0
+        blob = buf.get(BLOB_MAX)
+        yield blob, 0, _max_blob_sha(blob) if want_sha else None
 
 
-def _hashsplit_iter(files, progress):
+def _hashsplit_iter(files, progress, want_sha=False):
     assert(BLOB_READ_SIZE > BLOB_MAX)
-    basebits = _helpers.blobbits()
+    basebits = BLOB_BITS
     fanbits = int(math.log(fanout or 128, 2))
+    # The engine's arguments to find_splits()
+    engine = (CHUNKERS[chunker], BLOB_BITS,
+              -1 if BLOB_MIN is None else BLOB_MIN)
     buf = Buf()
     for inblock in readfile_iter(files, progress):
         buf.put(inblock)
-        for buf_and_level in _splitbuf(buf, basebits, fanbits):
-            yield buf_and_level
+        for split in _splitbuf(buf, basebits, fanbits, engine, want_sha):
+            yield split
     if buf.used():
-        yield buf.get(buf.used()), 0
+        blob = buf.get(buf.used())
+        yield blob, 0, _blob_sha(blob) if want_sha else None
 
 
-def _hashsplit_iter_keep_boundaries(files, progress):
+def _hashsplit_iter_keep_boundaries(files, progress, want_sha=False):
     for real_filenum,f in enumerate(files):
         if progress:
             def prog(filenum, nbytes):
@@ -162,22 +286,166 @@ def _hashsplit_iter_keep_boundaries(files, progress):
                 return progress(real_filenum, nbytes)
         else:
             prog = None
-        for buf_and_level in _hashsplit_iter([f], progress=prog):
-            yield buf_and_level
+        for split in _hashsplit_iter([f], progress=prog, want_sha=want_sha):
+            yield split
 
 
-def hashsplit_iter(files, keep_boundaries, progress):
+def _split_iter(files, keep_boundaries, progress, want_sha=False):
+    """Yield (blob, level, sha) for each blob, where sha is the blob's
+    git id when want_sha is true, and None otherwise."""
     if keep_boundaries:
-        return _hashsplit_iter_keep_boundaries(files, progress)
+        return _hashsplit_iter_keep_boundaries(files, progress, want_sha)
     else:
-        return _hashsplit_iter(files, progress)
+        return _hashsplit_iter(files, progress, want_sha)
+
+
+def hashsplit_iter(files, keep_boundaries, progress):
+    for blob, level, sha in _split_iter(files, keep_boundaries, progress):
+        yield blob, level
+
+
+# The largest bup.split.maxSize.  _splitbuf() hands _helpers, which
+# uses C int sizes, up to a BLOB_READ_SIZE (at least 2 * BLOB_MAX) read
+# plus a leftover of less than BLOB_MAX.
+MAX_BLOB_MAX = 512 * 1024 * 1024
+assert 3 * MAX_BLOB_MAX < _helpers.INT_MAX
+
+SplitConfig = namedtuple('SplitConfig', ['chunker', 'blob_bits', 'blob_min',
+                                         'blob_max', 'fanout'])
+
+def read_config(config_get):
+    """Return the SplitConfig given by a repository's bup.split.*
+    settings, where config_get(name) returns the value of its git
+    config option name, or None if it's not set (e.g.
+    git.git_config_get, or client.Client.config_get for a remote
+    repository).  Unset values have their defaults, except that
+    blob_min is None when the chunker's own default applies.  Raise
+    ValueError if any settings are invalid."""
+    def get(name, parse, default):
+        value = config_get('bup.split.' + name)
+        if value is None:
+            return default
+        value = value.strip()
+        try:
+            return parse(value)
+        except ValueError:
+            raise ValueError('invalid bup.split.%s %r' % (name, value))
+    size = lambda s: int(parse_num(s))
+    chunker = get('chunker', str, DEFAULT_CHUNKER)
+    if chunker not in CHUNKERS:
+        raise ValueError('unknown bup.split.chunker %r (expected one of %s)'
+                         % (chunker, ', '.join(sorted(CHUNKERS))))
+    blob_bits = get('blobBits', int, _helpers.blobbits())
+    if not 6 <= blob_bits <= 30:
+        raise ValueError('bup.split.blobBits must be between 6 and 30')
+    blob_min = get('minSize', size, None)
+    blob_max = get('maxSize', size, min(4 << blob_bits, MAX_BLOB_MAX))
+    if not 0 < blob_max <= MAX_BLOB_MAX:
+        raise ValueError('bup.split.maxSize must be between 1 and %d'
+                         % MAX_BLOB_MAX)
+    if blob_min is not None and not 0 <= blob_min < blob_max:
+        raise ValueError('bup.split.minSize must be at least 0,'
+                         ' and less than bup.split.maxSize')
+    split_fanout = get('fanout', size, 16)
+    if split_fanout < 2:
+        raise ValueError('bup.split.fanout must be at least 2')
+    return SplitConfig(chunker, blob_bits, blob_min, blob_max, split_fanout)
+
+
+def configure(config_get):
+    """Adopt the split settings of the destination repository (see
+    read_config()), so that all of its data is split the same way."""
+    global chunker, BLOB_BITS, BLOB_MIN, BLOB_MAX, BLOB_READ_SIZE
+    global fanout, MAX_PER_TREE
+    config = read_config(config_get)
+    chunker = config.chunker
+    BLOB_BITS = config.blob_bits
+    BLOB_MIN = config.blob_min
+    BLOB_MAX = config.blob_max
+    BLOB_READ_SIZE = max(BLOB_READ_SIZE, 2 * BLOB_MAX)
+    fanout = config.fanout
+    # 256 for the default fanout of 16
+    MAX_PER_TREE = 16 * fanout
+
+
+# How much of a file split_ahead() may split before it's consumed
+_SPLIT_AHEAD_BYTES = 8 * 1024 * 1024
+
+class _SplitAhead:
+    """Iterates over the (blob, level, sha) splits of files, as
+    _split_iter(..., want_sha=True) yields them, while a background
+    thread finds them."""
+    def __init__(self, files, keep_boundaries):
+        self._queue = Queue.Queue(max(1, _SPLIT_AHEAD_BYTES // BLOB_MAX))
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._split,
+                                        args=(files, keep_boundaries))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _split(self, files, keep_boundaries):
+        # Queue each split, then None, or (exc_info,) after an error.
+        try:
+            for blob, level, sha in _split_iter(files, keep_boundaries, None,
+                                                want_sha=True):
+                # The blob may be a view of a buffer that's about to
+                # be reused.
+                self._queue.put((str(blob), level, sha))
+                if self._stop.is_set():
+                    return
+        except:
+            self._queue.put((sys.exc_info(),))
+            return
+        self._queue.put(None)
+
+    def __iter__(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if len(item) == 1:
+                exc_info = item[0]
+                raise exc_info[0], exc_info[1], exc_info[2]
+            yield item
+
+    def close(self):
+        """Stop splitting, and discard anything that hasn't been
+        consumed."""
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+
+def split_ahead(files, keep_boundaries):
+    """Start splitting files on a background thread, and return an
+    iterable of the splits to pass to split_to_blob_or_tree() (or
+    split_to_shalist() or split_to_blobs()) as splits.  That way the
+    reading, splitting and hashing of several files can proceed at
+    once (the C parts release the GIL), while the blobs are still
+    written in order by the caller's thread.  The iterable's close()
+    abandons the split."""
+    return _SplitAhead(files, keep_boundaries)
 
 
 total_split = 0
-def split_to_blobs(makeblob, files, keep_boundaries, progress):
+def split_to_blobs(makeblob, files, keep_boundaries, progress, splits=None):
+    """Split files into blobs, passing each one to makeblob, and yield
+    (sha, size, level) for each.  The blob's id is computed during
+    the split, and passed along as makeblob(blob, sha=sha), so makeblob
+    must accept that (as PackWriter.new_blob does).  If
+    splits isn't None, take the splits from it (see split_ahead()),
+    rather than splitting files here."""
     global total_split
-    for (blob, level) in hashsplit_iter(files, keep_boundaries, progress):
-        sha = makeblob(blob)
+    if splits is None:
+        splits = _split_iter(files, keep_boundaries, progress, want_sha=True)
+    for (blob, level, sha) in splits:
+        if sha:
+            sha = makeblob(blob, sha=sha)
+        else:
+            sha = makeblob(blob)
         total_split += len(blob)
         if progress_callback:
             progress_callback(len(blob))
@@ -213,8 +481,8 @@ def _squish(maketree, stacks, n):
 
 
 def split_to_shalist(makeblob, maketree, files,
-                     keep_boundaries, progress=None):
-    sl = split_to_blobs(makeblob, files, keep_boundaries, progress)
+                     keep_boundaries, progress=None, splits=None):
+    sl = split_to_blobs(makeblob, files, keep_boundaries, progress, splits)
     assert(fanout != 0)
     if not fanout:
         shal = []
@@ -233,9 +501,10 @@ def split_to_shalist(makeblob, maketree, files,
 
 
 def split_to_blob_or_tree(makeblob, maketree, files,
-                          keep_boundaries, progress=None):
+                          keep_boundaries, progress=None, splits=None):
     shalist = list(split_to_shalist(makeblob, maketree,
-                                    files, keep_boundaries, progress))
+                                    files, keep_boundaries, progress,
+                                    splits))
     if len(shalist) == 1:
         return (shalist[0][0], shalist[0][2])
     elif len(shalist) == 0:
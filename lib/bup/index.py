@@ -1,8 +1,9 @@
 
 from __future__ import absolute_import
 import errno, os, stat, struct, tempfile
+from io import BytesIO
 
-from bup import metadata, xstat
+from bup import metadata, vint, xstat
 from bup._helpers import UINT_MAX, bytescmp
 from bup.helpers import (add_error, log, merge_iter, mmap_readwrite,
                          progress, qprogress, resolve_parent, slashappend)
@@ -10,7 +11,8 @@ from bup.helpers import (add_error, log, merge_iter, mmap_readwrite,
 EMPTY_SHA = '\0'*20
 FAKE_SHA = '\x01'*20
 
-INDEX_HDR = 'BUPI\0\0\0\7'
+INDEX_HDR = 'BUPI\0\0\0\10'
+DIRTY_HDR = 'BUPD\0\0\0\2'
 
 # Time values are handled as integer nanoseconds since the epoch in
 # memory, but are written as xstat/metadata timespecs.  This behavior
@@ -36,13 +38,24 @@ INDEX_SIG = ('!'
              'Q')               # meta_ofs
 
 ENTLEN = struct.calcsize(INDEX_SIG)
-FOOTER_SIG = '!Q'
+FOOTER_SIG = ('!'
+              'Q'                # generation
+              'Q')               # count
 FOOTLEN = struct.calcsize(FOOTER_SIG)
 
 IX_EXISTS = 0x8000        # file exists on filesystem
 IX_HASHVALID = 0x4000     # the stored sha1 matches the filesystem
 IX_SHAMISSING = 0x2000    # the stored sha1 object doesn't seem to exist
 
+# New entries are merged into a (small) overlay index next to the main
+# one, rather than into a rewrite of the whole index, until the overlay
+# has grown to more than 1/compact_ratio of the main index's entries.
+# Each main index has a random generation in its footer, and an overlay
+# records the generation of the main index it belongs to, so that an
+# overlay left behind when the main index is replaced is ignored.
+OVERLAY_SUFFIX = '.overlay'
+compact_ratio = 8
+
 class Error(Exception):
     pass
 
@@ -343,6 +356,8 @@ class ExistingEntry(Entry):
         self.parent = parent
         self._m = m
         self._ofs = ofs
+        # The (base, overlay) entries for this name, when it's in both.
+        self._pair = None
         (self.dev, self.ino, self.nlink,
          self.ctime, ctime_ns, self.mtime, mtime_ns, self.atime, atime_ns,
          self.size, self.mode, self.gitmode, self.sha,
@@ -376,10 +391,7 @@ class ExistingEntry(Entry):
             self.parent.invalidate()
             self.parent.repack()
 
-    def iter(self, name=None, wantrecurse=None):
-        dname = name
-        if dname and not dname.endswith('/'):
-            dname += '/'
+    def _raw_children(self, parent):
         ofs = self.children_ofs
         assert(ofs <= len(self._m))
         assert(self.children_n <= UINT_MAX)  # i.e. python struct 'I'
@@ -389,8 +401,22 @@ class ExistingEntry(Entry):
             assert(eon >= ofs)
             assert(eon > ofs)
             basename = str(buffer(self._m, ofs, eon-ofs))
-            child = ExistingEntry(self, basename, self.name + basename,
-                                  self._m, eon+1)
+            yield ExistingEntry(parent, basename, parent.name + basename,
+                                self._m, eon+1)
+            ofs = eon + 1 + ENTLEN
+
+    def _children(self):
+        if not self._pair:
+            return self._raw_children(self)
+        (base, over) = self._pair
+        return _merged_children(base._raw_children(self),
+                                over._raw_children(self))
+
+    def iter(self, name=None, wantrecurse=None):
+        dname = name
+        if dname and not dname.endswith('/'):
+            dname += '/'
+        for child in self._children():
             if (not dname
                  or child.name.startswith(dname)
                  or child.name.endswith('/') and dname.startswith(child.name)):
@@ -399,46 +425,103 @@ class ExistingEntry(Entry):
                         yield e
             if not name or child.name == name or child.name.startswith(dname):
                 yield child
-            ofs = eon + 1 + ENTLEN
 
     def __iter__(self):
         return self.iter()
             
 
+def _visible(base, over):
+    # The entry presented for a name that's in both the base index and
+    # its overlay; the overlay's wins unless it's just a placeholder
+    # for the directories leading to its entries.  Either way, the
+    # children of both are presented beneath it.
+    e = base if over.is_fake() else over
+    e._pair = (base, over)
+    return e
+
+
+def _merged_children(base, over):
+    # Merge the (reverse sorted) children of the same directory from
+    # the base index and from its overlay.
+    b = next(base, None)
+    o = next(over, None)
+    while b or o:
+        if not o or (b and b.name > o.name):
+            yield b
+            b = next(base, None)
+        elif not b or o.name > b.name:
+            yield o
+            o = next(over, None)
+        else:
+            yield _visible(b, o)
+            b = next(base, None)
+            o = next(over, None)
+
+
 class Reader:
-    def __init__(self, filename):
+    """An index file, together with its overlay (filename + '.overlay')
+    if there is one.  The entries from both are presented as a single
+    index, in which each entry belongs to (and is repacked into) the
+    file it came from."""
+
+    def __init__(self, filename, overlay=True):
         self.filename = filename
+        self.overlay = None
+        while True:
+            st = self._open()
+            if not overlay:
+                break
+            r = Reader(filename + OVERLAY_SUFFIX, overlay=False)
+            # If the main index was replaced (i.e. compacted) while we
+            # were opening the overlay, the two may not belong together.
+            if _file_id(filename) == (st and (st.st_dev, st.st_ino)):
+                break
+            r.close()
+            self.close()
+        if overlay:
+            if r.m and r.generation == self.generation:
+                self.overlay = r
+            else:
+                r.close()
+
+    def _open(self):
+        # Open the index file (without its overlay), and return its
+        # stat, or None if it doesn't exist.
         self.m = ''
         self.writable = False
         self.count = 0
+        self.generation = None
         f = None
         try:
-            f = open(filename, 'r+')
+            f = open(self.filename, 'r+')
         except IOError as e:
             if e.errno == errno.ENOENT:
-                pass
-            else:
-                raise
-        if f:
-            b = f.read(len(INDEX_HDR))
-            if b != INDEX_HDR:
-                log('warning: %s: header: expected %r, got %r\n'
-                                 % (filename, INDEX_HDR, b))
-            else:
-                st = os.fstat(f.fileno())
-                if st.st_size:
-                    self.m = mmap_readwrite(f)
-                    self.writable = True
-                    self.count = struct.unpack(FOOTER_SIG,
-                          str(buffer(self.m, st.st_size-FOOTLEN, FOOTLEN)))[0]
+                return None
+            raise
+        st = os.fstat(f.fileno())
+        b = f.read(len(INDEX_HDR))
+        if b != INDEX_HDR:
+            log('warning: %s: header: expected %r, got %r\n'
+                             % (self.filename, INDEX_HDR, b))
+        elif st.st_size:
+            self.m = mmap_readwrite(f)
+            self.writable = True
+            (self.generation, self.count) = \
+                struct.unpack(FOOTER_SIG,
+                              str(buffer(self.m, st.st_size-FOOTLEN, FOOTLEN)))
+        return st
 
     def __del__(self):
         self.close()
 
     def __len__(self):
-        return int(self.count)
+        n = int(self.count)
+        if self.overlay:
+            n += len(self.overlay)
+        return n
 
     def forward_iter(self):
+        # Just this file's entries (not the overlay's), in file order.
         ofs = len(INDEX_HDR)
         while ofs+ENTLEN <= len(self.m)-FOOTLEN:
             eon = self.m.find('\0', ofs)
@@ -449,13 +532,25 @@ class Reader:
             yield ExistingEntry(None, basename, basename, self.m, eon+1)
             ofs = eon + 1 + ENTLEN
 
+    def _root(self):
+        if self.m and len(self.m) > len(INDEX_HDR)+ENTLEN:
+            return ExistingEntry(None, '/', '/',
+                                 self.m, len(self.m)-FOOTLEN-ENTLEN)
+        return None
+
+    def root(self):
+        base = self._root()
+        over = self.overlay and self.overlay._root()
+        if base and over:
+            return _visible(base, over)
+        return base or over
+
     def iter(self, name=None, wantrecurse=None):
-        if len(self.m) > len(INDEX_HDR)+ENTLEN:
+        root = self.root()
+        if root:
             dname = name
             if dname and not dname.endswith('/'):
                 dname += '/'
-            root = ExistingEntry(None, '/', '/',
-                                 self.m, len(self.m)-FOOTLEN-ENTLEN)
             for sub in root.iter(name=name, wantrecurse=wantrecurse):
                 yield sub
             if not dname or dname == root.name:
@@ -470,11 +565,13 @@ class Reader:
                     None)
 
     def exists(self):
-        return self.m
+        return self.m or (self.overlay and self.overlay.m)
 
     def save(self):
         if self.writable and self.m:
             self.m.flush()
+        if self.overlay:
+            self.overlay.save()
 
     def close(self):
         self.save()
@@ -482,6 +579,9 @@ class Reader:
             self.m.close()
             self.m = None
             self.writable = False
+        if self.overlay:
+            self.overlay.close()
+            self.overlay = None
 
     def filter(self, prefixes, wantrecurse=None):
         for (rp, path) in reduce_paths(prefixes):
@@ -500,6 +600,60 @@ class Reader:
                 name = path + pe.name[len(rp):]
                 yield (name, pe)
 
+class DirListings:
+    """Find the index entries for directories, and the names of their
+    (existing) entries, remembering the directories leading to the
+    last one requested, so that a depth-first traversal only reads
+    each directory's entries once."""
+
+    def __init__(self, reader):
+        self._reader = reader
+        # [(basename, entry, names, {subdir basename: entry})]
+        self._stack = []
+
+    def _push(self, basename, e):
+        names = []
+        subdirs = {}
+        for child in e.iter(wantrecurse=lambda x: False):
+            if child.exists():
+                if child.basename.endswith('/'):
+                    names.append(child.basename[:-1])
+                    subdirs[child.basename] = child
+                else:
+                    names.append(child.basename)
+        self._stack.append((basename, e, names, subdirs))
+
+    def _find(self, path):
+        parts = pathsplit(path)
+        stack = self._stack
+        i = 0
+        while i < len(stack) and i < len(parts) and stack[i][0] == parts[i]:
+            i += 1
+        del stack[i:]
+        if not stack:
+            root = self._reader.root()
+            if not root or parts[0] != '/':
+                return None
+            self._push('/', root)
+        for part in parts[len(stack):]:
+            e = stack[-1][3].get(part)
+            if not e:
+                return None
+            self._push(part, e)
+        return stack[-1]
+
+    def entry(self, path):
+        """Return the entry for the directory path, or None."""
+        found = self._find(path)
+        return found and found[1]
+
+    def names(self, path):
+        """Return the names of the existing entries recorded for the
+        directory path (without any trailing '/'), or None."""
+        found = self._find(path)
+        return found and found[2]
+
+
 # FIXME: this function isn't very generic, because it splits the filename
 # in an odd way and depends on a terminating '/' to indicate directories.
 def pathsplit(p):
@@ -512,10 +666,16 @@ def pathsplit(p):
 
 
 class Writer:
-    def __init__(self, filename, metastore, tmax):
+    def __init__(self, filename, metastore, tmax, generation=None):
+        """Write an index to filename.  The generation of an overlay
+        must be that of the main index it belongs to; a main index gets
+        a new random one by default."""
         self.rootlevel = self.level = Level([], None)
         self.f = None
         self.count = 0
+        if generation is None:
+            generation = struct.unpack('!Q', os.urandom(8))[0]
+        self.generation = generation
         self.lastfile = None
         self.filename = None
         self.filename = filename = resolve_parent(filename)
@@ -543,7 +703,7 @@ class Writer:
             self.count = self.rootlevel.count
             if self.count:
                 self.count += 1
-            self.f.write(struct.pack(FOOTER_SIG, self.count))
+            self.f.write(struct.pack(FOOTER_SIG, self.generation, self.count))
             self.f.flush()
         assert(self.level == None)
 
@@ -649,3 +809,306 @@ def merge(*iters):
     def pfinal(count, total):
         progress('bup: merging indexes (%d/%d), done.\n' % (count, total))
     return merge_iter(iters, 1024, pfunc, pfinal, key='name')
+
+
+def add_to_overlay(reader, new, metastore, tmax):
+    """Merge the entries of the reader new into the overlay of the
+    index open as reader, leaving the main index file untouched."""
+    assert(reader.generation is not None)
+    w = Writer(reader.filename + OVERLAY_SUFFIX, metastore, tmax,
+               generation=reader.generation)
+    try:
+        for e in merge(*([reader.overlay, new] if reader.overlay
+                         else [new])):
+            w.add_ixentry(e)
+    except:
+        w.abort()
+        raise
+    w.close()
+
+
+def wants_compaction(reader, droppable=0):
+    """Return true if the index open as reader should be compacted,
+    given that it has (at least) droppable entries compact() would
+    drop."""
+    over = len(reader.overlay) if reader.overlay else 0
+    return (over + droppable) * compact_ratio > int(reader.count)
+
+
+def droppable(e):
+    """Return true if e is deleted, or beneath a deleted directory,
+    and the directory containing that deletion has been saved since
+    (i.e. the deleted entries can't matter to any save)."""
+    while e.parent:
+        if e.is_deleted() and e.parent.is_valid():
+            return True
+        e = e.parent
+    return False
+
+
+def compact(filename, metastore, tmax):
+    """Rewrite the index filename to include its overlay's entries,
+    without the droppable() ones, and remove the overlay.  The new
+    index has a new generation, so the old overlay no longer applies
+    even if it can't be removed (e.g. after a crash)."""
+    r = Reader(filename)
+    w = Writer(filename, metastore, tmax)
+    try:
+        for e in r:
+            if not droppable(e):
+                w.add_ixentry(e)
+    except:
+        w.abort()
+        r.close()
+        raise
+    r.close()
+    w.close()
+    try:
+        os.unlink(filename + OVERLAY_SUFFIX)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def _file_id(filename):
+    try:
+        st = os.stat(filename)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    return (st.st_dev, st.st_ino)
+
+
+def _file_stamp(filename):
+    try:
+        st = xstat.stat(filename)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+
+def _index_stamp(filename):
+    base = _file_stamp(filename)
+    return base and (base, _file_stamp(filename + OVERLAY_SUFFIX))
+
+
+def _write_stamp(port, stamp):
+    if stamp is None:
+        vint.write_vuint(port, 0)
+    else:
+        vint.write_vuint(port, len(stamp))
+        for x in stamp:
+            vint.write_vint(port, x)
+
+
+def _read_stamp(port):
+    n = vint.read_vuint(port)
+    if not n:
+        return None
+    return tuple(vint.read_vint(port) for i in xrange(n))
+
+
+class DirtyCounts:
+    """Per-directory counts of the index entries a "bup save" still
+    has to visit, recorded by "bup index" for each path it updated so
+    that "bup save --progress" doesn't have to pre-scan the index.
+
+    For every directory under an indexed top, the counts cover the
+    directory itself and its non-directory children: the number of
+    entries save's pre-scan would see, and the bytes of those which
+    exist but aren't hash-valid.  Each top's overall totals are kept
+    too, and its directories' counts are only decoded when a path
+    beneath the top is asked for, so totals() for the indexed paths
+    themselves doesn't depend on the number of directories.  The
+    counts are only trusted while the index file is exactly the one
+    they were computed from."""
+
+    def __init__(self, filename, indexfile):
+        self._filename = filename
+        self._indexfile = indexfile
+        # Map each indexed top to (bytes, files, dirs), where dirs is
+        # {dir: (bytes, files)}, or its encoding (see _dirs()).
+        self._tops = {}
+        # The top being counted by begin()/add()/end(), the counts for
+        # its finished directories (in the order they finished), and
+        # the counts for the rest of them, by directory.
+        self._top = None
+        self._done = None
+        self._pending = None
+        try:
+            f = open(filename, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        if not data.startswith(DIRTY_HDR):
+            return
+        try:
+            tops = self._unpacked(BytesIO(data[len(DIRTY_HDR):]))
+        except EOFError:
+            return
+        if tops is not None:
+            self._tops = tops
+
+    def _unpacked(self, port):
+        # Return the tops in port, or None if they're out of date.
+        base = _read_stamp(port)
+        over = _read_stamp(port)
+        if not base or (base, over) != _index_stamp(self._indexfile):
+            return None
+        tops = {}
+        for i in xrange(vint.read_vuint(port)):
+            top = vint.read_bvec(port)
+            nbytes = vint.read_vuint(port)
+            nfiles = vint.read_vuint(port)
+            n = vint.read_vuint(port)
+            dirs = port.read(n)
+            if len(dirs) != n:
+                raise EOFError()
+            tops[top] = (nbytes, nfiles, dirs)
+        return tops
+
+    def _dirs(self, top):
+        # Return top's {dir: (bytes, files)}, decoding it if necessary.
+        (nbytes, nfiles, dirs) = self._tops[top]
+        if isinstance(dirs, bytes):
+            port = BytesIO(dirs)
+            dirs = {}
+            for j in xrange(vint.read_vuint(port)):
+                d = vint.read_bvec(port)
+                dbytes = vint.read_vuint(port)
+                dirs[d] = (dbytes, vint.read_vuint(port))
+            self._tops[top] = (nbytes, nfiles, dirs)
+        return dirs
+
+    def forget(self, top):
+        """Drop the counts for top, and for any top it overlaps."""
+        for t in list(self._tops):
+            if t.startswith(top) or top.startswith(t):
+                del self._tops[t]
+
+    def begin(self, top):
+        """Start replacing the counts for top (and for any top it
+        overlaps).  Each entry beneath top must then be passed to
+        add(), in index order (i.e. with everything beneath a
+        directory before the directory), followed by a call to end()."""
+        self.forget(top)
+        self._top = top
+        self._done = []
+        self._pending = {}
+
+    def add(self, name, size, exists, valid):
+        """Count the entry name (see begin()) in its final state."""
+        if not name.endswith('/'):
+            key = name[:name.rindex('/') + 1]
+            (nbytes, nfiles) = self._pending.get(key, (0, 0))
+            if exists and not valid:
+                nbytes += size
+            self._pending[key] = (nbytes, nfiles + 1)
+            return
+        # Everything beneath the directory has been added.
+        (nbytes, nfiles) = self._pending.pop(name, (0, 0))
+        if valid:
+            # Save won't look beneath it.
+            done = self._done
+            while done and done[-1][0].startswith(name):
+                done.pop()
+            (nbytes, nfiles) = (0, 0)
+        elif exists:
+            nbytes += size
+        self._done.append((name, (nbytes, nfiles + 1)))
+
+    def end(self):
+        """Finish the counts started by begin()."""
+        dirs = dict(self._pending)
+        dirs.update(self._done)
+        self._tops[self._top] = (sum(b for (b, n) in dirs.itervalues()),
+                                 sum(n for (b, n) in dirs.itervalues()),
+                                 dirs)
+        self._top = self._done = self._pending = None
+
+    def count(self, reader, top):
+        """Replace the counts for top (and for any top it overlaps)
+        with fresh ones from reader."""
+        self.begin(top)
+        for e in reader.iter(name=top, wantrecurse=lambda e: not e.is_valid()):
+            self.add(e.name, e.size, e.exists(), e.is_valid())
+        self.end()
+
+    def totals(self, paths):
+        """Return the (bytes, files) a save of paths would have to
+        visit, or None if some path isn't covered by the counts."""
+        total = ftotal = 0
+        for (rp, path) in reduce_paths(paths):
+            if not rp.endswith('/'):
+                return None
+            top = next((t for t in self._tops
+                        if t.endswith('/') and rp.startswith(t)),
+                       None)
+            if top is None:
+                return None
+            (nbytes, nfiles, dirs) = self._tops[top]
+            if rp != top:
+                nbytes = nfiles = 0
+                for (d, (b, n)) in self._dirs(top).iteritems():
+                    if d.startswith(rp):
+                        nbytes += b
+                        nfiles += n
+            total += nbytes
+            # Reader.filter() always yields at least the top.
+            ftotal += max(nfiles, 1)
+        return (total, ftotal)
+
+    def save(self):
+        """Write the counts, tagged with the current state of the
+        index file."""
+        (dir, name) = os.path.split(self._filename)
+        (ffd, tmpname) = tempfile.mkstemp('.tmp', name, dir)
+        try:
+            f = os.fdopen(ffd, 'wb', 65536)
+        except:
+            os.close(ffd)
+            os.unlink(tmpname)
+            raise
+        try:
+            try:
+                f.write(DIRTY_HDR)
+                stamp = _index_stamp(self._indexfile)
+                _write_stamp(f, stamp and stamp[0])
+                _write_stamp(f, stamp and stamp[1])
+                vint.write_vuint(f, len(self._tops))
+                for (top, (nbytes, nfiles, dirs)) in self._tops.iteritems():
+                    vint.write_bvec(f, top)
+                    vint.write_vuint(f, nbytes)
+                    vint.write_vuint(f, nfiles)
+                    if not isinstance(dirs, bytes):
+                        port = BytesIO()
+                        vint.write_vuint(port, len(dirs))
+                        for (d, (dbytes, dfiles)) in dirs.iteritems():
+                            vint.write_bvec(port, d)
+                            vint.write_vuint(port, dbytes)
+                            vint.write_vuint(port, dfiles)
+                        dirs = port.getvalue()
+                    vint.write_bvec(f, dirs)
+            finally:
+                f.close()
+            os.rename(tmpname, self._filename)
+        except:
+            os.unlink(tmpname)
+            raise
+
+    def clear(self):
+        """Forget the counts, i.e. before modifying the index."""
+        self._tops = {}
+        try:
+            os.unlink(self._filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,518 @@
+"""Journal of the paths that change beneath watched directories.
+
+"bup index --watch" uses Linux inotify to record each changed path in
+a journal next to the index, and "bup index --from-journal" re-stats
+just those paths (and the directories leading to them) instead of
+walking everything.  The journal is only trusted while a watcher is
+running for the indexed paths, and not after the kernel reports that
+events were dropped (an "overflow").
+"""
+
+from __future__ import absolute_import
+import errno, fcntl, os, stat, struct
+
+from bup import _helpers, drecurse, xstat
+from bup.helpers import add_error, debug1, should_rx_exclude_path
+
+
+# Each record is a kind character followed by a path and a NUL.
+CHANGED = 'p'    # the path (or the directory itself) changed
+ADDED_DIR = 'r'  # a directory appeared; everything beneath it is new
+OVERFLOW = 'o'   # changes may have been missed (no path)
+
+# Records describing the watcher, in filename.lock.
+_WATCHED = 'w'
+_EXCLUDED = 'x'
+_EXCLUDED_RX = 'X'
+_XDEV = 'd'
+_END = 'e'
+
+_watch_mask = (getattr(_helpers, 'IN_MODIFY', 0)
+               | getattr(_helpers, 'IN_ATTRIB', 0)
+               | getattr(_helpers, 'IN_CLOSE_WRITE', 0)
+               | getattr(_helpers, 'IN_MOVED_FROM', 0)
+               | getattr(_helpers, 'IN_MOVED_TO', 0)
+               | getattr(_helpers, 'IN_CREATE', 0)
+               | getattr(_helpers, 'IN_DELETE', 0)
+               | getattr(_helpers, 'IN_ONLYDIR', 0)
+               | getattr(_helpers, 'IN_DONT_FOLLOW', 0))
+
+_event_hdr = struct.Struct('iIII')  # struct inotify_event
+
+
+class Error(Exception):
+    pass
+
+
+def have_inotify():
+    return hasattr(_helpers, 'inotify_init')
+
+
+def _unslash(path):
+    return path.rstrip('/') or '/'
+
+
+def _dirname(path):
+    # The index's name for the directory path.
+    return path if path.endswith('/') else path + '/'
+
+
+def _beneath(path, top):
+    # Whether the (unslashed) path is top or inside it.
+    return path == _unslash(top) or (top.endswith('/')
+                                     and path.startswith(top))
+
+
+def encode_records(records):
+    return ''.join('%s%s\0' % (kind, path) for (kind, path) in records)
+
+
+def decode_records(data):
+    """Return the (kind, path) records in data, ignoring any trailing
+    partial record."""
+    return [(r[:1], r[1:]) for r in data.split('\0')[:-1]]
+
+
+def _write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+class WatchInfo:
+    """What a watcher reported watching: the resolved top paths, and
+    the exclusions it applied."""
+    def __init__(self, paths, excluded_paths, exclude_rx_patterns, xdev):
+        self.paths = paths
+        self.excluded_paths = excluded_paths
+        self.exclude_rx_patterns = exclude_rx_patterns
+        self.xdev = xdev
+
+    def encode(self):
+        records = [(_WATCHED, p) for p in self.paths]
+        records.extend((_EXCLUDED, p) for p in self.excluded_paths)
+        records.extend((_EXCLUDED_RX, p) for p in self.exclude_rx_patterns)
+        if self.xdev:
+            records.append((_XDEV, ''))
+        records.append((_END, ''))
+        return encode_records(records)
+
+    @staticmethod
+    def decode(data):
+        records = decode_records(data)
+        if not records or records[-1] != (_END, ''):
+            return None  # not (completely) written yet
+        select = lambda kind: [p for (k, p) in records if k == kind]
+        return WatchInfo(select(_WATCHED), select(_EXCLUDED),
+                         select(_EXCLUDED_RX), bool(select(_XDEV)))
+
+    def unwatched_reason(self, top, excluded_paths, exclude_rxs, xdev):
+        """Return None if this watcher sees every change that an index
+        update of top with the given options would, or else why not."""
+        # Both top and the watched paths are resolved, and end with
+        # '/' when they're directories.
+        if not any(top == p or (p.endswith('/') and top.startswith(p))
+                   for p in self.paths):
+            return '%r is not being watched' % top
+        if not set(self.excluded_paths) <= set(excluded_paths or ()):
+            return 'the watcher was given other --exclude paths'
+        patterns = set(rx.pattern for rx in exclude_rxs or ())
+        if not set(self.exclude_rx_patterns) <= patterns:
+            return 'the watcher was given other --exclude-rx patterns'
+        if self.xdev and not xdev:
+            return 'the watcher was given --xdev'
+        return None
+
+
+class Journal:
+    """The change journal filename (normally BUP_DIR/bupindex.journal),
+    along with filename.claimed, which holds the records taken from it
+    by an index update until that update finishes, and filename.lock,
+    which a running watcher holds locked (and describes)."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.claimed_name = filename + '.claimed'
+        self.lock_name = filename + '.lock'
+        self._lockf = None
+        self.records = []
+        self.overflowed = False
+        self.watch_info = None
+
+    # The watcher's side.
+
+    def start_watching(self, info):
+        """Lock the journal for a new watcher described by info, or
+        raise Error if another watcher holds it."""
+        f = open(self.lock_name, 'a+')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            f.close()
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                raise Error('%r already has a watcher' % self.filename)
+            raise
+        f.truncate(0)
+        f.write(info.encode())
+        f.flush()
+        self._lockf = f
+        # Anything that changed before the watches are in place is
+        # unknown.
+        self.append([(OVERFLOW, '')])
+
+    def stop_watching(self):
+        if self._lockf:
+            self._lockf.close()
+            self._lockf = None
+
+    def append(self, records):
+        # Reopened each time, so that a journal removed by "bup index
+        # --clear" is recreated.
+        fd = os.open(self.filename, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            _write_all(fd, encode_records(records))
+        finally:
+            os.close(fd)
+
+    # The index update's side.
+
+    def _read_watch_info(self):
+        try:
+            f = open(self.lock_name, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        try:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return WatchInfo.decode(f.read())
+            return None  # No one's watching.
+        finally:
+            f.close()
+
+    def claim(self):
+        """Move the journaled records to filename.claimed (after any
+        left there by an unfinished update) and load all of them."""
+        self.watch_info = self._read_watch_info()
+        try:
+            fd = os.open(self.filename, os.O_RDWR)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            fd = None
+        if fd is not None:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                data = []
+                while True:
+                    b = os.read(fd, 1024 * 1024)
+                    if not b:
+                        break
+                    data.append(b)
+                data = ''.join(data)
+                end = data.rfind('\0') + 1
+                if end < len(data):
+                    # A watcher died mid-write.
+                    data = data[:end] + encode_records([(OVERFLOW, '')])
+                if data:
+                    f = open(self.claimed_name, 'ab')
+                    try:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    finally:
+                        f.close()
+                os.ftruncate(fd, 0)
+            finally:
+                os.close(fd)
+        try:
+            f = open(self.claimed_name, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            data = ''
+        else:
+            try:
+                data = f.read()
+            finally:
+                f.close()
+        self.records = decode_records(data)
+        self.overflowed = any(kind == OVERFLOW for (kind, p) in self.records)
+
+    def unusable_reason(self, top, excluded_paths, exclude_rxs, xdev):
+        """Return None if the claimed records account for every change
+        beneath top, or else the reason they don't."""
+        if not self.watch_info:
+            return 'no watcher is running'
+        if self.overflowed:
+            return 'the journal overflowed'
+        return self.watch_info.unwatched_reason(top, excluded_paths,
+                                                exclude_rxs, xdev)
+
+    def records_beneath(self, top):
+        return [(kind, path) for (kind, path) in self.records
+                if kind != OVERFLOW and _beneath(path, top)]
+
+    def finish(self, tops):
+        """Drop the claimed records that the completed updates of tops
+        account for, keeping the rest for later updates."""
+        keep = [(kind, path) for (kind, path) in self.records
+                if kind != OVERFLOW
+                and not any(_beneath(path, t) for t in tops)]
+        if self.overflowed:
+            info = self.watch_info
+            if not info or not all(any(p.startswith(t) for t in tops)
+                                   for p in info.paths):
+                keep.append((OVERFLOW, ''))
+        if not keep:
+            try:
+                os.unlink(self.claimed_name)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        else:
+            tmpname = self.claimed_name + '.tmp'
+            f = open(tmpname, 'wb')
+            try:
+                f.write(encode_records(keep))
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.rename(tmpname, self.claimed_name)
+        self.records = keep
+        self.overflowed = any(kind == OVERFLOW for (kind, p) in keep)
+
+
+def _excluded(name, bup_dir, excluded_paths, exclude_rxs):
+    # What drecurse's walk would skip (name ends with '/' for dirs).
+    if excluded_paths and os.path.normpath(name) in excluded_paths:
+        debug1('Skipping %r: excluded.\n' % name)
+        return True
+    if exclude_rxs and should_rx_exclude_path(name, exclude_rxs):
+        return True
+    if name.endswith('/') and bup_dir is not None \
+       and os.path.normpath(name) == bup_dir:
+        return True
+    return False
+
+
+class Changes:
+    """The paths beneath top that need re-indexing according to the
+    journal records, i.e. the recorded paths, the directories leading
+    to them, and everything beneath any added directory.  The
+    (path, stat) pairs are in paths, in the order recursive_dirlist()
+    would produce them."""
+
+    def __init__(self, top, records, xdev, bup_dir=None,
+                 excluded_paths=None, exclude_rxs=None,
+                 xdev_exceptions=frozenset(), jobs=1):
+        self._stats = {}
+        found = {}
+        # Unslashed paths whose index entries, if not found, are gone.
+        self._stale_names = set()
+        # Directories beneath which entries that weren't found are gone.
+        self._stale_dirs = set()
+        # Directories leading to something of interest.
+        self._ancestors = set()
+        t = top
+        while True:
+            self._ancestors.add(_dirname(t))
+            if t == '/':
+                break
+            t = os.path.dirname(_unslash(t))
+
+        try:
+            top_dev = self._lstat(_unslash(top)).st_dev
+        except OSError as e:
+            add_error('%s: %s' % (top, e))
+            top_dev = None
+            records = []
+        xdev = top_dev if xdev else None
+
+        for (kind, path) in records:
+            chain = [_unslash(top)]
+            if path != chain[0]:
+                parent = top
+                for part in path[len(top):].split('/'):
+                    chain.append(parent + part)
+                    parent = chain[-1] + '/'
+            for (i, p) in enumerate(chain):
+                last = i == len(chain) - 1
+                try:
+                    st = self._lstat(p)
+                except OSError as e:
+                    if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                        add_error('%s: %s' % (p, e))
+                        break
+                    self._stale_names.add(p)
+                    self._stale_dirs.add(_dirname(p))
+                    break
+                isdir = stat.S_ISDIR(st.st_mode)
+                name = _dirname(p) if isdir else p
+                if i and _excluded(name, bup_dir, excluded_paths, exclude_rxs):
+                    break
+                self._stale_names.add(p)
+                found[name] = st
+                if not isdir:
+                    self._stale_dirs.add(_dirname(p))
+                    break
+                if xdev is not None and st.st_dev != xdev \
+                   and name not in xdev_exceptions:
+                    break
+                if last:
+                    if kind == ADDED_DIR:
+                        self._stale_dirs.add(name)
+                        for (wp, wst) in drecurse.recursive_dirlist(
+                                [name], xdev=xdev is not None,
+                                bup_dir=bup_dir,
+                                excluded_paths=excluded_paths,
+                                exclude_rxs=exclude_rxs,
+                                xdev_exceptions=xdev_exceptions,
+                                jobs=jobs):
+                            found[wp] = wst
+                else:
+                    self._ancestors.add(name)
+        self.paths = sorted(found.iteritems(), reverse=True)
+
+    def _lstat(self, path):
+        st = self._stats.get(path)
+        if st is None:
+            st = self._stats[path] = xstat.lstat(path)
+        return st
+
+    def _under_stale_dir(self, name):
+        i = name.find('/')
+        while i >= 0:
+            if name[:i + 1] in self._stale_dirs:
+                return True
+            i = name.find('/', i + 1)
+        return False
+
+    def covers(self, name):
+        """Return true if the index entry name, absent from paths, no
+        longer exists."""
+        return _unslash(name) in self._stale_names \
+            or self._under_stale_dir(name)
+
+    def wantrecurse(self, e):
+        """Return true if the index's entries beneath e matter."""
+        return e.name in self._ancestors or self._under_stale_dir(e.name)
+
+
+def _read_events(fd):
+    buf = os.read(fd, 64 * 1024)
+    ofs = 0
+    while ofs < len(buf):
+        (wd, mask, cookie, n) = _event_hdr.unpack_from(buf, ofs)
+        ofs += _event_hdr.size
+        yield (wd, mask, buf[ofs:ofs + n].rstrip('\0'))
+        ofs += n
+
+
+class Watcher:
+    """Watch every directory beneath paths (as recursive_dirlist()
+    would find them), and append what changes to journal."""
+
+    def __init__(self, journal, paths, xdev, bup_dir=None,
+                 excluded_paths=None, exclude_rxs=None,
+                 xdev_exceptions=frozenset()):
+        self.journal = journal
+        self.paths = paths
+        self.xdev = xdev
+        self.bup_dir = bup_dir
+        self.excluded_paths = excluded_paths
+        self.exclude_rxs = exclude_rxs
+        self.xdev_exceptions = xdev_exceptions
+        self._fd = _helpers.inotify_init()
+        self._dirs = {}  # Map each watch descriptor to its directory.
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _add(self, path):
+        try:
+            wd = _helpers.inotify_add_watch(self._fd, path, _watch_mask)
+        except OSError as e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return  # Already gone; the parent's events cover it.
+            if e.errno == errno.ENOSPC:
+                raise Error('%s: too many directories to watch'
+                            ' (see fs.inotify.max_user_watches)' % path)
+            add_error(e)
+            return
+        self._dirs[wd] = path
+
+    def watch(self, path):
+        """Watch the directory path and everything beneath it."""
+        xdev = None
+        for (p, st) in drecurse.recursive_dirlist(
+                [path], xdev=self.xdev, bup_dir=self.bup_dir,
+                excluded_paths=self.excluded_paths,
+                exclude_rxs=self.exclude_rxs,
+                xdev_exceptions=self.xdev_exceptions):
+            if not stat.S_ISDIR(st.st_mode):
+                continue
+            if xdev is None:
+                xdev = xstat.lstat(path).st_dev
+            if self.xdev and st.st_dev != xdev \
+               and p not in self.xdev_exceptions:
+                continue
+            self._add(p)
+
+    def watch_all(self):
+        for path in self.paths:
+            if path.endswith('/'):
+                self.watch(path)
+            else:
+                self._add(os.path.dirname(path) + '/')
+
+    def _records(self, events):
+        records = []
+        seen = set()
+        overflowed = False
+        for (wd, mask, name) in events:
+            if mask & _helpers.IN_Q_OVERFLOW:
+                overflowed = True
+                continue
+            if mask & _helpers.IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            d = self._dirs.get(wd)
+            if d is None:
+                continue
+            path = d + name if name else _unslash(d)
+            if path.startswith(self.journal.filename):
+                continue
+            kind = CHANGED
+            if mask & _helpers.IN_ISDIR \
+               and mask & (_helpers.IN_CREATE | _helpers.IN_MOVED_TO):
+                name = path + '/'
+                if not _excluded(name, self.bup_dir, self.excluded_paths,
+                                 self.exclude_rxs):
+                    self.watch(name)
+                kind = ADDED_DIR
+            if (kind, path) not in seen:
+                seen.add((kind, path))
+                records.append((kind, path))
+        return records, overflowed
+
+    def run(self):
+        """Watch the paths and journal their changes, forever."""
+        self.watch_all()
+        self.journal.append([(OVERFLOW, '')])
+        while True:
+            records, overflowed = self._records(_read_events(self._fd))
+            if records:
+                self.journal.append(records)
+            if overflowed:
+                # Directories created in the meantime may be unwatched.
+                self.journal.append([(OVERFLOW, '')])
+                self.watch_all()
+                self.journal.append([(OVERFLOW, '')])
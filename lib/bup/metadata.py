@@ -10,7 +10,7 @@ from copy import deepcopy
 from errno import EACCES, EINVAL, ENOTTY, ENOSYS, EOPNOTSUPP
 from io import BytesIO
 from time import gmtime, strftime
-import errno, os, sys, stat, time, pwd, grp, socket, struct
+import errno, heapq, os, sys, stat, tempfile, time, pwd, grp, socket, struct
 
 from bup import vint, xstat
 from bup.drecurse import recursive_dirlist
@@ -904,6 +904,96 @@ def from_path(path, statinfo=None, archive_path=None,
     return result
 
 
+# How many entries a MetadataSpool keeps in memory before spilling
+# them to a temporary file.
+spool_max_entries = 100000
+
+
+class _IterReader:
+    # Just enough of a file to hand a stream of strings to hashsplit.
+    def __init__(self, it):
+        self._it = it
+        self._buf = ''
+
+    def read(self, size=-1):
+        parts = [self._buf]
+        n = len(self._buf)
+        while size < 0 or n < size:
+            b = next(self._it, None)
+            if b is None:
+                break
+            parts.append(b)
+            n += len(b)
+        data = ''.join(parts)
+        if size < 0:
+            self._buf = ''
+            return data
+        self._buf = data[size:]
+        return data[:size]
+
+
+class MetadataSpool:
+    """Collect the content of a directory's .bupm: the directory's
+    own metadata, followed by that of each of its entries in sort_key
+    order.  At most max_entries encoded entries are held in memory;
+    beyond that, sorted runs are written to temporary files and
+    merged when the .bupm is read."""
+
+    def __init__(self, dir_meta, max_entries=None):
+        self.dir_meta = dir_meta
+        self._max_entries = max_entries or spool_max_entries
+        self._pending = []
+        self._runs = []
+        self._count = 0
+
+    def append(self, sort_key, meta):
+        # The sequence number keeps the sort stable for equal keys.
+        self._pending.append((sort_key, self._count, meta.encode()))
+        self._count += 1
+        if len(self._pending) >= self._max_entries:
+            self._spill()
+
+    def _spill(self):
+        self._pending.sort()
+        f = tempfile.TemporaryFile()
+        try:
+            for (sort_key, seq, encoded) in self._pending:
+                vint.write_bvec(f, sort_key)
+                vint.write_vuint(f, seq)
+                vint.write_bvec(f, encoded)
+            f.seek(0)
+        except:
+            f.close()
+            raise
+        self._runs.append((f, len(self._pending)))
+        self._pending = []
+
+    def _read_run(self, f, n):
+        for i in xrange(n):
+            sort_key = vint.read_bvec(f)
+            seq = vint.read_vuint(f)
+            yield (sort_key, seq, vint.read_bvec(f))
+
+    def encoded(self):
+        """Yield the encoded .bupm, a piece at a time."""
+        yield self.dir_meta.encode()
+        self._pending.sort()
+        runs = [self._read_run(f, n) for (f, n) in self._runs]
+        for (sort_key, seq, encoded) in heapq.merge(self._pending, *runs):
+            yield encoded
+
+    def reader(self):
+        """Return a readable file-like object for the encoded .bupm."""
+        return _IterReader(self.encoded())
+
+    def close(self):
+        runs = self._runs
+        self._runs = []
+        self._pending = []
+        for (f, n) in runs:
+            f.close()
+
+
 def save_tree(output_file, paths,
               recurse=False,
               write_paths=True,
@@ -1,6 +1,7 @@
 
 from __future__ import absolute_import
 from functools import partial
+from itertools import islice
 
 from bup import client, git
 
@@ -8,7 +9,7 @@ from bup import client, git
 class LocalRepo:
     def __init__(self, repo_dir=None):
         self.repo_dir = repo_dir or git.repo()
-        self._cp = git.cp(self.repo_dir)
+        self._cp = git.PackCatPipe(self.repo_dir)
         self.rev_list = partial(git.rev_list, repo_dir=self.repo_dir)
 
     def cat(self, ref):
@@ -25,6 +26,30 @@ class LocalRepo:
                 yield data
         assert not next(it, None)
 
+    def cat_many(self, refs):
+        """Yield (oidx, type, size, data_it) for each ref in refs, in
+        order, or (None, None, None, None) if a ref does not exist.
+        Any data left unread in data_it is discarded when the next
+        item is requested.
+
+        """
+        return self._cp.get_many(refs)
+
+    def cat_info(self, ref):
+        """Return (oidx, type, size) for ref, or (None, None, None) if
+        it does not exist, without reading the object's data.
+
+        """
+        return self._cp.get_info(ref)
+
+    def cat_info_many(self, refs):
+        """Return a list of (oidx, type, size) for each ref in refs, in
+        order, with (None, None, None) for any ref that does not
+        exist, without reading the objects' data.
+
+        """
+        return list(self._cp.get_info_many(refs))
+
     def join(self, ref):
         return self._cp.join(ref)
 
@@ -36,6 +61,8 @@ class LocalRepo:
             yield ref
 
 class RemoteRepo:
+    cat_many_batch = 128
+
     def __init__(self, address):
         self.address = address
         self.client = client.Client(address)
@@ -59,6 +86,53 @@ class RemoteRepo:
                 yield data
         assert not next(items, None)
 
+    def cat_many(self, refs):
+        """Yield (oidx, type, size, data_it) for each ref in refs, in
+        order, or (None, None, None, None) if a ref does not exist.
+        Any data left unread in data_it is discarded when the next
+        item is requested.
+
+        """
+        # Send the refs in bounded batches, and since the connection
+        # can't be used for anything else until a batch is finished,
+        # always read every reply, even if we're abandoned early.
+        refs = iter(refs)
+        while True:
+            batch = tuple(islice(refs, self.cat_many_batch))
+            if not batch:
+                break
+            items = self.client.cat_batch(batch)
+            data_it = None
+            try:
+                for oidx, typ, size, data_it in items:
+                    yield oidx, typ, size, data_it
+                    for ignored in data_it or ():
+                        pass
+            finally:
+                for ignored in data_it or ():
+                    pass
+                for oidx, typ, size, data_it in items:
+                    for ignored in data_it or ():
+                        pass
+
+    def cat_info(self, ref):
+        """Return (oidx, type, size) for ref, or (None, None, None) if
+        it does not exist, without reading the object's data.
+
+        """
+        items = self.client.cat_batch_check((ref,))
+        info = next(items)
+        assert not next(items, None)
+        return info
+
+    def cat_info_many(self, refs):
+        """Return a list of (oidx, type, size) for each ref in refs, in
+        order, with (None, None, None) for any ref that does not
+        exist, without reading the objects' data.
+
+        """
+        return list(self.client.cat_batch_check(tuple(refs)))
+
     def join(self, ref):
         return self.client.join(ref)
 
@@ -4,7 +4,7 @@ import sys, os, stat, time, random, subprocess, glob
 
 from wvtest import *
 
-from bup import client, git
+from bup import client, git, repo
 from bup.helpers import mkdirp
 from buptest import no_lingering_errors, test_tempdir
 
@@ -43,6 +43,59 @@ def test_server_split_with_indexes():
             rw.close()
     
 
+@wvtest
+def test_remote_cat_many():
+    with no_lingering_errors():
+        with test_tempdir('bup-tclient-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = '../../../bup'
+            os.environ['BUP_DIR'] = bupdir = tmpdir
+            git.init_repo(bupdir)
+            lw = git.PackWriter()
+            blobs = [str(i) * i for i in xrange(300)]
+            oidxs = [lw.new_blob(b).encode('hex') for b in blobs]
+            lw.close()
+            r = repo.RemoteRepo(bupdir)
+            items = list((oidx, typ, it and ''.join(it))
+                         for oidx, typ, size, it
+                         in r.cat_many(oidxs + ['0' * 40]))
+            WVPASSEQ(zip(oidxs, ['blob'] * len(blobs), blobs)
+                     + [(None, None, None)],
+                     items)
+            # Abandon a batch early; the connection must stay usable
+            items = r.cat_many(oidxs)
+            next(items)
+            items.close()
+            WVPASSEQ(blobs[3], ''.join(r.join(oidxs[3])))
+            WVPASSEQ((oidxs[3], 'blob', 3), r.cat_info(oidxs[3]))
+            WVPASSEQ((None, None, None), r.cat_info('0' * 40))
+            WVPASSEQ([(oidxs[3], 'blob', 3), (None, None, None),
+                      (oidxs[4], 'blob', 4)],
+                     r.cat_info_many(iter([oidxs[3], '0' * 40, oidxs[4]])))
+            # As if the server were too old for cat-batch-check
+            r.client._available_commands -= frozenset(['cat-batch-check'])
+            WVPASSEQ((oidxs[3], 'blob', 3), r.cat_info(oidxs[3]))
+            WVPASSEQ((None, None, None), r.cat_info('0' * 40))
+            WVPASSEQ([(oidxs[3], 'blob', 3), (None, None, None)],
+                     r.cat_info_many([oidxs[3], '0' * 40]))
+            WVPASSEQ(blobs[4], ''.join(r.join(oidxs[4])))
+
+
+@wvtest
+def test_remote_config_get():
+    with no_lingering_errors():
+        with test_tempdir('bup-tclient-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = '../../../bup'
+            os.environ['BUP_DIR'] = bupdir = tmpdir
+            git.init_repo(bupdir, config={'bup.split.chunker': 'fastcdc'})
+            c = client.Client(bupdir)
+            WVPASSEQ('fastcdc\n', c.config_get('bup.split.chunker'))
+            WVPASSEQ(None, c.config_get('bup.no-such-setting'))
+            c.close()
+            WVEXCEPT(git.GitError, git.init_repo, bupdir,
+                     config={'bup.split.chunker': 'bupsplit'})
+            git.init_repo(bupdir, config={'bup.split.chunker': 'fastcdc'})
+
+
 @wvtest
 def test_multiple_suggestions():
     with no_lingering_errors():
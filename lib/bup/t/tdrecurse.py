@@ -0,0 +1,33 @@
+
+from __future__ import absolute_import
+import os
+
+from wvtest import *
+
+from bup import drecurse
+from bup.helpers import mkdirp
+from buptest import no_lingering_errors, test_tempdir
+
+
+@wvtest
+def test_listing_opens_relative_to_parent():
+    with no_lingering_errors():
+        with test_tempdir('bup-tdrecurse-') as tmpdir:
+            mkdirp(tmpdir + '/a/sub')
+            open(tmpdir + '/a/sub/mine', 'w').close()
+            mkdirp(tmpdir + '/other/sub')
+            open(tmpdir + '/other/sub/theirs', 'w').close()
+            parent = drecurse._Listing(tmpdir + '/a/')
+            parent.run()
+            WVPASSEQ([n for n, st in parent.result()], ['sub/'])
+            # Replace a/ with a symlink before its subdirectory is
+            # listed; the listing should still be of the original.
+            os.rename(tmpdir + '/a', tmpdir + '/a.old')
+            os.symlink('other', tmpdir + '/a')
+            sub = drecurse._Listing(tmpdir + '/a/sub/', parent=parent)
+            sub.run()
+            if drecurse._openat:
+                WVPASSEQ([n for n, st in sub.result()], ['mine'])
+            parent.close()
+            sub.close()
+            WVPASSEQ(None, parent.dir)
@@ -1,7 +1,7 @@
 
 from __future__ import absolute_import
 from subprocess import check_call
-import struct, os, time
+import glob, random, re, struct, os, sys, time
 
 from wvtest import *
 
@@ -106,6 +106,8 @@ def testpacks():
             print repr(nameprefix)
             WVPASS(os.path.exists(nameprefix + '.pack'))
             WVPASS(os.path.exists(nameprefix + '.idx'))
+            # Checks both the pack and idx checksums
+            exc('git', 'verify-pack', nameprefix + '.idx')
 
             r = git.open_idx(nameprefix + '.idx')
             print repr(r.fanout)
@@ -127,6 +129,39 @@ def testpacks():
             WVFAIL(r.exists('\0'*20))
 
 
+@wvtest
+def test_threaded_pack_writer():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            blobs = [os.urandom(i * 37) for i in xrange(300)]
+            packs = []
+            for threads, background in ((None, False), (None, True),
+                                        (4, True)):
+                bupdir = '%s/bup-%s-%s' % (tmpdir, threads, background)
+                os.environ['BUP_DIR'] = bupdir
+                git.init_repo(bupdir)
+                finished = []
+                w = git.PackWriter(threads=threads, max_pack_objects=100,
+                                   finish_in_background=background,
+                                   on_pack_finish=finished.append)
+                shas = [w.new_blob(b) for b in blobs]
+                WVPASSEQ(git.calc_hash('blob', blobs[7]), shas[7])
+                # Already written, even if their pack isn't finished yet
+                for b in blobs[::-1]:
+                    w.new_blob(b)
+                w.close()
+                names = sorted(glob.glob(bupdir + '/objects/pack/*.pack'))
+                WVPASSEQ(3, len(names))
+                WVPASSEQ(sorted(n[:-5] for n in names), sorted(finished))
+                packs.append([(os.path.basename(n), open(n).read())
+                              for n in names])
+                exc('git', '--git-dir', bupdir, 'fsck')
+            # Same objects in the same order, so the same packs
+            WVPASS(packs[0] == packs[1])
+            WVPASS(packs[0] == packs[2])
+
+
 @wvtest
 def test_pack_name_lookup():
     with no_lingering_errors():
@@ -170,10 +205,11 @@ def test_long_index():
                     0x22334455, 0x66778899, 0x00112233, 0x44556677, 0x88990011)
             pack_bin = struct.pack('!IIIII',
                     0x99887766, 0x55443322, 0x11009988, 0x77665544, 0x33221100)
-            idx = list(list() for i in xrange(256))
-            idx[0].append((obj_bin, 1, 0xfffffffff))
-            idx[0x11].append((obj2_bin, 2, 0xffffffffff))
-            idx[0x22].append((obj3_bin, 3, 0xff))
+            idx = bytearray()
+            for entry in ((obj3_bin, 3, 0xff),
+                          (obj_bin, 1, 0xfffffffff),
+                          (obj2_bin, 2, 0xffffffffff)):
+                idx.extend(git._idx_entry.pack(*entry))
             w.count = 3
             name = tmpdir + '/tmp.idx'
             r = w._write_pack_idx_v2(name, idx, pack_bin)
@@ -442,3 +478,140 @@ def test_cat_pipe():
             for buf in it.next():
                 pass
             WVPASSEQ((oidx, typ, size), get_info)
+
+
+@wvtest
+def test_pack_cat_pipe():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            w = git.PackWriter()
+            base = ''.join(str(i) for i in xrange(5000))
+            oids = [w.new_blob(base + str(i)) for i in xrange(20)]
+            oids.append(w.new_blob(''))
+            oids.append(w.new_tree([(0o100644, str(i), oid)
+                                    for i, oid in enumerate(oids)]))
+            now = int(time.time())
+            oids.append(w.new_commit(oids[-1], None, 'a <a@b>', now, None,
+                                     'a <a@b>', now, None, 'msg'))
+            w.close()
+            # Make sure repack doesn't drop everything as unreachable
+            git.update_ref('refs/heads/src', oids[-1], None)
+
+            def check_all(desc):
+                pcp = git.PackCatPipe(bupdir)
+                for oid in oids:
+                    oidx = oid.encode('hex')
+                    expected = list(git.cp().get(oidx))
+                    actual = list(pcp.get(oidx))
+                    WVPASSEQ((desc, expected[0]), (desc, actual[0]))
+                    WVPASSEQ(''.join(expected[1:]), ''.join(actual[1:]))
+                    WVPASSEQ((desc, expected[0]), (desc, pcp.get_info(oidx)))
+                WVPASSEQ((None, None, None), next(pcp.get('0' * 40)))
+                WVPASSEQ((None, None, None), pcp.get_info('0' * 40))
+                WVPASSEQ(''.join(git.cp().join(oids[-1].encode('hex'))),
+                         ''.join(pcp.join('src')))
+
+            check_all('undeltified')
+            exc('git', '--git-dir', bupdir, 'repack', '-adf', '--window=50')
+            check_all('ofs-delta')
+            exc('git', '--git-dir', bupdir,
+                '-c', 'repack.useDeltaBaseOffset=false',
+                'repack', '-adf', '--window=50')
+            check_all('ref-delta')
+
+
+@wvtest
+def test_pack_cat_pipe_deep_delta_chain():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            w = git.PackWriter()
+            # Versions of a file that each differ from the last by one
+            # line, which git repack chains into long deltas.
+            lines = ['line %d\n' % i for i in xrange(300)]
+            rnd = random.Random(0)
+            now = int(time.time())
+            commit = None
+            blobs = []
+            for i in xrange(600):
+                lines.insert(rnd.randrange(len(lines)), 'new %d\n' % i)
+                blobs.append(''.join(lines))
+                tree = w.new_tree([(0o100644, 'f', w.new_blob(blobs[-1]))])
+                commit = w.new_commit(tree, commit, 'a <a@b>', now, None,
+                                      'a <a@b>', now, None, 'msg')
+            w.close()
+            git.update_ref('refs/heads/src', commit, None)
+            exc('git', '--git-dir', bupdir, 'repack', '-adf', '--window=2',
+                '--depth=4095')
+            depths = exo('git', '--git-dir', bupdir, 'verify-pack', '-v',
+                         *glob.glob(bupdir + '/objects/pack/*.idx'))
+            depth = max(int(x) for x in re.findall(r'chain length = (\d+)',
+                                                   depths))
+            WVPASS(depth > 100)
+            pcp = git.PackCatPipe(bupdir)
+            def read(oidx):
+                it = pcp.get(oidx)
+                next(it)
+                return pcp.get_info(oidx), ''.join(it)
+            limit = sys.getrecursionlimit()
+            sys.setrecursionlimit(100)
+            try:
+                results = [read(git.calc_hash('blob', b).encode('hex'))
+                           for b in blobs]
+            finally:
+                sys.setrecursionlimit(limit)
+            for blob, (info, data) in zip(blobs, results):
+                WVPASSEQ(('blob', len(blob)), info[1:])
+                WVPASSEQ(blob, data)
+
+
+@wvtest
+def test_cat_pipe_get_many():
+    with no_lingering_errors():
+        with test_tempdir('bup-tgit-') as tmpdir:
+            os.environ['BUP_MAIN_EXE'] = bup_exe
+            os.environ['BUP_DIR'] = bupdir = tmpdir + "/bup"
+            git.init_repo(bupdir)
+            w = git.PackWriter()
+            blobs = [str(i) * i for i in xrange(300)]
+            oidxs = [w.new_blob(b).encode('hex') for b in blobs]
+            w.close()
+            cp = git.CatPipe(bupdir)
+            refs = oidxs[:] + ['0' * 40] + oidxs[:]
+            expected = blobs + [None] + blobs
+            results = list((oidx, typ, size, it and ''.join(it))
+                           for oidx, typ, size, it in cp.get_many(refs))
+            WVPASSEQ(len(refs), len(results))
+            for ref, data, (oidx, typ, size, actual) in zip(refs, expected,
+                                                            results):
+                if data is None:
+                    WVPASSEQ((None, None, None, None),
+                             (oidx, typ, size, actual))
+                else:
+                    WVPASSEQ((ref, 'blob', len(data), data),
+                             (oidx, typ, size, actual))
+            # Abandon a batch partway through, leaving data unread
+            items = cp.get_many(oidxs)
+            next(items)
+            next(items)
+            items.close()
+            WVPASSEQ(blobs[7], ''.join(cp.join(oidxs[7])))
+
+            # Headers only, which may overlap a get() in progress
+            it = cp.get(oidxs[9])
+            next(it)
+            infos = list(cp.get_info_many(refs))
+            WVPASSEQ(blobs[9], ''.join(it))
+            WVPASSEQ([(ref, 'blob', len(data)) if data is not None
+                      else (None, None, None)
+                      for ref, data in zip(refs, expected)],
+                     infos)
+            infos = cp.get_info_many(oidxs)
+            next(infos)
+            infos.close()
+            WVPASSEQ((oidxs[5], 'blob', 5), cp.get_info(oidxs[5]))
@@ -1,11 +1,13 @@
 
 from __future__ import absolute_import
+from array import array
 from io import BytesIO
+import os
 
 from wvtest import *
 
-from bup import hashsplit, _helpers, helpers
-from buptest import no_lingering_errors
+from bup import git, hashsplit, _helpers, helpers
+from buptest import no_lingering_errors, test_tempdir
 
 
 def nr_regions(x, max_count=None):
@@ -84,11 +86,341 @@ def test_uncache_ours_upto():
             hashsplit._fadvise_pages_done = orig_pages_done
 
 
+@wvtest
+def test_buf():
+    with no_lingering_errors():
+        b = hashsplit.Buf()
+        b.put('abcdef')
+        WVPASSEQ('ab', str(b.get(2)))
+        WVPASSEQ(4, b.used())
+        b.put('ghij')
+        WVPASSEQ('cdefghij', str(b.peek(100)))
+        capacity = len(b.data)
+        # Leftovers move to the front; the storage is reused
+        b.eat(7)
+        b.put('klm')
+        WVPASSEQ('jklm', str(b.peek(100)))
+        WVPASSEQ(capacity, len(b.data))
+        b.eat(1)
+        b.put('nopq')
+        WVPASSEQ('klmnopq', str(b.get(100)))
+        WVPASSEQ(0, b.used())
+        b.put('x' * (capacity + 1))
+        WVPASSEQ(capacity + 1, b.used())
+        WVPASSEQ('x' * (capacity + 1), str(b.get(capacity + 1)))
+
+
+@wvtest
+def test_readfile_iter():
+    with no_lingering_errors():
+        with test_tempdir('bup-thashsplit-') as tmpdir:
+            data = os.urandom(3 * hashsplit.BLOB_READ_SIZE + 1234)
+            name = tmpdir + '/data'
+            with open(name, 'wb') as f:
+                f.write(data)
+            with open(name, 'rb') as f:
+                WVPASSEQ(data, ''.join(hashsplit.readfile_iter([f])))
+                WVPASSEQ(len(data), f.tell())
+            with open(name, 'rb') as f:
+                f.seek(100000)
+                WVPASSEQ(data[100000:], ''.join(hashsplit.readfile_iter([f])))
+            # A file that shrinks while it's read just ends early
+            with open(name, 'rb') as f:
+                it = hashsplit.readfile_iter([f])
+                got = next(it)
+                size = len(got) + 1000
+                with open(name, 'r+b') as trunc:
+                    trunc.truncate(size)
+                got += ''.join(it)
+                WVPASSEQ(data[:size], got)
+
+
+@wvtest
+def test_prefetch():
+    with no_lingering_errors():
+        with test_tempdir('bup-thashsplit-') as tmpdir:
+            data = os.urandom(3 * 1024 * 1024)
+            with open(tmpdir + '/file', 'w') as f:
+                f.write(data)
+            with open(tmpdir + '/file') as f:
+                f.seek(1000)
+                hashsplit.prefetch(f)
+                key = hashsplit._file_key(f.fileno())
+                if hashsplit._fmincore:
+                    WVPASS(key in hashsplit._prefetched_mincore)
+                WVPASSEQ(data[1000:], ''.join(str(b) for b
+                                             in hashsplit.readfile_iter([f])))
+                WVFAIL(key in hashsplit._prefetched_mincore)
+            # A file that's closed without being read is forgotten.
+            with open(tmpdir + '/file') as f:
+                hashsplit.prefetch(f)
+                key = hashsplit._file_key(f.fileno())
+                hashsplit.forget_prefetch(f)
+                WVFAIL(key in hashsplit._prefetched_mincore)
+                hashsplit.forget_prefetch(f)
+
+
 @wvtest
 def test_rolling_sums():
     with no_lingering_errors():
         WVPASS(_helpers.selftest())
 
+def splits_via_splitbuf(splitbuf, buf, blob_max):
+    """Return what find_splits(buf, blob_max) should, via splitbuf()."""
+    result = array('i')
+    ofs = 0
+    while True:
+        size, bits = splitbuf(buffer(buf, ofs))
+        if not size:
+            return result.tostring()
+        if size > blob_max:
+            size, bits = blob_max, 0
+        result.extend((size, bits))
+        ofs += size
+
+
+@wvtest
+def test_find_splits():
+    with no_lingering_errors():
+        data = os.urandom(1024 * 1024)
+        for blob_max in (1, 4096, 8192 * 4):
+            WVPASSEQ(splits_via_splitbuf(_helpers.splitbuf, data, blob_max),
+                     _helpers.find_splits(data, blob_max))
+        WVPASSEQ('', _helpers.find_splits('', 4096))
+        WVEXCEPT(ValueError, _helpers.find_splits, data, 0)
+
+
+@wvtest
+def test_find_splits_zero_runs():
+    with no_lingering_errors():
+        zeros = '\0' * (300 * 1024 + 7)
+        data = os.urandom(50000) + zeros + os.urandom(50000) + zeros
+        for blob_max in (4096, 8192 * 4):
+            WVPASSEQ(splits_via_splitbuf(_helpers.splitbuf, data, blob_max),
+                     _helpers.find_splits(data, blob_max))
+
+
+@wvtest
+def test_fastcdc_splits():
+    with no_lingering_errors():
+        fastcdc = _helpers.CHUNKER_FASTCDC
+        blob_max = 8192 * 4
+        data = os.urandom(1024 * 1024)
+        splits = array('i')
+        splits.fromstring(_helpers.find_splits(data, blob_max, fastcdc))
+        sizes = splits[0::2]
+        WVPASS(len(sizes) > 64)
+        # No blob is smaller than the minimum (a quarter of the average)
+        WVPASSLE((1 << _helpers.blobbits()) // 4, min(sizes))
+        WVPASSLE(max(sizes), blob_max)
+        WVPASS(all(bits >= _helpers.blobbits() for bits in splits[1::2]
+                   if bits))
+        WVPASSNE(_helpers.find_splits(data, blob_max),
+                 splits.tostring())
+        # The same content is split the same way after an insertion
+        shifted = array('i')
+        shifted.fromstring(_helpers.find_splits('x' * 100 + data, blob_max,
+                                                fastcdc))
+        WVPASSEQ(sizes[5:], shifted[0::2][5:])
+        WVEXCEPT(ValueError, _helpers.find_splits, data, blob_max, 42)
+
+
+_split_settings = ('chunker', 'BLOB_BITS', 'BLOB_MIN', 'BLOB_MAX',
+                   'BLOB_READ_SIZE', 'MAX_PER_TREE', 'fanout')
+
+@wvtest
+def test_configure():
+    with no_lingering_errors():
+        old = dict((name, getattr(hashsplit, name))
+                   for name in _split_settings)
+        try:
+            settings = {}
+            hashsplit.configure(settings.get)
+            WVPASSEQ(hashsplit.DEFAULT_CHUNKER, hashsplit.chunker)
+            WVPASSEQ((_helpers.blobbits(), None, 8192 * 4, 16, 256),
+                     (hashsplit.BLOB_BITS, hashsplit.BLOB_MIN,
+                      hashsplit.BLOB_MAX, hashsplit.fanout,
+                      hashsplit.MAX_PER_TREE))
+            settings['bup.split.chunker'] = 'fastcdc\n'
+            hashsplit.configure(settings.get)
+            WVPASSEQ('fastcdc', hashsplit.chunker)
+            data = os.urandom(256 * 1024)
+            blobs = [str(b) for b, level
+                     in hashsplit.hashsplit_iter([BytesIO(data)], False, None)]
+            WVPASSEQ(data, ''.join(blobs))
+            WVPASSLE((1 << _helpers.blobbits()) // 4,
+                     min(len(b) for b in blobs[:-1]))
+
+            settings['bup.split.blobBits'] = '16\n'
+            settings['bup.split.minSize'] = '20k\n'
+            settings['bup.split.fanout'] = '64\n'
+            hashsplit.configure(settings.get)
+            WVPASSEQ((16, 20 * 1024, 4 << 16, 64, 1024),
+                     (hashsplit.BLOB_BITS, hashsplit.BLOB_MIN,
+                      hashsplit.BLOB_MAX, hashsplit.fanout,
+                      hashsplit.MAX_PER_TREE))
+            WVPASS(hashsplit.BLOB_READ_SIZE > hashsplit.BLOB_MAX)
+            data = os.urandom(4 * 1024 * 1024)
+            blobs = [str(b) for b, level
+                     in hashsplit.hashsplit_iter([BytesIO(data)], False, None)]
+            WVPASSEQ(data, ''.join(blobs))
+            WVPASSLE(20 * 1024, min(len(b) for b in blobs[:-1]))
+            WVPASSLE(max(len(b) for b in blobs), 4 << 16)
+            WVPASSLT(len(blobs), len(data) // (16 * 1024))
+
+            for name, value in (('chunker', 'nonesuch'),
+                                ('blobBits', '5'),
+                                ('blobBits', 'x'),
+                                ('minSize', str(4 << 16)),
+                                ('maxSize', '0'),
+                                ('maxSize', str(hashsplit.MAX_BLOB_MAX + 1)),
+                                ('maxSize', '2g'),
+                                ('fanout', '1')):
+                bad = dict(settings)
+                bad['bup.split.' + name] = value
+                WVEXCEPT(ValueError, hashsplit.configure, bad.get)
+            WVPASSEQ('fastcdc', hashsplit.chunker)
+            WVPASSEQ(16, hashsplit.BLOB_BITS)
+
+            big = dict(settings)
+            big['bup.split.maxSize'] = str(hashsplit.MAX_BLOB_MAX)
+            WVPASSEQ(hashsplit.MAX_BLOB_MAX,
+                     hashsplit.read_config(big.get).blob_max)
+            del big['bup.split.maxSize']
+            big['bup.split.blobBits'] = '30'
+            WVPASSEQ(hashsplit.MAX_BLOB_MAX,
+                     hashsplit.read_config(big.get).blob_max)
+        finally:
+            for name, value in old.items():
+                setattr(hashsplit, name, value)
+
+
+@wvtest
+def test_find_splits_sizes():
+    with no_lingering_errors():
+        data = os.urandom(1024 * 1024)
+        bupsplit, fastcdc = _helpers.CHUNKER_BUPSPLIT, _helpers.CHUNKER_FASTCDC
+        default = _helpers.blobbits()
+        WVPASSEQ(_helpers.find_splits(data, 8192 * 4),
+                 _helpers.find_splits(data, 8192 * 4, bupsplit, default, -1))
+        WVPASSEQ(_helpers.find_splits(data, 8192 * 4, fastcdc),
+                 _helpers.find_splits(data, 8192 * 4, fastcdc, default,
+                                      (1 << default) // 4))
+        for engine in (bupsplit, fastcdc):
+            splits = array('i')
+            splits.fromstring(_helpers.find_splits(data, 1 << 20, engine,
+                                                   15, 4096))
+            sizes = splits[0::2]
+            WVPASSLE(4096, min(sizes))
+            WVPASS(all(bits >= 15 for bits in splits[1::2]))
+            WVPASSLT(len(sizes), len(data) // 8192)
+            WVEXCEPT(ValueError, _helpers.find_splits, data, 1 << 20, engine,
+                     31)
+
+
+@wvtest
+def test_split_to_blobs_passes_sha():
+    with no_lingering_errors():
+        given = []
+        def makeblob(blob, sha=None):
+            given.append(sha == git.calc_hash('blob', blob))
+            return sha
+        # Include a run of zeros cut at BLOB_MAX, and a tail after the
+        # last split
+        data = os.urandom(1024 * 1024) + '\0' * (200 * 1024) + 'x'
+        old_chunker = hashsplit.chunker
+        old_split_and_hash = hashsplit._split_and_hash
+        try:
+            # With and without the C split_and_hash(), when there is one
+            for split_and_hash in set([old_split_and_hash, None]):
+                hashsplit._split_and_hash = split_and_hash
+                for engine in ('bupsplit', 'fastcdc'):
+                    hashsplit.chunker = engine
+                    del given[:]
+                    blobs = list(hashsplit.split_to_blobs(makeblob,
+                                                          [BytesIO(data)],
+                                                          False, None))
+                    WVPASSEQ(len(data),
+                             sum(size for sha, size, level in blobs))
+                    WVPASS(len(given) > 16)
+                    WVPASS(all(given))
+        finally:
+            hashsplit.chunker = old_chunker
+            hashsplit._split_and_hash = old_split_and_hash
+
+
+@wvtest
+def test_zero_blobs_hashed_once():
+    with no_lingering_errors():
+        hashed = []
+        def blob_sha(blob):
+            hashed.append(len(blob))
+            return old_blob_sha(blob)
+        max_blobs = 20
+        data = '\0' * (max_blobs * hashsplit.BLOB_MAX) + 'x'
+        old_blob_sha = hashsplit._blob_sha
+        old_split_and_hash = hashsplit._split_and_hash
+        try:
+            hashsplit._blob_sha = blob_sha
+            for split_and_hash in set([old_split_and_hash, None]):
+                hashsplit._split_and_hash = split_and_hash
+                hashsplit._zero_blob_cache[:] = None, None
+                del hashed[:]
+                splits = list(hashsplit._split_iter([BytesIO(data)], False,
+                                                    None, want_sha=True))
+                WVPASSEQ(max_blobs + 1, len(splits))
+                WVPASS(all(sha == git.calc_hash('blob', blob)
+                           for blob, level, sha in splits))
+                # Just the zeros, once, and the tail
+                WVPASSEQ([hashsplit.BLOB_MAX, 1], hashed)
+        finally:
+            hashsplit._blob_sha = old_blob_sha
+            hashsplit._split_and_hash = old_split_and_hash
+
+
+@wvtest
+def test_split_and_hash_zero_sha():
+    with no_lingering_errors():
+        if not hashsplit._split_and_hash:
+            return
+        blob_max = 1024
+        data = '\0' * (3 * blob_max) + os.urandom(64 * 1024)
+        records = hashsplit._split_and_hash(data, blob_max,
+                                            _helpers.CHUNKER_BUPSPLIT,
+                                            13, -1, 'z' * 20)
+        ofs = 0
+        for size, bits, sha in hashsplit._iter_unpack(
+                hashsplit._split_hash_entry, records):
+            blob = data[ofs:ofs + size]
+            if ofs < 3 * blob_max:
+                # zero_sha stands in for the zero blobs' id
+                WVPASSEQ((blob_max, 'z' * 20), (size, sha))
+            else:
+                WVPASSEQ(git.calc_hash('blob', blob), sha)
+            ofs += size
+        WVPASS(ofs > 3 * blob_max)
+        WVEXCEPT(ValueError, hashsplit._split_and_hash, data, blob_max,
+                 _helpers.CHUNKER_BUPSPLIT, 13, -1, 'z')
+
+
+@wvtest
+def test_split_ahead():
+    with no_lingering_errors():
+        data = os.urandom(3 * 1024 * 1024)
+        expected = [(str(blob), level, sha) for blob, level, sha
+                    in hashsplit._split_iter([BytesIO(data)], False, None,
+                                             want_sha=True)]
+        WVPASSEQ(expected,
+                 list(hashsplit.split_ahead([BytesIO(data)], False)))
+        splits = hashsplit.split_ahead([BytesIO(data)], False)
+        WVPASSEQ(expected[0], next(iter(splits)))
+        splits.close()
+        class Unreadable:
+            def read(self, n):
+                raise IOError('unreadable')
+        WVEXCEPT(IOError, list, hashsplit.split_ahead([Unreadable()], False))
+
+
 @wvtest
 def test_fanout_behaviour():
 
@@ -102,10 +434,12 @@ def test_fanout_behaviour():
             if ord(c) >= basebits:
                 return ofs, ord(c)
         return 0, 0
+    def find_splits(buf, blob_max, *engine):
+        return splits_via_splitbuf(splitbuf, buf, blob_max)
 
     with no_lingering_errors():
-        old_splitbuf = _helpers.splitbuf
-        _helpers.splitbuf = splitbuf
+        old_find_splits = _helpers.find_splits
+        _helpers.find_splits = find_splits
         old_BLOB_MAX = hashsplit.BLOB_MAX
         hashsplit.BLOB_MAX = 4
         old_BLOB_READ_SIZE = hashsplit.BLOB_READ_SIZE
@@ -131,7 +465,7 @@ def test_fanout_behaviour():
         WVPASSEQ(levels(split_many),
             [(1, 1), (4, 2), (4, 0), (1, 0), (4, 0), (1, 5), (1, 0)])
 
-        _helpers.splitbuf = old_splitbuf
+        _helpers.find_splits = old_find_splits
         hashsplit.BLOB_MAX = old_BLOB_MAX
         hashsplit.BLOB_READ_SIZE = old_BLOB_READ_SIZE
         hashsplit.fanout = old_fanout
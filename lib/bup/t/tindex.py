@@ -5,6 +5,7 @@ import os, time
 from wvtest import *
 
 from bup import index, metadata
+from bup.drecurse import recursive_dirlist
 from bup.helpers import mkdirp, resolve_parent
 from buptest import no_lingering_errors, test_tempdir
 import bup.xstat as xstat
@@ -181,3 +182,227 @@ def index_dirty():
                 w3.close()
             finally:
                 os.chdir(orig_cwd)
+
+
+@wvtest
+def index_dirty_counts():
+    with no_lingering_errors():
+        with test_tempdir('bup-tindex-') as tmpdir:
+            src = tmpdir + '/src/'
+            for d in ('d1/', 'd1/sub/', 'd2/'):
+                mkdirp(src + d)
+            for name, size in (('d1/f1', 10), ('d1/f2', 200),
+                               ('d1/sub/f3', 3000), ('d2/f4', 40000),
+                               ('f5', 5)):
+                with open(src + name, 'wb') as f:
+                    f.write('x' * size)
+            indexfile = tmpdir + '/index'
+            ms = index.MetaStoreWriter(indexfile + '.meta')
+            tmax = (time.time() - 1) * 10**9
+            w = index.Writer(indexfile, ms, tmax)
+            for path, pst in recursive_dirlist([src], xdev=None):
+                w.add(path, pst, ms.store(metadata.Metadata()))
+            ms.close()
+            w.close()
+
+            def prescan(r, paths):
+                total = ftotal = 0
+                for name, e in r.filter(paths,
+                                        wantrecurse=lambda e: not e.is_valid()):
+                    if e.exists() and not e.is_valid():
+                        total += e.size
+                    ftotal += 1
+                return (total, ftotal)
+
+            r = index.Reader(indexfile)
+            fake_validate(e for e in r if e.name.startswith(src + 'd2/'))
+            r.close()
+            r = index.Reader(indexfile)
+            dirty = index.DirtyCounts(indexfile + '.dirty', indexfile)
+            WVPASSEQ(dirty.totals([src]), None)
+            dirty.count(r, src)
+            r.close()
+            dirty.save()
+
+            # The totals for the top itself don't need its directories.
+            dirty = index.DirtyCounts(indexfile + '.dirty', indexfile)
+            r = index.Reader(indexfile)
+            WVPASSEQ(dirty.totals([src]), prescan(r, [src]))
+            r.close()
+            WVPASS(isinstance(dirty._tops[src][2], bytes))
+            dirty.save()
+
+            r = index.Reader(indexfile)
+            dirty = index.DirtyCounts(indexfile + '.dirty', indexfile)
+            for paths in ([src], [src + 'd1'], [src + 'd1/sub'],
+                          [src + 'd2'], [src + 'd1', src + 'd2/']):
+                WVPASSEQ(dirty.totals(paths), prescan(r, paths))
+            WVPASSEQ(dirty.totals([src + 'f5']), None)
+            WVPASSEQ(dirty.totals([tmpdir]), None)
+            r.close()
+
+            # Damaged counts are ignored.
+            with open(indexfile + '.dirty', 'rb') as f:
+                saved = f.read()
+            for damaged in (saved[:-1], 'x' + saved[1:]):
+                with open(indexfile + '.dirty', 'wb') as f:
+                    f.write(damaged)
+                dirty = index.DirtyCounts(indexfile + '.dirty', indexfile)
+                WVPASSEQ(dirty.totals([src]), None)
+
+            # Counts for a rewritten index are ignored.
+            ms = index.MetaStoreWriter(indexfile + '.meta')
+            w = index.Writer(indexfile, ms, tmax)
+            for e in index.Reader(indexfile):
+                w.add_ixentry(e)
+            ms.close()
+            w.close()
+            dirty = index.DirtyCounts(indexfile + '.dirty', indexfile)
+            WVPASSEQ(dirty.totals([src]), None)
+
+            dirty.clear()
+            WVPASS(not os.path.exists(indexfile + '.dirty'))
+
+
+@wvtest
+def index_dir_listings():
+    with no_lingering_errors():
+        with test_tempdir('bup-tindex-') as tmpdir:
+            ds = xstat.stat(lib_t_dir)
+            fs = xstat.stat(lib_t_dir + '/tindex.py')
+            ms = index.MetaStoreWriter(tmpdir + '/index.meta')
+            tmax = (time.time() - 1) * 10**9
+            w = index.Writer(tmpdir + '/index', ms, tmax)
+            for name in ('/a/y/z', '/a/y/', '/a/x', '/a/w', '/a/', '/'):
+                w.add(name, ds if name.endswith('/') else fs, 0)
+            ms.close()
+            w.close()
+            r = index.Reader(tmpdir + '/index')
+            e = eget(r, '/a/w')
+            e.set_deleted()
+            e.repack()
+            listings = index.DirListings(r)
+            WVPASSEQ(listings.names('/'), ['a'])
+            WVPASSEQ(listings.names('/a/y/'), ['z'])
+            WVPASSEQ(listings.names('/a/'), ['y', 'x'])
+            WVPASSEQ(listings.entry('/a/').name, '/a/')
+            WVPASSEQ(listings.entry('/a/y/').name, '/a/y/')
+            WVPASSEQ(listings.entry('/a/w/'), None)
+            WVPASSEQ(listings.names('/b/'), None)
+            WVPASSEQ(listings.names('/a/y/'), ['z'])
+            r.close()
+
+
+@wvtest
+def index_overlay():
+    with no_lingering_errors():
+        with test_tempdir('bup-tindex-') as tmpdir:
+            ds = xstat.stat(lib_t_dir)
+            fs = xstat.stat(lib_t_dir + '/tindex.py')
+            ms = index.MetaStoreWriter(tmpdir + '/index.meta')
+            tmax = (time.time() - 1) * 10**9
+            indexfile = tmpdir + '/index'
+            w = index.Writer(indexfile, ms, tmax)
+            for name in ('/a/y/z', '/a/y/', '/a/x', '/a/', '/'):
+                w.add(name, ds if name.endswith('/') else fs, 0)
+            w.close()
+            r = index.Reader(indexfile)
+            fake_validate(r)
+            WVPASSEQ(r.overlay, None)
+            WVPASS(not index.wants_compaction(r))
+
+            w = index.Writer(tmpdir + '/new', ms, tmax)
+            w.add('/a/y/n', fs, 0)
+            w.add('/a/b/c', fs, 0)
+            w.add('/a/b/', ds, 0)
+            wr = w.new_reader()
+            base_size = os.path.getsize(indexfile)
+            index.add_to_overlay(r, wr, ms, tmax)
+            wr.close()
+            w.abort()
+            r.close()
+            WVPASSEQ(os.path.getsize(indexfile), base_size)
+
+            r = index.Reader(indexfile)
+            WVPASS(r.overlay)
+            WVPASSEQ([e.name for e in r],
+                     ['/a/y/z', '/a/y/n', '/a/y/', '/a/x',
+                      '/a/b/c', '/a/b/', '/a/', '/'])
+            WVPASSEQ([e.name for e in r if not e.is_valid()],
+                     ['/a/y/n', '/a/b/c', '/a/b/'])
+            WVPASSEQ([e.name for e in r.iter(name='/a/y/')],
+                     ['/a/y/z', '/a/y/n', '/a/y/'])
+            # Updates land in whichever file holds the entry.
+            fake_validate(r)
+            e = eget(r, '/a/x')
+            e.set_deleted()
+            e.repack()
+            r.close()
+            r = index.Reader(indexfile)
+            WVPASSEQ([e.name for e in r if not e.is_valid()],
+                     ['/a/x', '/a/', '/'])
+            WVPASS(not index.droppable(eget(r, '/a/x')))
+            WVPASS(index.wants_compaction(r))
+
+            # Deleted entries are only dropped once their directory
+            # is valid again, i.e. a save has seen the deletion.
+            fake_validate([eget(r, '/a/'), eget(r, '/')])
+            WVPASS(index.droppable(eget(r, '/a/x')))
+            r.close()
+            with open(indexfile + index.OVERLAY_SUFFIX, 'rb') as f:
+                old_overlay = f.read()
+            index.compact(indexfile, ms, tmax)
+            WVPASS(not os.path.exists(indexfile + index.OVERLAY_SUFFIX))
+            r = index.Reader(indexfile)
+            WVPASSEQ(r.overlay, None)
+            WVPASSEQ([e.name for e in r],
+                     ['/a/y/z', '/a/y/n', '/a/y/', '/a/b/c', '/a/b/',
+                      '/a/', '/'])
+            WVPASSEQ([e.name for e in r if not e.is_valid()], [])
+            r.close()
+
+            # An overlay left behind by a compaction that was
+            # interrupted before removing it doesn't belong to the new
+            # index, and is ignored.
+            with open(indexfile + index.OVERLAY_SUFFIX, 'wb') as f:
+                f.write(old_overlay)
+            r = index.Reader(indexfile)
+            WVPASSEQ(r.overlay, None)
+            WVPASSEQ([e.name for e in r],
+                     ['/a/y/z', '/a/y/n', '/a/y/', '/a/b/c', '/a/b/',
+                      '/a/', '/'])
+            WVPASSEQ([e.name for e in r if not e.is_valid()], [])
+            # ...and replaced by the next one.
+            w = index.Writer(tmpdir + '/new', ms, tmax)
+            w.add('/a/m', fs, 0)
+            wr = w.new_reader()
+            index.add_to_overlay(r, wr, ms, tmax)
+            wr.close()
+            w.abort()
+            r.close()
+            r = index.Reader(indexfile)
+            WVPASS(r.overlay)
+            WVPASSEQ([e.name for e in r],
+                     ['/a/y/z', '/a/y/n', '/a/y/', '/a/m', '/a/b/c', '/a/b/',
+                      '/a/', '/'])
+            r.close()
+
+            # A reader notices a compaction that replaces the index
+            # while it's opening the overlay, and starts over.
+            file_id = index._file_id
+            def compacting_file_id(filename):
+                index._file_id = file_id
+                index.compact(indexfile, ms, tmax)
+                return file_id(filename)
+            try:
+                index._file_id = compacting_file_id
+                r = index.Reader(indexfile)
+            finally:
+                index._file_id = file_id
+            WVPASSEQ(r.overlay, None)
+            WVPASSEQ(len(r), 8)
+            WVPASSEQ([e.name for e in r],
+                     ['/a/y/z', '/a/y/n', '/a/y/', '/a/m', '/a/b/c', '/a/b/',
+                      '/a/', '/'])
+            r.close()
+            ms.close()
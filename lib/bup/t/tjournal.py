@@ -0,0 +1,98 @@
+
+from __future__ import absolute_import
+import os, re
+
+from wvtest import *
+
+from bup import journal
+from bup.helpers import mkdirp
+from buptest import no_lingering_errors, test_tempdir
+
+
+@wvtest
+def test_journal_claim():
+    with no_lingering_errors():
+        with test_tempdir('bup-tjournal-') as tmpdir:
+            j = journal.Journal(tmpdir + '/bupindex.journal')
+            j.claim()
+            WVPASSEQ(j.records, [])
+            WVPASSEQ(j.unusable_reason('/x/', [], [], False),
+                     'no watcher is running')
+
+            j.append([(journal.CHANGED, '/x/a'), (journal.CHANGED, '/y/b')])
+            with open(j.filename, 'ab') as f:
+                f.write('p/x/partial')  # as if a watcher died mid-write
+            j.claim()
+            WVPASSEQ(os.path.getsize(j.filename), 0)
+            WVPASSEQ(j.records, [(journal.CHANGED, '/x/a'),
+                                 (journal.CHANGED, '/y/b'),
+                                 (journal.OVERFLOW, '')])
+            WVPASS(j.overflowed)
+            WVPASSEQ(j.records_beneath('/x/'), [(journal.CHANGED, '/x/a')])
+
+            # Unfinished claims accumulate.
+            j.append([(journal.ADDED_DIR, '/x/c')])
+            j.claim()
+            WVPASSEQ(len(j.records), 4)
+
+            j.finish(['/x/'])
+            WVPASSEQ(j.records, [(journal.CHANGED, '/y/b'),
+                                 (journal.OVERFLOW, '')])
+            j = journal.Journal(j.filename)
+            j.claim()
+            WVPASSEQ(j.records, [(journal.CHANGED, '/y/b'),
+                                 (journal.OVERFLOW, '')])
+            j.finish(['/'])
+            WVPASSEQ(j.records, [(journal.OVERFLOW, '')])
+
+
+@wvtest
+def test_watch_info():
+    with no_lingering_errors():
+        info = journal.WatchInfo(['/x/', '/y/f'], ['/x/tmp'], [r'\.o$'], True)
+        info = journal.WatchInfo.decode(info.encode())
+        WVPASSEQ(info.paths, ['/x/', '/y/f'])
+        rxs = [re.compile(r'\.o$')]
+        WVPASSEQ(info.unwatched_reason('/x/a/', ['/x/tmp'], rxs, True), None)
+        WVPASSEQ(info.unwatched_reason('/y/f', ['/x/tmp'], rxs, True), None)
+        WVPASS(info.unwatched_reason('/z/', ['/x/tmp'], rxs, True))
+        # Watching /x/ or /y/f doesn't cover /xy/ or /y/foo/
+        WVPASS(info.unwatched_reason('/xy/', ['/x/tmp'], rxs, True))
+        WVPASS(info.unwatched_reason('/y/foo/', ['/x/tmp'], rxs, True))
+        WVPASS(info.unwatched_reason('/y/f/', ['/x/tmp'], rxs, True))
+        WVPASSEQ(info.unwatched_reason('/x/', ['/x/tmp'], rxs, True), None)
+        WVPASS(info.unwatched_reason('/x/', [], rxs, True))
+        WVPASS(info.unwatched_reason('/x/', ['/x/tmp'], [], True))
+        WVPASS(info.unwatched_reason('/x/', ['/x/tmp'], rxs, False))
+        WVPASSEQ(journal.WatchInfo.decode(info.encode()[:-2]), None)
+
+
+@wvtest
+def test_changes():
+    with no_lingering_errors():
+        with test_tempdir('bup-tjournal-') as tmpdir:
+            top = os.path.realpath(tmpdir) + '/'
+            mkdirp(top + 'a/b')
+            mkdirp(top + 'new/sub')
+            for name in ('a/1', 'a/b/2', 'new/3', 'new/sub/4', 'file'):
+                open(top + name, 'w').close()
+            changes = journal.Changes(top,
+                                      [(journal.CHANGED, top + 'a/1'),
+                                       (journal.CHANGED, top + 'a/gone'),
+                                       (journal.ADDED_DIR, top + 'new'),
+                                       (journal.CHANGED, top + 'file/x')],
+                                      xdev=False)
+            WVPASSEQ([p for (p, st) in changes.paths],
+                     [top + 'new/sub/4', top + 'new/sub/', top + 'new/3',
+                      top + 'new/', top + 'file', top + 'a/1', top + 'a/',
+                      top])
+            # Deleted, or replaced by something of another type.
+            WVPASS(changes.covers(top + 'a/gone'))
+            WVPASS(changes.covers(top + 'a/gone/x'))
+            WVPASS(changes.covers(top + 'a/1/'))
+            WVPASS(changes.covers(top + 'file/'))
+            WVPASS(changes.covers(top + 'file/x'))
+            WVPASS(changes.covers(top + 'new/old'))
+            # Unmentioned, so presumably unchanged.
+            WVPASS(not changes.covers(top + 'a/b/2'))
+            WVPASS(not changes.covers(top + 'other'))
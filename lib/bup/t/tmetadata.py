@@ -305,3 +305,34 @@ if xattr:
         WVPASSEQ(xattr.get(path, 'user.foo'), 'bar')
         os.chdir(start_dir)
         cleanup_testfs()
+
+
+@wvtest
+def test_metadata_spool():
+    with no_lingering_errors():
+        dir_meta = metadata.from_path('.')
+        items = []
+        for i in xrange(57):
+            m = metadata.from_path('tmetadata.py')
+            m.uid = i
+            # Include some duplicate keys to check the ordering is stable.
+            items.append(('%04d' % ((i * 37) % 50), m))
+        expected = dir_meta.encode() \
+            + ''.join(m.encode() for k, m in sorted(items, key=lambda x: x[0]))
+        for max_entries in (1, 2, 10, 56, 57, 1000):
+            spool = metadata.MetadataSpool(dir_meta, max_entries=max_entries)
+            for k, m in items:
+                spool.append(k, m)
+            r = spool.reader()
+            pieces = []
+            while True:
+                b = r.read(100)
+                if not b:
+                    break
+                WVPASS(len(b) <= 100)
+                pieces.append(b)
+            WVPASSEQ(''.join(pieces), expected)
+            spool.close()
+        spool = metadata.MetadataSpool(dir_meta, max_entries=3)
+        WVPASSEQ(spool.reader().read(), dir_meta.encode())
+        spool.close()
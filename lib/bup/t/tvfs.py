@@ -10,11 +10,11 @@ from time import localtime, strftime
 
 from wvtest import *
 
-from bup import git, metadata, vfs
+from bup import git, hashsplit, metadata, vfs
 from bup.git import BUP_CHUNKED
 from bup.helpers import exc, exo, shstr
 from bup.metadata import Metadata
-from bup.repo import LocalRepo
+from bup.repo import LocalRepo, RemoteRepo
 from buptest import no_lingering_errors, test_tempdir
 
 top_dir = '../../..'
@@ -566,4 +566,135 @@ def test_duplicate_save_dates():
                       'latest'),
                      tuple(sorted(x[0] for x in vfs.contents(repo, revlist))))
 
+@wvtest
+def test_read_large_blobs():
+    with no_lingering_errors():
+        with test_tempdir('bup-tvfs-read-') as tmpdir:
+            bup_dir = tmpdir + '/bup'
+            environ['GIT_DIR'] = bup_dir
+            environ['BUP_DIR'] = bup_dir
+            git.repodir = bup_dir
+            data_path = tmpdir + '/src'
+            os.mkdir(data_path)
+            data = os.urandom(3 * 1024 * 1024)
+            with open(data_path + '/file', 'w+') as tmpfile:
+                tmpfile.write(data)
+            ex((bup_path, 'init', '--blob-bits', '18'))
+            ex((bup_path, 'index', '-v', data_path))
+            ex((bup_path, 'save', '-d', '100000', '-n', 'test', '--strip',
+                data_path))
+            repo = LocalRepo()
+            res = vfs.resolve(repo, '/test/latest/file')
+            blobs = exo(('git', 'ls-tree', '-r', 'test:file.bup'))[0]
+            wvpass(1 < len(blobs.splitlines()) < len(data) // (64 * 1024))
+            with vfs.fopen(repo, res[-1][1]) as f:
+                wvpasseq(data[:1000], f.read(1000))
+                chunks = []
+                while True:
+                    buf = f.read(4093)
+                    if not buf:
+                        break
+                    chunks.append(buf)
+                wvpasseq(data[1000:], ''.join(chunks))
+                f.seek(len(data) - 10)
+                wvpasseq(data[-10:], f.read())
+                f.seek(300001)
+                wvpasseq(data[300001:305001], f.read(5000))
+            # Each cat_many() is limited by the size of its blobs.
+            fetched = []
+            cat_many = repo.cat_many
+            def recording_cat_many(refs):
+                refs = tuple(refs)
+                fetched.append((len(refs),
+                                sum(repo.cat_info(ref)[2] for ref in refs)))
+                return cat_many(refs)
+            old_batch_bytes = vfs._tree_chunks_batch_bytes
+            try:
+                vfs._tree_chunks_batch_bytes = 600 * 1024
+                repo.cat_many = recording_cat_many
+                with vfs.fopen(repo, res[-1][1]) as f:
+                    wvpasseq(data, f.read())
+            finally:
+                vfs._tree_chunks_batch_bytes = old_batch_bytes
+                del repo.cat_many
+            wvpass(len(fetched) > 2)
+            wvpass(all(n == 1 or size <= 600 * 1024 for n, size in fetched))
+            wvpasseq(len(blobs.splitlines()), sum(n for n, size in fetched))
+
+@wvtest
+def test_read_zero_runs():
+    with no_lingering_errors():
+        with test_tempdir('bup-tvfs-zeros-') as tmpdir:
+            bup_dir = tmpdir + '/bup'
+            environ['GIT_DIR'] = bup_dir
+            environ['BUP_DIR'] = bup_dir
+            git.repodir = bup_dir
+            data_path = tmpdir + '/src'
+            os.mkdir(data_path)
+            data = os.urandom(100000) + '\0' * (1024 * 1024) \
+                   + os.urandom(100000)
+            with open(data_path + '/file', 'w+') as tmpfile:
+                tmpfile.write(data)
+            ex((bup_path, 'init'))
+            ex((bup_path, 'index', '-v', data_path))
+            ex((bup_path, 'save', '-n', 'test', '--strip', data_path))
+            zero_oid = git.calc_hash('blob', '\0' * hashsplit.BLOB_MAX)
+            blobs = exo(('git', 'ls-tree', '-r', 'test:file.bup'))[0]
+            wvpass(blobs.count(zero_oid.encode('hex')) > 1)
+            repo = LocalRepo()
+            res = vfs.resolve(repo, '/test/latest/file')
+            # Only the first of each run of zero blobs is fetched.
+            fetched = []
+            cat_many = repo.cat_many
+            def recording_cat_many(refs):
+                refs = tuple(refs)
+                fetched.extend(refs)
+                return cat_many(refs)
+            repo.cat_many = recording_cat_many
+            with vfs.fopen(repo, res[-1][1]) as f:
+                wvpasseq(data, f.read())
+                wvpasseq(1, fetched.count(zero_oid.encode('hex')))
+                wvpasseq((hashsplit.BLOB_MAX, zero_oid), vfs._zero_blob)
+                f.seek(500001)
+                wvpasseq(data[500001:700001], f.read(200000))
+            with vfs.fopen(repo, res[-1][1]) as f:
+                wvpasseq(data, f.read())
+
+@wvtest
+def test_interleaved_reads():
+    with no_lingering_errors():
+        with test_tempdir('bup-tvfs-interleave-') as tmpdir:
+            bup_dir = tmpdir + '/bup'
+            environ['GIT_DIR'] = bup_dir
+            environ['BUP_DIR'] = bup_dir
+            git.repodir = bup_dir
+            data_path = tmpdir + '/src'
+            os.mkdir(data_path)
+            data = {}
+            for name in ('a', 'b'):
+                data[name] = os.urandom(1024 * 1024)
+                with open(data_path + '/' + name, 'w+') as tmpfile:
+                    tmpfile.write(data[name])
+            ex((bup_path, 'init'))
+            ex((bup_path, 'index', '-v', data_path))
+            ex((bup_path, 'save', '-n', 'test', '--strip', data_path))
+            environ['BUP_MAIN_EXE'] = bup_path
+            for repo in (LocalRepo(), RemoteRepo(bup_dir)):
+                a = vfs.fopen(repo, vfs.resolve(repo, '/test/latest/a')[-1][1])
+                b = vfs.fopen(repo, vfs.resolve(repo, '/test/latest/b')[-1][1])
+                got = {'a': [], 'b': []}
+                for i in range(len(data['a']) // 100000 + 1):
+                    got['a'].append(a.read(100000))
+                    got['b'].append(b.read(100000))
+                wvpasseq(data['a'], ''.join(got['a']))
+                wvpasseq(data['b'], ''.join(got['b']))
+                # Abandon a file part way through.
+                a.seek(0)
+                wvpasseq(data['a'][:5000], a.read(5000))
+                a.close()
+                res = vfs.resolve(repo, '/test/latest/b')
+                with vfs.fopen(repo, res[-1][1]) as f:
+                    wvpasseq(data['b'], f.read())
+                b.close()
+
 # FIXME: add tests for the want_meta=False cases.
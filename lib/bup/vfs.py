@@ -48,7 +48,7 @@ item.coid.
 from __future__ import absolute_import, print_function
 from collections import namedtuple
 from errno import ELOOP, ENOENT, ENOTDIR
-from itertools import chain, dropwhile, groupby, izip, tee
+from itertools import chain, groupby, islice, izip, tee
 from stat import S_IFDIR, S_IFLNK, S_IFREG, S_ISDIR, S_ISLNK, S_ISREG
 from time import localtime, strftime
 import exceptions, re, sys
@@ -80,39 +80,124 @@ def _default_mode_for_gitmode(gitmode):
 
 def _normal_or_chunked_file_size(repo, oid):
     """Return the size of the normal or chunked file indicated by oid."""
-    # FIXME: --batch-format CatPipe?
-    it = repo.cat(oid.encode('hex'))
-    _, obj_t, size = next(it)
+    _, obj_t, size = repo.cat_info(oid.encode('hex'))
     ofs = 0
     while obj_t == 'tree':
-        mode, name, last_oid = last(tree_decode(''.join(it)))
+        it = repo.cat(oid.encode('hex'))
+        next(it)
+        mode, name, oid = last(tree_decode(''.join(it)))
         ofs += int(name, 16)
-        it = repo.cat(last_oid.encode('hex'))
-        _, obj_t, size = next(it)
-    return ofs + sum(len(b) for b in it)
+        # Only the blob at the end needs its own (header only) request.
+        if not S_ISDIR(mode):
+            _, obj_t, size = repo.cat_info(oid.encode('hex'))
+    return ofs + size
+
+def _skip_chunks_before_offset(tree, offset):
+    """Return the entries of tree, starting with the one containing
+    offset (the last one that starts at or before it)."""
+    tree = iter(tree)
+    prev_ent = next(tree, None)
+    if not prev_ent:
+        return ()
+    for ent in tree:
+        ent_ofs = int(ent[1], 16)
+        if ent_ofs > offset:
+            return chain((prev_ent, ent), tree)
+        prev_ent = ent
+    return (prev_ent,)
+
+# The (size, oid) of the all-zero blob _is_zero_blob() last checked
+# for.  The id only depends on the size, which is usually the
+# repository's bup.split.maxSize.
+_zero_blob = (None, None)
+
+def _is_zero_blob(oid, size):
+    global _zero_blob
+    if _zero_blob[0] != size:
+        _zero_blob = (size, git.calc_hash('blob', '\0' * size))
+    return oid == _zero_blob[1]
+
+# How many blobs _tree_chunks() fetches with each cat_many(), and
+# roughly how many bytes of them (the limit only matters for large
+# blobs, and a single blob may exceed it)
+_tree_chunks_batch = 32
+_tree_chunks_batch_bytes = 8 * 1024 * 1024
+
+def _blob_batches(repo, ents):
+    """Yield lists of (name, oid, zeros) for the blob entries ents, as
+    _tree_chunks() should fetch them, where zeros is the size of an
+    all-zero blob that needn't be fetched, or None.  The lists are
+    limited by the sizes cat_info_many() reports."""
+    ents = iter(ents)
+    prev_oid = None
+    while True:
+        window = tuple(islice(ents, _tree_chunks_batch))
+        if not window:
+            break
+        infos = repo.cat_info_many(oid.encode('hex') for _, _, oid in window)
+        batch = []
+        nbytes = 0
+        for (mode, name, oid), (_, obj_t, size) in izip(window, infos):
+            assert obj_t == 'blob'
+            # Runs of zeros are split into many copies of the same
+            # blob, so after the first, the rest can be produced
+            # without fetching or inflating them.
+            zeros = None
+            if oid == prev_oid and _is_zero_blob(oid, size):
+                zeros = size
+            elif batch and nbytes + size > _tree_chunks_batch_bytes:
+                yield batch
+                batch = []
+                nbytes = 0
+            if zeros is None:
+                nbytes += size
+            batch.append((name, oid, zeros))
+            prev_oid = oid
+        yield batch
 
 def _tree_chunks(repo, tree, startofs):
     "Tree should be a sequence of (name, mode, hash) as per tree_decode()."
     assert(startofs >= 0)
     # name is the chunk's hex offset in the original file
-    tree = dropwhile(lambda (_1, name, _2): int(name, 16) < startofs, tree)
-    for mode, name, oid in tree:
-        ofs = int(name, 16)
-        skipmore = startofs - ofs
-        if skipmore < 0:
-            skipmore = 0
-        it = repo.cat(oid.encode('hex'))
-        _, obj_t, size = next(it)
-        data = ''.join(it)            
-        if S_ISDIR(mode):
-            assert obj_t == 'tree'
-            for b in _tree_chunks(repo, tree_decode(data), skipmore):
-                yield b
-        else:
-            assert obj_t == 'blob'
-            yield data[skipmore:]
+    tree = _skip_chunks_before_offset(tree, startofs)
+    def skipmore(name):
+        return max(0, startofs - int(name, 16))
+    # Fetch each run of blobs via cat_many() so the requests can be
+    # pipelined.  Subtrees are fetched one at a time, since the repo
+    # can't serve the recursion while a cat_many() is in progress.
+    # Likewise, each batch is read completely before any of it is
+    # yielded, since the caller may use the repo (e.g. to read another
+    # file) before asking for more, or never ask again.
+    for isdir, ents in groupby(tree, lambda (mode, _1, _2): S_ISDIR(mode)):
+        if isdir:
+            for mode, name, oid in ents:
+                it = repo.cat(oid.encode('hex'))
+                _, obj_t, size = next(it)
+                assert obj_t == 'tree'
+                data = ''.join(it)
+                for b in _tree_chunks(repo, tree_decode(data), skipmore(name)):
+                    yield b
+            continue
+        for batch in _blob_batches(repo, ents):
+            blobs = {}
+            for item in repo.cat_many(oid.encode('hex')
+                                      for _, oid, zeros in batch
+                                      if zeros is None):
+                _, obj_t, size, it = item
+                assert obj_t == 'blob'
+                data = ''.join(it)
+                blobs[item[0].decode('hex')] = data
+            for name, oid, zeros in batch:
+                if zeros is not None:
+                    yield '\0' * max(0, zeros - skipmore(name))
+                else:
+                    yield blobs[oid][skipmore(name):]
 
 class _ChunkReader:
+    # Rather than slicing off what's been read, track the position in
+    # the current blob (blob_ofs), so that small reads don't copy the
+    # rest of the blob each time, which matters when a repository's
+    # split settings call for large blobs.
     def __init__(self, repo, oid, startofs):
         it = repo.cat(oid.encode('hex'))
         _, obj_t, size = next(it)
@@ -121,25 +206,34 @@ class _ChunkReader:
         if isdir:
             self.it = _tree_chunks(repo, tree_decode(data), startofs)
             self.blob = None
+            self.blob_ofs = 0
         else:
             self.it = None
-            self.blob = data[startofs:]
+            self.blob = data
+            self.blob_ofs = min(startofs, len(data))
         self.ofs = startofs
 
     def next(self, size):
-        out = ''
-        while len(out) < size:
+        out = []
+        n = 0
+        while n < size:
             if self.it and not self.blob:
                 try:
                     self.blob = self.it.next()
+                    self.blob_ofs = 0
                 except StopIteration:
                     self.it = None
             if self.blob:
-                want = size - len(out)
-                out += self.blob[:want]
-                self.blob = self.blob[want:]
+                end = min(len(self.blob), self.blob_ofs + size - n)
+                out.append(self.blob[self.blob_ofs:end])
+                n += end - self.blob_ofs
+                if end == len(self.blob):
+                    self.blob = None
+                else:
+                    self.blob_ofs = end
             if not self.it:
                 break
+        out = ''.join(out)
         debug2('next(%d) returned %d\n' % (size, len(out)))
         self.ofs += len(out)
         return out
@@ -385,7 +479,8 @@ def _compute_item_size(repo, item):
         size = _normal_or_chunked_file_size(repo, item.oid)
         return size
     if S_ISLNK(mode):
-        return len(_readlink(repo, item.oid))
+        # The target is the blob's content.
+        return repo.cat_info(item.oid.encode('hex'))[2]
     return 0
 
 def item_size(repo, item):
@@ -97,4 +97,12 @@ $(pwd)/src/a/
 $(pwd)/src/a-link
 $(pwd)/src/"
 
+WVSTART "drecurse -j"
+WVPASSEQ "$(bup drecurse -j 4 src)" "$(bup drecurse src)"
+WVPASSEQ "$(bup drecurse -j 4 --exclude src/b/ src)" \
+    "$(bup drecurse --exclude src/b/ src)"
+WVPASSEQ "$(bup drecurse -j 3 "$top/t/sampledata")" \
+    "$(bup drecurse "$top/t/sampledata")"
+WVFAIL bup drecurse -j 0 src
+
 WVPASS rm -rf "$tmpdir"
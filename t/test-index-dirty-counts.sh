@@ -0,0 +1,76 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh || exit $?
+. t/lib.sh || exit $?
+
+set -o pipefail
+
+top="$(WVPASS pwd)" || exit $?
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+
+export BUP_DIR="$tmpdir/bup"
+export GIT_DIR="$tmpdir/bup"
+
+bup() { "$top/bup" "$@"; }
+
+# Check that the counts bup index recorded for each path match what
+# save's --progress pre-scan would find.
+counts-match-prescan()
+{
+    PYTHONPATH="$top/lib" bup-python -c '
+import sys
+from bup import index
+indexfile = sys.argv[1]
+r = index.Reader(indexfile)
+dirty = index.DirtyCounts(indexfile + ".dirty", indexfile)
+ok = True
+for path in sys.argv[2:]:
+    total = ftotal = 0
+    for name, e in r.filter([path], wantrecurse=lambda e: not e.is_valid()):
+        if e.exists() and not e.is_valid():
+            total += e.size
+        ftotal += 1
+    recorded = dirty.totals([path])
+    print path, recorded, (total, ftotal)
+    ok = ok and recorded == (total, ftotal)
+sys.exit(not ok)
+' "$BUP_DIR/bupindex" "$@"
+}
+
+WVPASS cd "$tmpdir"
+WVPASS bup init
+WVPASS mkdir -p src/d1/sub src/d2 src/d3
+WVPASS echo one > src/d1/f1
+WVPASS echo two two > src/d1/sub/f2
+WVPASS echo three > src/d2/f3
+WVPASS echo four > src/d3/f4
+WVPASS echo five > src/f5
+WVPASS sleep 2  # so the index can trust the times
+
+WVSTART 'dirty counts: initial index'
+WVPASS bup index src
+WVPASS counts-match-prescan src src/d1 src/d1/sub src/d2
+
+WVSTART 'dirty counts: after save'
+WVPASS bup save -n src src
+WVPASS bup index src
+WVPASS counts-match-prescan src src/d1 src/d1/sub src/d2
+
+WVSTART 'dirty counts: after changes'
+WVPASS echo more >> src/d1/sub/f2
+WVPASS rm src/d2/f3
+WVPASS mkdir src/d4
+WVPASS echo six > src/d4/f6
+WVPASS echo seven > src/d3/f7
+WVPASS sleep 2
+WVPASS bup index src
+WVPASS counts-match-prescan src src/d1 src/d1/sub src/d2 src/d3 src/d4
+
+WVSTART 'dirty counts: fake-valid and fake-invalid'
+WVPASS bup index --fake-valid src/d1
+WVPASS counts-match-prescan src/d1 src/d1/sub
+WVPASS bup index --fake-invalid src/d3
+WVPASS counts-match-prescan src/d3
+WVPASS bup index src
+WVPASS counts-match-prescan src src/d1 src/d3 src/d4
+
+WVPASS rm -rf "$tmpdir"
@@ -0,0 +1,132 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh || exit $?
+. t/lib.sh || exit $?
+
+set -o pipefail
+
+if ! bup-python -c 'import sys; sys.path[:0] = ["lib"]
+from bup import journal; sys.exit(not journal.have_inotify())'
+then
+    WVSTART 'no inotify support; skipping test'
+    exit 0
+fi
+
+top="$(WVPASS pwd)" || exit $?
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+
+export BUP_DIR="$tmpdir/bup"
+export GIT_DIR="$tmpdir/bup"
+
+bup() { "$top/bup" "$@"; }
+
+# When bup runs the subcommand as a child (rather than via exec), it
+# ignores SIGTERM itself and expects the child to get it too.
+watcher=''
+stop-watcher()
+{
+    pkill -P "$watcher"
+    kill "$watcher"
+    wait "$watcher"
+    watcher=''
+}
+trap 'test -z "$watcher" || stop-watcher' EXIT
+
+journal-records()
+{
+    tr '\0' '\n' < "$BUP_DIR/bupindex.journal"
+}
+
+wait-for-journal()
+{
+    local i
+    for i in $(seq 100); do
+        if journal-records 2> /dev/null | grep -qx "$1"; then
+            return 0
+        fi
+        sleep 0.1
+    done
+    return 1
+}
+
+# Compare the index against one made by a full walk.
+check-index()
+{
+    WVPASS bup index -f "$tmpdir/full.idx" src
+    WVPASSEQ "$(WVPASS bup index -s src)" \
+             "$(WVPASS bup index -s -f "$tmpdir/full.idx" src)"
+}
+
+
+WVPASS bup init
+WVPASS cd "$tmpdir"
+WVPASS mkdir -p src/a/b src/c
+WVPASS touch src/a/1 src/a/b/2 src/c/3
+WVPASS bup index src
+
+
+WVSTART "index --from-journal (no watcher)"
+WVPASS touch src/c/4
+WVPASS bup index --from-journal src 2>&1 | WVPASS grep 'no watcher is running'
+check-index
+
+
+WVSTART "index --watch"
+"$top/bup" index --watch src &
+watcher=$!
+WVPASS wait-for-journal o
+# The second overflow record marks the end of the initial scan.
+for i in $(seq 100); do
+    test "$(journal-records | grep -cx o)" -ge 2 && break
+    sleep 0.1
+done
+WVPASSEQ "$(journal-records | grep -cx o)" 2
+WVFAIL bup index --watch src
+WVPASS bup index --from-journal src 2>&1 | WVPASS grep 'journal overflowed'
+check-index
+
+
+WVSTART "index --from-journal"
+WVPASS echo changed > src/a/1
+WVPASS rm src/c/3
+WVPASS mkdir -p src/d/e
+WVPASS touch src/d/e/5
+WVPASS mv src/a/b src/b
+WVPASS chmod 700 src/c
+WVPASS wait-for-journal "p$(pwd)/src/c"
+out="$(WVPASS bup index --from-journal src 2>&1)" || exit $?
+echo "$out" | WVFAIL grep 'checking everything'
+check-index
+WVPASSEQ "$(WVPASS bup index -s src)" \
+"A src/d/e/5
+A src/d/e/
+A src/d/
+A src/c/4
+D src/c/3
+A src/c/
+A src/b/2
+A src/b/
+D src/a/b/2
+D src/a/b/
+A src/a/1
+A src/a/
+A src/"
+WVPASS test ! -e "$BUP_DIR/bupindex.journal.claimed"
+
+# Paths outside the updated ones are kept for later.
+WVPASS touch src/d/6 src/a/7
+WVPASS wait-for-journal "p$(pwd)/src/a/7"
+WVPASS bup index --from-journal src/d
+WVPASS tr '\0' '\n' < "$BUP_DIR/bupindex.journal.claimed" \
+    | WVPASS grep -x "p$(pwd)/src/a/7"
+WVPASS bup index --from-journal src
+check-index
+
+
+WVSTART "index --from-journal (watcher stopped)"
+stop-watcher
+WVPASS touch src/8
+WVPASS bup index --from-journal src 2>&1 | WVPASS grep 'no watcher is running'
+check-index
+
+WVPASS cd "$top"
+WVPASS rm -rf "$tmpdir"
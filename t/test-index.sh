@@ -124,4 +124,75 @@ WVPASS bup save -r ":$BUP_DIR" -n r-test $D
 WVFAIL bup save -r ":$BUP_DIR/fake/path" -n r-test $D
 WVFAIL bup save -r ":$BUP_DIR" -n r-test $D/fake/path
 
+
+WVSTART "index -j"
+WVPASS bup index -f "$tmpdir/serial.idx" $D
+WVPASS bup index -j 4 -f "$tmpdir/jobs.idx" $D
+WVPASSEQ "$(WVPASS bup index -pl -f "$tmpdir/jobs.idx" $D)" \
+    "$(WVPASS bup index -pl -f "$tmpdir/serial.idx" $D)"
+WVFAIL bup index -j 0 $D
+
+
+WVSTART "index --skip-unchanged-dirs"
+WVPASS rm -rf $D
+WVPASS mkdir -p $D/a/b $D/c
+WVPASS touch $D/a/1 $D/a/b/2 $D/a/b/3 $D/c/4
+# Make sure the index doesn't cap any of the directory times.
+WVPASS sleep 2
+WVPASS bup index -f "$tmpdir/full.idx" $D
+WVPASS cp "$tmpdir/full.idx" "$tmpdir/skip.idx"
+WVPASS cp "$tmpdir/full.idx.meta" "$tmpdir/skip.idx.meta"
+WVPASS echo changed > $D/a/1
+WVPASS rm $D/a/b/3
+WVPASS touch $D/c/5
+WVPASS bup index -f "$tmpdir/full.idx" $D
+WVPASS bup index --skip-unchanged-dirs -f "$tmpdir/skip.idx" $D
+WVPASSEQ "$(WVPASS bup index -s -f "$tmpdir/skip.idx" $D)" \
+    "$(WVPASS bup index -s -f "$tmpdir/full.idx" $D)"
+WVPASS bup index --skip-unchanged-dirs -j 3 -f "$tmpdir/skip.idx" $D
+WVPASSEQ "$(WVPASS bup index -s -f "$tmpdir/skip.idx" $D)" \
+    "$(WVPASS bup index -s -f "$tmpdir/full.idx" $D)"
+
+
+WVSTART "index overlay"
+WVPASS rm -rf $D
+ov="$tmpdir/overlay.idx"
+for d in $(seq 20); do
+    WVPASS mkdir -p $D/d$d
+    for f in $(seq 10); do WVPASS touch $D/d$d/f$f; done
+done
+# As above, don't let the index treat anything as racy.
+WVPASS sleep 2
+WVPASS bup index -f "$ov" $D
+WVPASS bup save -f "$ov" -n overlay $D
+WVPASS mkdir $D/d3/new
+WVPASS touch $D/d3/f11 $D/d3/new/1
+WVPASS rm $D/d5/f1
+WVPASS bup index -u --check -f "$ov" $D
+# A few new entries go to the overlay, leaving the main index alone.
+WVPASS test -s "$ov.overlay"
+WVPASSEQ "$(WVPASS bup index -s -f "$ov" $D | WVPASS grep -v '^  ')" \
+"D $D/d5/f1
+M $D/d5/
+A $D/d3/new/1
+A $D/d3/new/
+A $D/d3/f11
+M $D/d3/
+M $D/"
+WVPASS bup save -f "$ov" -n overlay $D
+WVPASSEQ "$(WVPASS bup index -s -f "$ov" $D | WVPASS grep -v '^  ')" "D $D/d5/f1"
+WVPASS force-delete restore
+WVPASS bup restore -C restore overlay/latest/"$tmpdir"/$D/
+WVPASS "$top/t/compare-trees" $D/ restore/
+# Enough new entries compact the overlay into the main index, dropping
+# the deletions the last save saw.
+WVPASS mkdir $D/d21
+for f in $(seq 30); do WVPASS touch $D/d21/f$f; done
+WVPASS bup index -u --check -f "$ov" $D
+WVPASS test ! -e "$ov.overlay"
+WVPASS bup index -s -f "$ov" $D | WVFAIL grep '^D'
+WVPASS bup index -f "$tmpdir/overlay-full.idx" $D
+WVPASSEQ "$(WVPASS bup index -p -f "$ov" $D)" \
+    "$(WVPASS bup index -p -f "$tmpdir/overlay-full.idx" $D)"
+
 WVPASS rm -rf "$tmpdir"
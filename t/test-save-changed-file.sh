@@ -0,0 +1,56 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh || exit $?
+
+set -o pipefail
+
+top="$(WVPASS pwd)" || exit $?
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+export BUP_DIR="$tmpdir/bup"
+export GIT_DIR="$BUP_DIR"
+
+bup() { "$top/bup" "$@"; }
+
+# Save src to a new repository, and print the id of src/f there.
+fresh-save-id()
+{
+    (export BUP_DIR="$tmpdir/fresh" GIT_DIR="$tmpdir/fresh"
+     rm -rf "$BUP_DIR" \
+         && bup init \
+         && bup index src \
+         && bup save -n src src \
+         && bup ls -s "src/latest/$tmpdir/src/f" | cut -d' ' -f1)
+}
+
+WVPASS cd "$tmpdir"
+WVPASS bup init
+WVPASS mkdir src
+WVPASS head -c 2000000 /dev/urandom > src/f
+WVPASS bup index src
+WVPASS bup save -n src src
+
+
+WVSTART 'grown file'
+WVPASS head -c 80000 /dev/urandom >> src/f
+WVPASS bup index src
+WVPASS bup save -n src src
+WVPASS rm -rf restore
+WVPASS bup restore -C restore "src/latest/$tmpdir/src/f"
+WVPASS cmp src/f restore/f
+WVPASSEQ "$(WVPASS bup ls -s "src/latest/$tmpdir/src/f" | cut -d' ' -f1)" \
+         "$(WVPASS fresh-save-id)"
+
+
+WVSTART 'grown file, changed before its end'
+WVPASS dd if=/dev/urandom of=src/f bs=1 seek=100000 count=100 conv=notrunc
+WVPASS head -c 80000 /dev/urandom >> src/f
+WVPASS bup index src
+WVPASS bup save -n src src
+WVPASS rm -rf restore
+WVPASS bup restore -C restore "src/latest/$tmpdir/src/f"
+WVPASS cmp src/f restore/f
+WVPASSEQ "$(WVPASS bup ls -s "src/latest/$tmpdir/src/f" | cut -d' ' -f1)" \
+         "$(WVPASS fresh-save-id)"
+
+
+WVPASS cd "$top"
+WVPASS rm -rf "$tmpdir"
@@ -0,0 +1,33 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh || exit $?
+
+set -o pipefail
+
+top="$(WVPASS pwd)" || exit $?
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+export BUP_DIR="$tmpdir/bup"
+
+bup() { "$top/bup" "$@"; }
+
+WVPASS cd "$tmpdir"
+WVPASS bup init
+WVPASS mkdir src
+WVPASS echo same > src/same
+WVPASS echo changed > src/changed
+WVPASS chmod 600 src/same src/changed
+# Make sure the index doesn't cap any of the times.
+WVPASS sleep 2
+
+
+WVSTART 'save uses indexed metadata only for unchanged paths'
+WVPASS bup index src
+WVPASS chmod 640 src/changed
+WVPASS bup save -n src src
+WVPASS bup restore -C restore /src/latest/"$tmpdir"/src/
+WVPASSEQ "$(WVPASS stat -c %a restore/same)" 600
+WVPASSEQ "$(WVPASS stat -c %a restore/changed)" 640
+WVPASSEQ "$(WVPASS stat -c %Y restore/same)" "$(WVPASS stat -c %Y src/same)"
+
+
+WVPASS cd "$top"
+WVPASS rm -rf "$tmpdir"
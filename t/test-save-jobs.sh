@@ -0,0 +1,65 @@
+#!/usr/bin/env bash
+. ./wvtest-bup.sh || exit $?
+
+set -o pipefail
+
+top="$(WVPASS pwd)" || exit $?
+tmpdir="$(WVPASS wvmktempdir)" || exit $?
+
+bup() { "$top/bup" "$@"; }
+
+WVPASS mkdir -p "$tmpdir/src/sub"
+WVPASS bup random --seed 1 3m > "$tmpdir/src/big"
+WVPASS bup random --seed 2 200k > "$tmpdir/src/sub/medium"
+for i in $(seq 1 20); do
+    WVPASS bup random --seed $((i + 2)) $((i * 3))k > "$tmpdir/src/sub/f$i"
+done
+WVPASS touch "$tmpdir/src/empty"
+WVPASS ln -s big "$tmpdir/src/link"
+
+
+WVSTART 'save -j matches save'
+export BUP_DIR="$tmpdir/serial"
+WVPASS bup init
+WVPASS bup index "$tmpdir/src"
+WVPASS cp -a "$tmpdir/serial" "$tmpdir/jobs"
+WVPASS cp -a "$tmpdir/serial" "$tmpdir/prefetch"
+WVPASS cp -a "$tmpdir/serial" "$tmpdir/both"
+serial="$(WVPASS bup save -t "$tmpdir/src")" || exit $?
+export BUP_DIR="$tmpdir/prefetch"
+WVPASSEQ "$(WVPASS bup save --prefetch 4 -t "$tmpdir/src")" "$serial"
+WVFAIL bup save --prefetch -1 -t "$tmpdir/src"
+export BUP_DIR="$tmpdir/both"
+WVPASSEQ "$(WVPASS bup save -j 2 --prefetch 2 -t "$tmpdir/src")" "$serial"
+export BUP_DIR="$tmpdir/jobs"
+WVPASSEQ "$(WVPASS bup save -j 3 -t "$tmpdir/src")" "$serial"
+WVPASS git --git-dir="$BUP_DIR" fsck --no-dangling
+WVFAIL bup save -j 0 -t "$tmpdir/src"
+
+
+WVSTART 'save of grown files'
+WVPASS bup random --seed 99 100k >> "$tmpdir/src/big"
+WVPASS bup random --seed 98 10k >> "$tmpdir/src/sub/f20"
+for dir in serial jobs; do
+    export BUP_DIR="$tmpdir/$dir"
+    WVPASS bup index "$tmpdir/src"
+done
+# Since the files' metadata may differ, just compare their contents.
+file-ids()
+{
+    local tree="$(WVPASS bup save "$@" --strip -t "$tmpdir/src")" || exit $?
+    WVPASS git --git-dir="$BUP_DIR" ls-tree -r "$tree" | WVPASS grep -v bupm
+}
+export BUP_DIR="$tmpdir/serial"
+grown="$(file-ids)" || exit $?
+export BUP_DIR="$tmpdir/jobs"
+WVPASSEQ "$(file-ids -j 2)" "$grown"
+export BUP_DIR="$tmpdir/fresh"
+WVPASS bup init
+WVPASS bup index "$tmpdir/src"
+WVPASSEQ "$(file-ids)" "$grown"
+WVPASS bup save -n src "$tmpdir/src"
+WVPASS bup restore -C "$tmpdir/restore" "/src/latest$tmpdir/src/big"
+WVPASS cmp "$tmpdir/src/big" "$tmpdir/restore/big"
+
+WVPASS rm -rf "$tmpdir"